@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Benchmark one run of the main loop (list, rename, download, backfill,
+delete) against a fake_dropbox.FakeBackend, so performance changes can be
+checked without a network or a dropbox account.
+
+For each folder size we fill a fake folder with that many synthetic images,
+then run each phase and report how long it took, how many API calls it
+made, how many bytes it moved, and the peak RSS of the process after it.
+
+Usage:
+  bench_backend.py [options]
+  bench_backend.py (-h | --help)
+
+Options:
+  -h, --help              Show this text and exit
+  --sizes=<n,...>         Comma separated folder sizes to benchmark
+                          [default: 1000,10000,100000]
+  --unrenamed=<f>         Fraction of the images that still need to be
+                          renamed [default: 0.01]
+  --new=<f>               Fraction of the images that have not been
+                          downloaded yet [default: 0.01]
+  --missing=<f>           Fraction of the images older than the newest one
+                          we have downloaded that we never downloaded (that
+                          the backfill phase has to find) [default: 0.001]
+  --expired=<f>           Fraction of the images that are old enough to be
+                          deleted [default: 0.1]
+  --size=<bytes>          Size of each image [default: 20000]
+  --latency=<s>           Seconds each API call takes [default: 0]
+  --not_found_rate=<f>    Fraction of calls that fail with a 404 [default: 0]
+  --error_rate=<f>        Fraction of calls that fail with a 500 [default: 0]
+  --timeout_rate=<f>      Fraction of calls that time out [default: 0]
+  --download_workers=<n>  Files to download at the same time [default: 1]
+  --mutation_workers=<n>  Files to rename or delete at the same time
+                          [default: 1]
+  --retries=<n>           Times to retry a call that failed with a transient
+                          error [default: 3]
+"""
+
+# system imports
+#
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+# 3rd party imports
+#
+from docopt import docopt
+
+import webcam_download_rename_clean as webcam
+from fake_dropbox import FakeBackend
+
+
+##################################################################
+##################################################################
+#
+class Quiet(object):
+    """
+    A file that throws away what is written to it, so the script's chatter
+    about every file it touches does not swamp the results.
+    """
+    def write(self, s):
+        pass
+
+
+####################################################################
+#
+def peak_rss():
+    """
+    Return the peak resident set size of this process in megabytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss / (1024.0 * 1024.0)
+    return rss / 1024.0
+
+
+####################################################################
+#
+@contextmanager
+def phase(name, backend, results):
+    """
+    Time the phase `name`, count the calls it made to `backend`, and add a
+    line about it to `results`.
+    """
+    backend.reset_counters()
+    stdout = sys.stdout
+    sys.stdout = Quiet()
+    start = time.time()
+    error = None
+    try:
+        yield
+    except (webcam.BackendError, webcam.BackendSocketError), e:
+        error = e
+    finally:
+        elapsed = time.time() - start
+        sys.stdout = stdout
+    results.append((name, elapsed, sum(backend.calls.values()),
+                    backend.bytes_sent + backend.bytes_received, peak_rss(),
+                    error))
+
+
+#############################################################################
+#
+def main():
+    """
+    Run the benchmark for each folder size and print the results.
+    """
+    args = docopt(__doc__)
+    folder = "/Apps/Ninja Blocks"
+    download_workers = int(args['--download_workers'])
+    mutation_workers = int(args['--mutation_workers'])
+    retries = int(args['--retries'])
+
+    print "%-8s %-10s %10s %10s %14s %10s" % ("files", "phase", "seconds",
+                                              "calls", "bytes", "peak MB")
+    for size in [int(n) for n in args['--sizes'].split(",")]:
+        backend = FakeBackend(latency=float(args['--latency']),
+                              not_found_rate=float(args['--not_found_rate']),
+                              error_rate=float(args['--error_rate']),
+                              timeout_rate=float(args['--timeout_rate']),
+                              seed=size)
+        retrying = webcam.RetryingBackend(backend, retries)
+        unrenamed = int(size * float(args['--unrenamed']))
+        start = 1367712000
+        step = 30
+        t = backend.populate(folder, size - unrenamed, start=start, step=step,
+                             size=int(args['--size']))
+        backend.populate(folder, unrenamed, start=t, step=step,
+                         size=int(args['--size']), renamed=False)
+
+        # Everything up to 'when' counts as already downloaded, and
+        # everything up to 'expiry' is old enough to delete.
+        #
+        when = start + int(size * (1 - float(args['--new']))) * step
+        expiry = start + int(size * float(args['--expired'])) * step
+
+        dest_dir = tempfile.mkdtemp(prefix="bench_backend.")
+        results = []
+        try:
+            # Everything up to 'when' is already in the index, except for
+            # the ones we are pretending we missed.
+            #
+            index = webcam.DownloadIndex(os.path.join(dest_dir, "index"))
+            missing = float(args['--missing'])
+            every = int(1 / missing) if missing else 0
+            for i in range((when - start) / step):
+                if not every or i % every != every - 1:
+                    index.add(webcam.timestamp_fname(start + i * step))
+            index.commit()
+            with phase("list", backend, results):
+                cur_hash, files = webcam.get_dropbox_dir(backend, folder)
+            with phase("parse", backend, results):
+                files = webcam.Listing(files)
+            with phase("rename", backend, results):
+                renames = webcam.rename_dropbox_files(
+                    backend, folder, files, False, workers=mutation_workers,
+                    backend_factory=lambda: backend)
+                files.apply_renames(renames)
+            with phase("download", backend, results):
+                webcam.download_new_files(
+                    retrying, folder, dest_dir, files, when, False,
+                    workers=download_workers,
+                    backend_factory=lambda: retrying, index=index)
+            with phase("backfill", backend, results):
+                webcam.backfill_files(
+                    retrying, folder, dest_dir, files, index, start, when,
+                    False, workers=download_workers,
+                    backend_factory=lambda: retrying)
+            with phase("delete", backend, results):
+                webcam.delete_old_files(backend, folder, files, expiry, False,
+                                        workers=mutation_workers,
+                                        backend_factory=lambda: backend)
+            index.close()
+        finally:
+            shutil.rmtree(dest_dir)
+
+        total = [0, 0, 0]
+        for name, elapsed, calls, moved, rss, error in results:
+            print "%-8d %-10s %10.3f %10d %14d %10.1f%s" % \
+                (size, name, elapsed, calls, moved, rss,
+                 "" if error is None else "  failed: %s" % error)
+            total[0] += elapsed
+            total[1] += calls
+            total[2] += moved
+        print "%-8d %-10s %10.3f %10d %14d %10.1f" % \
+            (size, "loop", total[0], total[1], total[2], peak_rss())
+    return
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    main()
+
+############################################################################
+############################################################################
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A micro-benchmark comparing how long it takes to parse the timestamps out of
+a folder listing with arrow (the way the rename, download, and delete phases
+each used to do it) against building a single Listing that all three phases
+share.
+
+Usage:
+  bench_parse_timestamps.py [options]
+  bench_parse_timestamps.py (-h | --help)
+
+Options:
+  -h, --help          Show this text and exit
+  --files=<n>         Number of file names in the listing [default: 100000]
+  --renames=<n>       How many of those still have the name the ninjablock
+                      uploads them with [default: 1000]
+  --repeat=<n>        Take the best of this many runs [default: 3]
+"""
+
+# system imports
+#
+import random
+import time
+
+# 3rd party imports
+#
+import arrow
+from docopt import docopt
+
+import webcam_download_rename_clean as webcam
+
+
+####################################################################
+#
+def make_listing(n_files, n_renames):
+    """
+    Return a shuffled list of `n_files` file names, `n_renames` of which are
+    named the way the ninjablock uploads them.
+    """
+    files = []
+    t = 1367712000
+    for i in range(n_files - n_renames):
+        files.append(webcam.timestamp_fname(t))
+        t += 7
+    for i in range(n_renames):
+        files.append(time.strftime("%a, %d %b %Y %H:%M:%S GMT.jpg",
+                                   time.gmtime(t)))
+        t += 7
+    random.shuffle(files)
+    return files
+
+
+####################################################################
+#
+def parse_with_arrow(files, when):
+    """
+    What one phase used to do: run the regular expressions over every name
+    and have arrow parse the ones that match.
+    """
+    renames = []
+    newer = []
+    for fname in files:
+        fname = str(fname)
+        if webcam.FNAMES_TO_MATCH_re.search(fname) is not None:
+            d = arrow.get(str(fname[5:-4]), "DD MMM YYYY HH:mm:ss")
+            renames.append((fname,
+                            "%s.jpg" % d.format(webcam.arrow_timestamp_fmt)))
+        elif webcam.DATE_FNAME_re.search(fname) is not None:
+            if arrow.get(fname, webcam.arrow_timestamp_fmt) > when:
+                newer.append(fname)
+    return renames, newer
+
+
+####################################################################
+#
+def parse_with_listing(files, when):
+    """
+    What the phases share now: one Listing.
+    """
+    listing = webcam.Listing(files)
+    return listing.to_rename, listing.newer_than(when)
+
+
+####################################################################
+#
+def best_time(func, repeat, *args):
+    """
+    Return the best wall clock time of `repeat` calls to func(*args) and
+    what the last call returned.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+#############################################################################
+#
+def main():
+    """
+    Run the benchmark and print the results.
+    """
+    args = docopt(__doc__)
+    n_files = int(args['--files'])
+    repeat = int(args['--repeat'])
+    files = make_listing(n_files, int(args['--renames']))
+    when = arrow.get(1367712000 + 7 * (n_files / 2))
+
+    arrow_time, (a_renames, a_newer) = best_time(parse_with_arrow, repeat,
+                                                 files, when)
+    listing_time, (l_renames, l_newer) = best_time(parse_with_listing,
+                                                   repeat, files, when)
+
+    # Make sure the two agree before we say anything about how fast they are.
+    #
+    assert sorted(a_renames) == sorted(l_renames)
+    assert sorted(a_newer) == l_newer
+
+    print "Parsing a listing of %d files (best of %d):" % (n_files, repeat)
+    print "  arrow, per phase:    %8.3fs" % arrow_time
+    print "  arrow, three phases: %8.3fs" % (arrow_time * 3)
+    print "  Listing, shared:     %8.3fs" % listing_time
+    print "  speedup:             %8.1fx" % (arrow_time * 3 / listing_time)
+    return
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    main()
+
+############################################################################
+############################################################################
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Benchmark how long a '--one_run' of webcam_download_rename_clean takes when
+nothing has changed in the dropbox folder, which is what most runs from cron
+look like.
+
+Each run is a fresh python process (so we pay for starting python and
+importing everything, like cron does) run against a fake_dropbox.FakeBackend
+with `--files` images in it that have all been downloaded already. We time:
+
+o starting python and doing nothing
+o starting python and importing the script
+o a run without a state file (the full listing and index are read)
+o a run with a state file (one metadata call that dropbox answers with a
+  304)
+
+The time it takes the fake backend to fill its folder in each process is
+left out.
+
+Usage:
+  bench_startup.py [options]
+  bench_startup.py (-h | --help)
+
+Options:
+  -h, --help              Show this text and exit
+  --files=<n>             Number of images in the dropbox folder
+                          [default: 10000]
+  --runs=<n>              Number of runs of each kind. We report the median.
+                          [default: 10]
+  --run=<dir>             Used by the benchmark itself: do one run with
+                          <dir> as the download directory and print how long
+                          filling the fake folder took.
+  --no_state              With '--run', do not use a state file.
+"""
+
+# system imports
+#
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# 3rd party imports
+#
+from docopt import docopt
+
+
+##################################################################
+##################################################################
+#
+class Quiet(object):
+    """
+    A file that throws away what is written to it, so the script's chatter
+    does not get mixed up with what we print.
+    """
+    def write(self, s):
+        pass
+
+
+####################################################################
+#
+def one_run(dest_dir, n_files, use_state):
+    """
+    Run the script once, with '--one_run', against a fake dropbox folder with
+    `n_files` images in it. Returns how long it took to fill the fake
+    folder, in seconds.
+
+    Arguments:
+    - `dest_dir`: The download directory (with the config in it)
+    - `n_files`: How many images are in the dropbox folder
+    - `use_state`: If False the run does not use a state file
+    """
+    import webcam_download_rename_clean as webcam
+    start = time.time()
+    from fake_dropbox import FakeBackend
+    backend = FakeBackend()
+    backend.populate("/Apps/Ninja Blocks", n_files)
+    webcam.DropboxBackend = lambda client: backend
+    populate = time.time() - start
+
+    state = os.path.join(dest_dir, "state.json")
+    if not use_state:
+        state = os.path.join(dest_dir, "no-state.json")
+        if os.path.exists(state):
+            os.unlink(state)
+    sys.argv = [sys.argv[0], "-c", os.path.join(dest_dir, "webcam.conf"),
+                "-d", dest_dir, "-f", "/Apps/Ninja Blocks", "--one_run",
+                "--state", state]
+    stdout = sys.stdout
+    sys.stdout = Quiet()
+    try:
+        webcam.main()
+    finally:
+        sys.stdout = stdout
+    return populate
+
+
+####################################################################
+#
+def time_command(args, runs):
+    """
+    Run `args` `runs` times and return the median wall time in seconds,
+    less whatever each run says it spent filling the fake folder.
+    """
+    times = []
+    for i in range(runs):
+        start = time.time()
+        output = subprocess.check_output(args)
+        elapsed = time.time() - start
+        lines = output.strip().splitlines()
+        if lines:
+            elapsed -= float(lines[-1])
+        times.append(elapsed)
+    times.sort()
+    return times[len(times) / 2]
+
+
+#############################################################################
+#
+def main():
+    """
+    Time each kind of run and print the results.
+    """
+    args = docopt(__doc__)
+    n_files = int(args['--files'])
+    if args['--run']:
+        print one_run(args['--run'], n_files, not args['--no_state'])
+        return
+
+    runs = int(args['--runs'])
+    python = sys.executable
+    script = os.path.abspath(__file__)
+    dest_dir = tempfile.mkdtemp(prefix="bench_startup.")
+    try:
+        with open(os.path.join(dest_dir, "webcam.conf"), "w") as f:
+            f.write("[general]\n"
+                    "app_key = key\n"
+                    "app_secret = secret\n"
+                    "access_token = token\n"
+                    "access_token_secret = token_secret\n")
+
+        # The first run downloads everything (and writes the state file),
+        # so every run after it finds nothing has changed.
+        #
+        run = [python, script, "--files", str(n_files), "--run", dest_dir]
+        subprocess.check_output(run)
+
+        print "%d images in the folder, median of %d runs" % (n_files, runs)
+        print "  %-28s %8.1f ms" % (
+            "python", 1000 * time_command([python, "-c", "pass"], runs))
+        print "  %-28s %8.1f ms" % (
+            "import", 1000 * time_command(
+                [python, "-c", "import webcam_download_rename_clean"], runs))
+        print "  %-28s %8.1f ms" % (
+            "no change, no state file",
+            1000 * time_command(run + ["--no_state"], runs))
+        print "  %-28s %8.1f ms" % ("no change, state file",
+                                    1000 * time_command(run, runs))
+    finally:
+        shutil.rmtree(dest_dir)
+    return
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    main()
+
+############################################################################
+############################################################################
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+An in-memory stand-in for dropbox so that the webcam_download_rename_clean
+script can be exercised (and benchmarked) without talking to dropbox.
+
+FakeBackend implements the script's Backend interface: list_folder(),
+delta(), move(), download() and delete(). It can be told to take a while to
+answer each call (`latency`) and to fail some fraction of calls with a 404, a
+500, or a socket timeout, so the script's error handling can be exercised
+too. populate() fills a folder with any number of synthetic images.
+
+It also keeps track of how many calls of each kind were made and how many
+bytes each call would have sent or received.
+
+Run it as a script to simulate a camera uploading to a folder that already
+has a week of images in it, and compare full listings with the incremental
+(delta) listing the script does in '--incremental' mode.
+
+Usage:
+  fake_dropbox.py [options]
+  fake_dropbox.py (-h | --help)
+
+Options:
+  -h, --help              Show this text and exit
+  --files=<n>             Number of files already in the folder
+                          [default: 20000]
+  --polls=<n>             Number of polls to simulate [default: 20]
+  --per_poll=<n>          Number of new files uploaded between polls
+                          [default: 3]
+"""
+
+# system imports
+#
+import errno
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from StringIO import StringIO
+
+# 3rd party imports
+#
+from docopt import docopt
+
+import webcam_download_rename_clean as webcam
+
+
+##################################################################
+##################################################################
+#
+class FakeBackend(webcam.Backend):
+    """
+    An in-memory storage service. It is safe to share one between threads.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, delta_page_size=2000, latency=0.0, not_found_rate=0.0,
+                 error_rate=0.0, timeout_rate=0.0, seed=None):
+        """
+        Arguments:
+        - `delta_page_size`: The most entries we return from one delta() call
+        - `latency`: How long, in seconds, each call takes
+        - `not_found_rate`: The fraction of move()s, download()s and
+                            delete()s that fail with a 404, as if the file
+                            had been deleted out from under us
+        - `error_rate`: The fraction of calls that fail with a 500
+        - `timeout_rate`: The fraction of calls that fail with a socket
+                          timeout
+        - `seed`: Seed for the random number generator that decides which
+                  calls fail
+        """
+        self.delta_page_size = delta_page_size
+        self.latency = latency
+        self.not_found_rate = not_found_rate
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+
+        # The files in the account, indexed by lower-cased path. Each value is
+        # a tuple of the file's metadata and contents.
+        #
+        self.files = {}
+
+        # Every change ever made to the account, in order, as the entries the
+        # delta API returns. A delta cursor is just an offset in to this log.
+        #
+        self.log = []
+
+        # The last list of the files in the account we made for a delta
+        # without a cursor, and how far in to the log it goes.
+        #
+        self.snapshot = None
+
+        self.rev = 0
+        self.calls = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    ##################################################################
+    #
+    def reset_counters(self):
+        """
+        Forget how many calls have been made and how many bytes were moved.
+        """
+        with self.lock:
+            self.calls = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    ##################################################################
+    #
+    def _call(self, call, path=None):
+        """
+        Record that we are making `call`, wait `latency` seconds, and then
+        maybe fail it.
+        """
+        with self.lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+            roll = self.random.random()
+        if self.latency:
+            time.sleep(self.latency)
+        if roll < self.timeout_rate:
+            raise webcam.BackendSocketError(errno.ETIMEDOUT,
+                                            "Connection timed out")
+        roll -= self.timeout_rate
+        if roll < self.error_rate:
+            raise webcam.BackendError(500, "Internal Server Error")
+        roll -= self.error_rate
+        if path is not None:
+            if roll < self.not_found_rate or path.lower() not in self.files:
+                raise webcam.BackendError(404, "Not Found")
+
+    ##################################################################
+    #
+    def _sent(self, response):
+        """
+        Record that a call sent us `response` (as JSON.)
+        """
+        with self.lock:
+            self.bytes_sent += len(json.dumps(response))
+        return response
+
+    ##################################################################
+    #
+    def put_file(self, path, data):
+        """
+        Add a file to the account (as a camera uploading it would.)
+
+        Arguments:
+        - `path`: The full path of the file
+        - `data`: Its contents
+        """
+        with self.lock:
+            self.rev += 1
+            metadata = {'path': path,
+                        'is_dir': False,
+                        'bytes': len(data),
+                        'rev': "%x" % self.rev}
+            self.files[path.lower()] = (metadata, data)
+            self.log.append([path.lower(), metadata])
+        return metadata
+
+    ##################################################################
+    #
+    def populate(self, folder, count, start=1367712000, step=30, size=0,
+                 renamed=True):
+        """
+        Fill `folder` with `count` synthetic images.
+
+        Arguments:
+        - `folder`: The folder to put them in
+        - `count`: How many images
+        - `start`: The time, in seconds since the epoch, of the first image
+        - `step`: The number of seconds between images
+        - `size`: The size of each image in bytes
+        - `renamed`: If True the images have the names we rename images to,
+                     otherwise they are named the way the ninjablock names
+                     them
+        """
+        data = "\xff" * size
+        for i in range(count):
+            t = start + i * step
+            if renamed:
+                fname = webcam.timestamp_fname(t)
+            else:
+                fname = time.strftime("%a, %d %b %Y %H:%M:%S GMT.jpg",
+                                      time.gmtime(t))
+            self.put_file("%s/%s" % (folder.rstrip("/"), fname), data)
+        return start + count * step
+
+    ##################################################################
+    #
+    def _remove(self, path):
+        self.files.pop(path.lower())
+        self.log.append([path.lower(), None])
+
+    ##################################################################
+    #
+    def list_folder(self, path, hash=None, file_limit=25000):
+        self._call('list_folder')
+        with self.lock:
+            folder = path.rstrip("/").lower()
+            contents = [md for md, data in self.files.itervalues()
+                        if os.path.dirname(md['path'].lower()) == folder]
+        if len(contents) > file_limit:
+            raise webcam.BackendError(406, "Not Acceptable",
+                                      error_msg="Too many files in folder")
+        folder_hash = hashlib.md5(
+            "".join(sorted(md['path'] + md['rev'] for md in contents))
+        ).hexdigest()
+        if hash is not None and hash == folder_hash:
+            raise webcam.BackendError(304, "Not Modified")
+        return self._sent({'path': path,
+                           'is_dir': True,
+                           'hash': folder_hash,
+                           'contents': contents})
+
+    ##################################################################
+    #
+    def delta(self, cursor=None):
+        """
+        Like dropbox, without a cursor (or with one from the middle of a
+        reset) we send the files that are in the account now, a page at a
+        time, and only then the changes made since we started.
+        """
+        self._call('delta')
+        with self.lock:
+            if cursor is None or cursor.startswith("reset:"):
+                if cursor is None:
+                    log_end, start = len(self.log), 0
+                else:
+                    log_end, start = [int(n) for n in cursor.split(":")[1:]]
+                live = self._snapshot(log_end)
+                end = min(len(live), start + self.delta_page_size)
+                entries = live[start:end]
+                if end < len(live):
+                    next_cursor = "reset:%d:%d" % (log_end, end)
+                    has_more = True
+                else:
+                    next_cursor = str(log_end)
+                    has_more = log_end < len(self.log)
+            else:
+                start = int(cursor)
+                end = min(len(self.log), start + self.delta_page_size)
+                entries = self.log[start:end]
+                next_cursor = str(end)
+                has_more = end < len(self.log)
+        return self._sent({'entries': entries,
+                           'reset': cursor is None,
+                           'cursor': next_cursor,
+                           'has_more': has_more})
+
+    ##################################################################
+    #
+    def _snapshot(self, log_end):
+        """
+        Return the delta entries for the files that were in the account
+        after the first `log_end` changes, in the order they were added.
+        """
+        if self.snapshot is None or self.snapshot[0] != log_end:
+            latest = {}
+            for i in range(log_end):
+                latest[self.log[i][0]] = i
+            self.snapshot = (log_end,
+                             [self.log[i] for i in sorted(latest.itervalues())
+                              if self.log[i][1] is not None])
+        return self.snapshot[1]
+
+    ##################################################################
+    #
+    def move(self, from_path, to_path):
+        self._call('move', from_path)
+        with self.lock:
+            if from_path.lower() not in self.files:
+                raise webcam.BackendError(404, "Not Found")
+            metadata, data = self.files[from_path.lower()]
+            self._remove(from_path)
+            metadata = self.put_file(to_path, data)
+        return self._sent(metadata)
+
+    ##################################################################
+    #
+    def download(self, path):
+        self._call('download', path)
+        with self.lock:
+            if path.lower() not in self.files:
+                raise webcam.BackendError(404, "Not Found")
+            metadata, data = self.files[path.lower()]
+            self.bytes_received += len(data)
+        return StringIO(data), metadata
+
+    ##################################################################
+    #
+    def delete(self, path):
+        self._call('delete', path)
+        with self.lock:
+            if path.lower() not in self.files:
+                raise webcam.BackendError(404, "Not Found")
+            metadata, data = self.files[path.lower()]
+            self._remove(path)
+        return self._sent(metadata)
+
+
+#############################################################################
+#
+def main():
+    """
+    Simulate a camera uploading images to a folder that already has
+    `--files` images in it and compare what it costs to keep track of the
+    folder with full listings and with the delta API.
+    """
+    args = docopt(__doc__)
+    n_files = int(args['--files'])
+    polls = int(args['--polls'])
+    per_poll = int(args['--per_poll'])
+    folder = "/Apps/Ninja Blocks"
+
+    backend = FakeBackend()
+    t = backend.populate(folder, n_files)
+
+    # Getting our first look at the folder costs the same either way.
+    #
+    view = webcam.FolderView(folder)
+    view.update(backend)
+
+    full_bytes = 0
+    delta_bytes = 0
+    for poll in range(polls):
+        t = backend.populate(folder, per_poll, start=t)
+
+        backend.reset_counters()
+        cur_hash, files = webcam.get_dropbox_dir(backend, folder)
+        full_bytes += backend.bytes_sent
+
+        backend.reset_counters()
+        generation, view_files = webcam.get_incremental_dir(backend, view)
+        delta_bytes += backend.bytes_sent
+
+        assert sorted(files) == view_files
+
+    print "%d polls of a folder with %d files, %d new files per poll" % \
+        (polls, n_files, per_poll)
+    print "  full listing: %10d bytes per poll" % (full_bytes / polls)
+    print "  delta:        %10d bytes per poll" % (delta_bytes / polls)
+    return
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    main()
+
+############################################################################
+############################################################################
@@ -24,8 +24,23 @@ It could be argued that the third task should be its own script but I do not
 want to deal with all the session and other bits of overhead in a separate
 script at this time.
 
+One copy of this script can watch several cameras (each its own dropbox
+folder downloading to its own directory.) Declare each one in a
+'[camera <name>]' section of the config file:
+
+  [camera front_door]
+  dropbox_folder = /Apps/Ninja Blocks/front door
+  dir = /var/webcam/front_door
+  expiry = 7
+  interval = 30
+
+'expiry' and 'interval' are optional and default to the command line options.
+If there are no camera sections the script watches the one folder given by
+'--dropbox_folder' and '--dir'.
+
 NOTE: We depend on the python modules listed in the 'requirements.txt'
-file. All hail 'pip install -r ./requirements.txt' + virtualenvs!
+file. All hail 'pip install -r ./requirements.txt' + virtualenvs! The
+'--dedupe' option also needs numpy and PIL (or Pillow.)
 
 Usage:
   webcam_download_rename_clean.py [options]
@@ -50,22 +65,200 @@ Options:
                               [default: /tmp/webcam]
   -i <s>, --interval=<s>      The interval in seconds between runs
                               [default: 30]
+  --adaptive                  Instead of always waiting '--interval' seconds
+                              between runs, wait longer and longer (up to
+                              '--max_interval') while nothing changes in the
+                              dropbox folder and go back to '--min_interval'
+                              as soon as something does.
+  --min_interval=<s>          The shortest time in seconds between runs in
+                              '--adaptive' mode [default: 5]
+  --max_interval=<s>          The longest time in seconds between runs in
+                              '--adaptive' mode [default: 600]
+  --jitter=<f>                In '--adaptive' mode randomly vary the time
+                              between runs by up to this fraction of it.
+                              [default: 0.1]
+  --download_workers=<n>      The number of files to download from dropbox at
+                              the same time. Each worker gets its own dropbox
+                              client. [default: 1]
+  --mutation_workers=<n>      The number of files to rename or delete in the
+                              dropbox at the same time. [default: 1]
+  --pipeline                  Rename, download, and delete files at the same
+                              time instead of one step after the other, so a
+                              file can be downloaded as soon as it is renamed.
+  --queue_size=<n>            In '--pipeline' mode the most files waiting to
+                              be downloaded or deleted. [default: 100]
+  --metrics_port=<port>       Serve our metrics (in the Prometheus text
+                              format) on http://localhost:<port>/metrics
+  --stats_file=<file>         Write our metrics (in the Prometheus text format)
+                              to this file after every run.
+  --profile                   Profile runs with cProfile, writing a '.pstats'
+                              file for each phase of a run to '--profile_dir',
+                              and write every call to dropbox and every file
+                              write that takes longer than '--slow_threshold'
+                              to 'slow.log' there.
+  --profile_dir=<dir>         Where '--profile' writes its files.
+                              [default: /tmp/webcam_profile]
+  --profile_sample=<f>        The fraction of runs '--profile' profiles. A
+                              small one, like 0.05, makes it cheap enough to
+                              leave on. [default: 1.0]
+  --profile_keep=<n>          How many profiled runs of each camera to keep
+                              the '.pstats' files of. [default: 10]
+  --slow_threshold=<s>        With '--profile', calls to dropbox and file
+                              writes that take at least this many seconds go
+                              in the slow log. [default: 1.0]
+  --http_port=<port>          Serve each camera's latest frame, older frames,
+                              and lists of frames on http://<host>:<port>/
+                              where <host> is '--http_host'.
+  --http_host=<host>          The address to serve frames on.
+                              [default: localhost]
+  --frame_cache=<n>           How many of the frames we downloaded last we
+                              keep in memory for each camera to serve.
+                              [default: 16]
+  --retries=<n>               The most times we retry a call to dropbox that
+                              failed with a transient error (a 5xx, a 429, or
+                              a socket error) [default: 3]
+  --retry_budget=<n>          The most retries, of all calls together, in one
+                              run of a camera. [default: 20]
+  --no_keep_alive             Open a new connection to dropbox for every call
+                              instead of keeping them open.
+  --max_concurrency=<n>       The most calls to dropbox we have going at once,
+                              across all cameras and workers. [default: 8]
+  --max_files_per_run=<n>     The most files we download for a camera in one
+                              run, so a camera that is catching up does not
+                              hold up the others. 0 means no limit.
+                              [default: 0]
+  --backfill                  When we start, look for files in the dropbox
+                              folder that are newer than '--expiry' but that
+                              we never downloaded (because they showed up late
+                              or we got an error downloading them) and
+                              download them.
+  --backfill_interval=<s>     Also look for files we never downloaded every
+                              this many seconds. 0 means only when we start
+                              (with '--backfill'). [default: 0]
+  --verify_every=<n>          After renaming files we normally work out what
+                              the dropbox folder looks like ourselves. Instead,
+                              every this many runs, get a fresh listing of it.
+                              0 means never. [default: 0]
+  --dedupe                    Do not keep frames that are nearly the same as
+                              the last frame we kept. The frames we skip are
+                              listed in '.webcam_skipped' in the download
+                              directory. Needs numpy and PIL.
+  --dedupe_threshold=<f>      Frames whose pixels differ from the last kept
+                              frame by less than this fraction on average are
+                              skipped. [default: 0.02]
+  --dedupe_workers=<n>        The number of processes decoding frames for
+                              '--dedupe'. [default: 2]
+  --retention=<tiers>         How to keep the images we have downloaded as they
+                              get older: a comma separated list of tiers, each
+                              the age in days it starts at and, separated by
+                              colons, 'quality=<n>' to recompress images,
+                              'scale=<f>' to shrink them, 'every=<minutes>' to
+                              keep only one image every so many minutes, or
+                              'delete'. For example
+                              7:quality=70:scale=0.5,90:every=10,365:delete
+                              Days that have been through a tier are packed
+                              (see '--compact'.) Recompressing needs PIL.
+  --retention_workers=<n>     The number of low priority processes
+                              recompressing images for '--retention'.
+                              [default: 1]
+  --compact                   Pack each day of images, once it is over, in to
+                              one '<yyyy-mm-dd>.pack' file in the year
+                              directory instead of leaving a file per image.
+  --keep_loose_days=<n>       With '--compact', how many of the most recent
+                              days to leave as a file per image. 1 means just
+                              today. [default: 1]
+  --fsync                     fsync each downloaded file before moving it in
+                              to place.
+  --index=<file>              The index of files we have downloaded. Defaults
+                              to '.webcam_index.sqlite' in the download
+                              directory.
+  --rebuild_index             Rebuild the index of downloaded files by
+                              scanning the download directory before starting.
+  --listing_limit=<n>         Folders with more than this many files in them
+                              are listed a page at a time instead of all at
+                              once, and from then on only asked what has
+                              changed (like '--incremental'.)
+                              [default: 25000]
+  --max_listing=<n>           The most files we read from a listing of the
+                              dropbox folder, so huge folders do not use up
+                              all our memory. If a listing is cut short we
+                              do not rename, download, or delete anything
+                              that run, since we can not tell which files
+                              we would miss. 0 means no limit. [default: 0]
+  --incremental               Instead of getting the entire listing of the
+                              dropbox folder every run only ask dropbox for
+                              what has changed since the last time we asked.
+  --delta_state=<file>        Where we keep what we know about the dropbox
+                              folder between runs in '--incremental' mode
+                              (or once it was listed a page at a time.)
+                              Defaults to '.webcam_delta.json' in the download
+                              directory.
+  --journal=<file>            Where we write down what we are about to rename,
+                              download, and delete, so if we are killed part
+                              way through a run we can finish it when we start
+                              again. Defaults to '.webcam_journal' in the
+                              download directory.
+  --state=<file>              Where we keep the dropbox folder's hash and the
+                              time of the latest image we downloaded, so a
+                              '--one_run' from cron can tell nothing has
+                              changed with one call to dropbox. Defaults to
+                              '.webcam_state.json' in the download directory.
 """
 
 # system imports
 #
+import bisect
+import BaseHTTPServer
+import calendar
+import cProfile
 import glob
 import ConfigParser
+import email.utils
+import heapq
+import errno
+import fcntl
+import functools
+import hashlib
+import httplib
+import inspect
+import json
+import mmap
+import random
 import re
 import os
+import signal
+import socket
+import SocketServer
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import Queue
+from array import array
+from contextlib import contextmanager
+from StringIO import StringIO
 from time import sleep
 
 # 3rd party imports
 #
-import dropbox
-import arrow
 from docopt import docopt
 
+# These take a while to import so we only import them when we need them:
+# dropbox when we are about to talk to dropbox (see import_dropbox()) and
+# numpy, PIL and multiprocessing when we are asked to '--dedupe' or to
+# recompress old frames (see import_image_modules() and
+# import_dedupe_modules().) That way a run from cron that finds nothing has
+# changed, or one that just prints '--help', does not pay for them.
+#
+dropbox = None
+numpy = None
+Image = None
+multiprocessing = None
+
 __version__ = "1.0.1"
 
 # The regular expression to match which files we will rename to make
@@ -80,11 +273,689 @@ FNAMES_TO_MATCH_re = re.compile(r'^(?P<weekday>\w\w\w), (?P<day>\d\d) '
 #
 DATE_FNAME_re = re.compile(r'^\d\d\d\d-\d\d-\d\dT\d\d_\d\d_\d\d-0000\.jpg$')
 
+# Dropbox's delta API only tells us the lower-cased name of a file that was
+# removed.
+#
+DATE_FNAME_NOCASE_re = re.compile(DATE_FNAME_re.pattern, re.IGNORECASE)
+
+# The regexp for a day, as in the name of the directory a day's images are
+# downloaded in to.
+#
+DAY_re = re.compile(r'^\d\d\d\d-\d\d-\d\d$')
+
 # the timestamp format used to parse and format our timestamp file names by
 # arrow.
 #
 arrow_timestamp_fmt = "YYYY-MM-DDTHH_mm_ssZ"
 
+# The month abbreviations in the file names we rename (these are always in
+# English.)
+#
+MONTHS = dict((m, i + 1) for i, m in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+     "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")))
+
+# The size (in pixels on a side) of the grayscale thumbnails we compare to
+# find frames that are nearly the same as the one before them.
+#
+DEDUPE_THUMBNAIL_SIZE = 32
+
+# A pack file (see PackFile) ends with an index of the frames in it, each
+# entry giving the frame's name, where it starts in the file and how long it
+# is, and then a trailer saying where the index starts and how many entries it
+# has.
+#
+PACK_MAGIC = "WCAMPAK1"
+PACK_ENTRY = struct.Struct("<28sQI")
+PACK_TRAILER = struct.Struct("<8sQI")
+
+# How often (in seconds) we go through the download directory applying a
+# camera's '--retention' policy, how many frames at a time we hand to the
+# processes recompressing them (which is also about how many frames we hold
+# in memory at once), and how nice those processes are, so they do not get
+# in the way of downloading.
+#
+RETENTION_INTERVAL = 60 * 60
+RETENTION_BATCH = 64
+RETENTION_NICENESS = 19
+
+# How much of a file we read from dropbox at a time when writing it to disk.
+#
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# The upper bounds, in seconds, of the buckets of our latency histograms.
+#
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Our umask. There is no way to read it without also setting it.
+#
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+##################################################################
+##################################################################
+#
+class Metrics(object):
+    """
+    Counters, gauges, and latency histograms describing what we have been
+    doing, which can be rendered in the Prometheus text format (see
+    `render()`.)
+
+    Each metric has a name and, optionally, labels, which are given as
+    keyword arguments:
+
+        metrics.inc('webcam_files_downloaded_total')
+        metrics.observe('webcam_api_call_seconds', 0.2, call='download')
+
+    It is safe to use from several threads at once.
+    """
+
+    ##################################################################
+    #
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+
+    ##################################################################
+    #
+    def _key(self, name, kind, labels):
+        """
+        Return the key we keep the value of metric `name` with `labels`
+        under, remembering what kind of metric it is.
+        """
+        self.types.setdefault(name, kind)
+        return (name, tuple(sorted(labels.iteritems())))
+
+    ##################################################################
+    #
+    def inc(self, name, value=1, **labels):
+        """
+        Add `value` to the counter `name`.
+        """
+        with self.lock:
+            key = self._key(name, 'counter', labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    ##################################################################
+    #
+    def set(self, name, value, **labels):
+        """
+        Set the gauge `name` to `value`.
+        """
+        with self.lock:
+            self.values[self._key(name, 'gauge', labels)] = value
+
+    ##################################################################
+    #
+    def observe(self, name, value, **labels):
+        """
+        Add the observation `value` (in seconds) to the histogram `name`.
+        """
+        with self.lock:
+            key = self._key(name, 'histogram', labels)
+            hist = self.values.get(key)
+            if hist is None:
+                hist = self.values[key] = [[0] * len(LATENCY_BUCKETS), 0, 0.0]
+            # Observations bigger than our biggest bucket only show up in
+            # the count (the '+Inf' bucket.)
+            #
+            idx = bisect.bisect_left(LATENCY_BUCKETS, value)
+            if idx < len(LATENCY_BUCKETS):
+                hist[0][idx] += 1
+            hist[1] += 1
+            hist[2] += value
+
+    ##################################################################
+    #
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        A context manager that adds how long its body took to the histogram
+        `name`.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    ##################################################################
+    #
+    def get(self, name, **labels):
+        """
+        Return the value of the counter or gauge `name` (or 0.)
+        """
+        with self.lock:
+            return self.values.get((name, tuple(sorted(labels.iteritems()))),
+                                   0)
+
+    ##################################################################
+    #
+    def render(self):
+        """
+        Return all of our metrics in the Prometheus text format.
+        """
+        def fmt_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (k, v) for k, v in labels)
+
+        lines = []
+        with self.lock:
+            for name in sorted(self.types):
+                kind = self.types[name]
+                lines.append("# TYPE %s %s" % (name, kind))
+                for (n, labels), value in sorted(self.values.iteritems()):
+                    if n != name:
+                        continue
+                    if kind != 'histogram':
+                        lines.append("%s%s %s" % (name, fmt_labels(labels),
+                                                  value))
+                        continue
+                    buckets, count, total = value
+                    cumulative = 0
+                    for le, c in zip(LATENCY_BUCKETS, buckets):
+                        cumulative += c
+                        lines.append("%s_bucket%s %d" % (
+                            name, fmt_labels(labels, [('le', le)]),
+                            cumulative))
+                    lines.append("%s_bucket%s %d" % (
+                        name, fmt_labels(labels, [('le', '+Inf')]), count))
+                    lines.append("%s_sum%s %f" % (name, fmt_labels(labels),
+                                                  total))
+                    lines.append("%s_count%s %d" % (name, fmt_labels(labels),
+                                                    count))
+        return "\n".join(lines) + "\n"
+
+    ##################################################################
+    #
+    def write(self, fname):
+        """
+        Write our metrics, in the Prometheus text format, to `fname`
+        (replacing it atomically so a reader never sees half of it.)
+        """
+        write_file_atomically(StringIO(self.render()), fname)
+
+
+# Where everything in this script records what it has been up to.
+#
+metrics = Metrics()
+
+
+##################################################################
+##################################################################
+#
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves `metrics` in the Prometheus text format on /metrics.
+    """
+
+    ##################################################################
+    #
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    ##################################################################
+    #
+    def log_message(self, format, *args):
+        # Do not log every scrape.
+        #
+        pass
+
+
+####################################################################
+#
+def start_metrics_server(port):
+    """
+    Serve `metrics` on http://localhost:<port>/metrics from a background
+    thread. Returns the server.
+
+    Arguments:
+    - `port`: The port to listen on
+    """
+    server = BaseHTTPServer.HTTPServer(("localhost", port), MetricsHandler)
+    t = threading.Thread(target=server.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+    return server
+
+
+##################################################################
+##################################################################
+#
+class Profiler(object):
+    """
+    With '--profile', runs a sample of our runs under cProfile, a phase at
+    a time, and writes down every call to dropbox and every file write that
+    takes longer than a threshold.
+
+    Each phase of a profiled run is written to
+    '<camera>.<run>.<phase>.pstats' in the profile directory, where <run> is
+    when the run started (so they sort in order.) Only the files of the last
+    few profiled runs of each camera are kept. Look at them with the pstats
+    module (or something like snakeviz.)
+
+    The slow operations go in 'slow.log' in the profile directory, one line
+    each giving when it finished, how long it took, what kind of operation
+    it was, and the file (or dropbox path) it was on.
+
+    NOTE: cProfile only sees the thread it is started in. The work of our
+          download and mutation workers (and of '--pipeline' mode) shows up
+          as the main thread waiting on them. The slow log covers every
+          thread though.
+
+    Until `configure()` is called it does nothing, and costs next to nothing.
+    """
+
+    ##################################################################
+    #
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profile_dir = None
+        self.sample = 0.0
+        self.keep = 0
+        self.slow_threshold = None
+        self.slow_fname = None
+
+        # The camera and run we are profiling right now, if any.
+        #
+        self.current = None
+
+    ##################################################################
+    #
+    def configure(self, profile_dir, sample=1.0, keep=10,
+                  slow_threshold=1.0):
+        """
+        Start profiling.
+
+        Arguments:
+        - `profile_dir`: Where the .pstats files and the slow log go
+        - `sample`: The fraction of runs we profile
+        - `keep`: How many profiled runs of each camera to keep the files of
+        - `slow_threshold`: Operations that take at least this many seconds
+                            go in the slow log. None means keep no slow log.
+        """
+        makedirs(profile_dir)
+        self.profile_dir = profile_dir
+        self.sample = sample
+        self.keep = keep
+        self.slow_threshold = slow_threshold
+        self.slow_fname = os.path.join(profile_dir, "slow.log")
+
+    ##################################################################
+    #
+    @contextmanager
+    def run(self, camera):
+        """
+        A context manager around one run of the camera named `camera`. If
+        this run is one of the ones we sample, the phases in it are
+        profiled (see `phase()`.)
+        """
+        if self.profile_dir is None or random.random() >= self.sample:
+            yield
+            return
+        now = time.time()
+        self.current = (camera, "%s.%03d" % (
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)),
+            int(now * 1000) % 1000))
+        try:
+            yield
+        finally:
+            self.current = None
+            self.rotate(camera)
+
+    ##################################################################
+    #
+    @contextmanager
+    def phase(self, name):
+        """
+        A context manager that profiles its body, as the phase `name` of the
+        run we are profiling (if we are profiling one.)
+        """
+        if self.current is None:
+            yield
+            return
+        camera, run = self.current
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(os.path.join(
+                self.profile_dir, "%s.%s.%s.pstats" % (camera, run, name)))
+
+    ##################################################################
+    #
+    def rotate(self, camera):
+        """
+        Remove the .pstats files of all but the last `keep` profiled runs of
+        `camera`.
+        """
+        prefix = camera + "."
+        runs = {}
+        for fname in os.listdir(self.profile_dir):
+            if fname.startswith(prefix) and fname.endswith(".pstats"):
+                run = fname[len(prefix):-len(".pstats")].rsplit(".", 1)[0]
+                runs.setdefault(run, []).append(fname)
+        for run in sorted(runs)[:-self.keep or None]:
+            for fname in runs[run]:
+                try:
+                    os.unlink(os.path.join(self.profile_dir, fname))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    ##################################################################
+    #
+    def slow(self, kind, seconds, what):
+        """
+        If the operation of kind `kind` on `what` (a file or a dropbox path)
+        took at least our threshold, write it down in the slow log.
+        """
+        if self.slow_threshold is None or seconds < self.slow_threshold:
+            return
+        metrics.inc('webcam_slow_operations_total', kind=kind)
+        line = "%s %9.3fs %-12s %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"),
+                                        seconds, kind, what)
+        with self.lock:
+            with open(self.slow_fname, "a") as f:
+                f.write(line)
+
+
+# What we profile (with '--profile'.)
+#
+profiler = Profiler()
+
+
+####################################################################
+#
+def fname_timestamp(fname, _day_cache={}):
+    """
+    Return the time, in seconds since the epoch, that a file whose name
+    matches DATE_FNAME_re was created.
+
+    This gets called for every file in a folder listing so instead of having
+    arrow parse the name we pull the fields out of it by their fixed offsets
+    (yyyy-mm-ddThh_mm_ss-0000.jpg) and remember the start of each day we have
+    seen so that most calls are just a dictionary lookup and some arithmetic.
+
+    Arguments:
+    - `fname`: The file name
+    """
+    day = fname[:10]
+    try:
+        day_start = _day_cache[day]
+    except KeyError:
+        day_start = calendar.timegm((int(fname[:4]), int(fname[5:7]),
+                                     int(fname[8:10]), 0, 0, 0))
+        _day_cache[day] = day_start
+    return (day_start + int(fname[11:13]) * 3600 + int(fname[14:16]) * 60 +
+            int(fname[17:19]))
+
+
+####################################################################
+#
+def timestamp_fname(ts):
+    """
+    The opposite of fname_timestamp(). Return the file name (matching
+    DATE_FNAME_re) for an image created at `ts` seconds since the epoch.
+
+    Arguments:
+    - `ts`: The time, in seconds since the epoch
+    """
+    return time.strftime("%Y-%m-%dT%H_%M_%S-0000.jpg", time.gmtime(ts))
+
+
+####################################################################
+#
+def renamed_fname(fname):
+    """
+    Given the name of a file as the ninjablock uploads it (matching
+    FNAMES_TO_MATCH_re, ie: 'Sun, 05 May 2013 12:34:56 GMT.jpg') return the
+    sortable date based name we rename it to.
+
+    Like fname_timestamp() we pull the fields out by their fixed offsets.
+
+    Arguments:
+    - `fname`: The file name
+    """
+    ts = calendar.timegm((int(fname[12:16]), MONTHS[fname[8:11]],
+                          int(fname[5:7]), int(fname[17:19]),
+                          int(fname[20:22]), int(fname[23:25])))
+    return timestamp_fname(ts)
+
+
+####################################################################
+#
+def epoch(when):
+    """
+    Return `when` as seconds since the epoch. `when` may be an arrow
+    timestamp or already be seconds since the epoch.
+    """
+    return getattr(when, 'timestamp', when)
+
+
+##################################################################
+##################################################################
+#
+class Listing(object):
+    """
+    A folder listing, parsed once so that renaming, downloading, and deleting
+    do not each have to run regular expressions over and parse the time out
+    of every file name in the folder.
+
+    The files whose names match DATE_FNAME_re are kept sorted by their
+    timestamp, with the timestamps in a compact array (`epochs`) and the
+    names in a parallel list (`names`.) This lets us find all the files newer
+    or older than a given time with a binary search.
+
+    The files that match FNAMES_TO_MATCH_re are kept in `to_rename` as a
+    list of (current name, new name) tuples.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, files, meta=None):
+        """
+        Arguments:
+        - `files`: The names of the files in the folder.
+        - `meta`: A dict of the (size, rev) dropbox gave us for each file, if
+                  we have it.
+        """
+        self.meta = {} if meta is None else meta
+        self.to_rename = []
+        dated = []
+        for fname in files:
+            # We want to force the file names to be strings (not unicode) for
+            # safety of other manipulations.
+            #
+            fname = str(fname)
+            if DATE_FNAME_re.match(fname) is not None:
+                dated.append((fname_timestamp(fname), fname))
+            elif FNAMES_TO_MATCH_re.match(fname) is not None:
+                self.to_rename.append((fname, renamed_fname(fname)))
+        dated.sort()
+        self.epochs = array('l', (ts for ts, fname in dated))
+        self.names = [fname for ts, fname in dated]
+
+    ##################################################################
+    #
+    def __len__(self):
+        return len(self.names)
+
+    ##################################################################
+    #
+    def size(self, fname):
+        """
+        Return the size dropbox says the file `fname` is, or None if we do
+        not know.
+        """
+        return self.meta.get(fname, (None, None))[0]
+
+    ##################################################################
+    #
+    def rev(self, fname):
+        """
+        Return the revision dropbox says the file `fname` is at, or None if
+        we do not know.
+        """
+        return self.meta.get(fname, (None, None))[1]
+
+    ##################################################################
+    #
+    def newer_than(self, when):
+        """
+        Return the names of the date named files created after `when`, oldest
+        first.
+
+        Arguments:
+        - `when`: seconds since the epoch (or an arrow timestamp)
+        """
+        return self.names[bisect.bisect_right(self.epochs, epoch(when)):]
+
+    ##################################################################
+    #
+    def not_newer_than(self, when):
+        """
+        Return the names of the date named files created at or before
+        `when`, oldest first.
+
+        Arguments:
+        - `when`: seconds since the epoch (or an arrow timestamp)
+        """
+        return self.names[:bisect.bisect_right(self.epochs, epoch(when))]
+
+    ##################################################################
+    #
+    def between(self, start, end):
+        """
+        Return the names of the date named files created from `start` to
+        `end` (inclusive), oldest first.
+
+        Arguments:
+        - `start`: seconds since the epoch (or an arrow timestamp)
+        - `end`: seconds since the epoch (or an arrow timestamp)
+        """
+        return self.names[bisect.bisect_left(self.epochs, epoch(start)):
+                          bisect.bisect_right(self.epochs, epoch(end))]
+
+    ##################################################################
+    #
+    def apply_renames(self, renames):
+        """
+        Update the listing to match what the folder looks like after the
+        renames in `renames` (a RenameResult) were done, without having to
+        ask dropbox for the listing again.
+
+        Files that were renamed move to their new, date based, names. Files
+        that were deleted before we could rename them are dropped.
+
+        Arguments:
+        - `renames`: A RenameResult
+        """
+        done = set(renames.missing)
+        done.update(fname for fname, new_fname in renames.renamed)
+        self.to_rename = [(fname, new_fname)
+                          for fname, new_fname in self.to_rename
+                          if fname not in done]
+
+        # A renamed file is the same size but we do not know its new rev.
+        #
+        for fname, new_fname in renames.renamed:
+            if fname in self.meta:
+                self.meta[new_fname] = (self.meta.pop(fname)[0], None)
+
+        have = set(self.names)
+        new_names = [new_fname for fname, new_fname in renames.renamed
+                     if new_fname not in have]
+        if not new_names:
+            return
+        dated = zip(self.epochs, self.names)
+        dated.extend((fname_timestamp(fname), fname) for fname in new_names)
+        dated.sort()
+        self.epochs = array('l', (ts for ts, fname in dated))
+        self.names = [fname for ts, fname in dated]
+
+    ##################################################################
+    #
+    def apply_changes(self, changes):
+        """
+        Update the listing with the files that were added to and removed
+        from the folder (as a FolderView tells us), instead of parsing and
+        sorting the whole folder all over again.
+
+        Each change is a tuple of a file name and its (size, rev), or None if
+        the file was removed. Applying a change we already know about (like a
+        rename we did ourselves and applied with apply_renames()) does
+        nothing.
+
+        Arguments:
+        - `changes`: A list of (file name, (size, rev) or None) tuples
+        """
+        for fname, entry in changes:
+            fname = str(fname)
+            lower = fname.lower()
+            if DATE_FNAME_NOCASE_re.match(fname) is not None:
+                ts = fname_timestamp(fname)
+                start = bisect.bisect_left(self.epochs, ts)
+                end = bisect.bisect_right(self.epochs, ts)
+                for i in xrange(end - 1, start - 1, -1):
+                    if self.names[i].lower() == lower:
+                        self.meta.pop(self.names[i], None)
+                        del self.epochs[i]
+                        del self.names[i]
+                        end -= 1
+                if entry is not None:
+                    self.epochs.insert(end, ts)
+                    self.names.insert(end, fname)
+                    self.meta[fname] = tuple(entry)
+            elif FNAMES_TO_MATCH_re.match(fname) is not None:
+                keep = []
+                for name, new_fname in self.to_rename:
+                    if name.lower() == lower:
+                        self.meta.pop(name, None)
+                    else:
+                        keep.append((name, new_fname))
+                self.to_rename = keep
+                if entry is not None:
+                    self.to_rename.append((fname, renamed_fname(fname)))
+                    self.meta[fname] = tuple(entry)
+
+
+##################################################################
+##################################################################
+#
+class RenameResult(object):
+    """
+    What rename_dropbox_files() did: the files it renamed, as a list of
+    (old name, new name) tuples in `renamed`, and the files that were deleted
+    before it could rename them in `missing`.
+    """
+
+    ##################################################################
+    #
+    def __init__(self):
+        self.renamed = []
+        self.missing = []
+
+    ##################################################################
+    #
+    def __len__(self):
+        return len(self.renamed) + len(self.missing)
+
 
 ####################################################################
 #
@@ -133,283 +1004,4726 @@ def do_oauth_setup(sess, callback_url=None):
 
 ####################################################################
 #
-def find_latest_downloaded_file(data_dirname):
+def downloaded_files(data_dirname):
     """
-    Given the name of the data directory find the name of the last downloaded
-    file.
+    A generator that walks the data directory and yields the name of every
+    downloaded image file in it.
 
-    We assume that the files have same naming convention:
+    We only look at files that follow our naming convention:
 
     <DATA DIR>/<yyyy>/<yyyy-mm-dd>/<DATE_FNAME_re>
 
-    Instead of using a directory walk all we need to do is find the latest year
-    directory, and then the latest date directory within that year and then the
-    latest date-time based file in that directory.
-
-    If we can find no latest file we return (None, None, None)
+    and the files packed in to <DATA DIR>/<yyyy>/<yyyy-mm-dd>.pack files.
 
     Arguments:
     - `data_dirname`: The data directory we are going to search for year
                       directories in.
     """
-    year_dirs = glob.glob(os.path.join(data_dirname, "[0-9][0-9][0-9][0-9]"))
-    if len(year_dirs) == 0:
-        print "No year directories... "
-        return None, None, None
+    for year_dir in glob.glob(os.path.join(data_dirname,
+                                           "[0-9][0-9][0-9][0-9]")):
+        # Days we have packed (see compact_days().)
+        #
+        for pack_fname in glob.glob(
+                os.path.join(year_dir, "[0-9][0-9][0-9][0-9]-[0-9][0-9]-"
+                             "[0-9][0-9].pack")):
+            pack = PackFile(pack_fname)
+            try:
+                for fname in pack.names:
+                    yield fname
+            finally:
+                pack.close()
+        for date_dir in glob.glob(
+                os.path.join(year_dir,
+                             "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]")):
+            for fname in os.listdir(date_dir):
+                if DATE_FNAME_re.search(fname) is not None:
+                    yield fname
+    return
 
-    # Go backwards from the most recent year directory we find..
-    #
-    year_dirs.sort(reverse=True)
 
-    for year_dir in year_dirs:
+##################################################################
+##################################################################
+#
+class PackFile(object):
+    """
+    Read the frames in a pack file without unpacking it.
 
-        date_dirs = glob.glob(
-            os.path.join(year_dir,
-                         "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]")
-        )
+    Once a day is over we pack all of its frames in to one file (see
+    compact_days()), so that we do not end up with millions of little files
+    for backups and rsync to wade through. A pack file is the frames, one
+    after the other, followed by an index of them and a trailer:
 
-        date_dirs.sort(reverse=True)
+        <frame> <frame> ... <index entry> <index entry> ... <trailer>
 
-        if len(date_dirs) == 0:
-            # This year has no date dirs.. goto the next (earlier) year dir
-            #
-            continue
+    Each index entry (PACK_ENTRY) is a frame's name, its offset in the file,
+    and its size. The trailer (PACK_TRAILER) is PACK_MAGIC, the offset of the
+    index, and the number of entries in it.
 
-        # Go backwards through the date directories in this year dir
-        # looking for one that has at least one data file in it.
-        #
-        date_dirs.sort(reverse=True)
+    The file is mmap'd so reading a frame is just a slice of it.
+    """
 
-        for date_dir in date_dirs:
+    ##################################################################
+    #
+    def __init__(self, pack_fname):
+        """
+        Arguments:
+        - `pack_fname`: The pack file to read
+        """
+        self.pack_fname = pack_fname
+        self.frames = {}
+        self.names = []
+        with open(pack_fname, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < PACK_TRAILER.size:
+                raise ValueError("'%s' is not a pack file" % pack_fname)
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, count = PACK_TRAILER.unpack_from(
+            self.mm, size - PACK_TRAILER.size)
+        if (magic != PACK_MAGIC or
+                index_offset + count * PACK_ENTRY.size !=
+                size - PACK_TRAILER.size):
+            self.mm.close()
+            raise ValueError("'%s' is not a pack file" % pack_fname)
+        for i in range(count):
+            fname, offset, length = PACK_ENTRY.unpack_from(
+                self.mm, index_offset + i * PACK_ENTRY.size)
+            self.frames[fname] = (offset, length)
+            self.names.append(fname)
 
-            # If this date dir has no data files goto to the next (earlier)
-            # date dir
-            #
-            latest = glob.glob(os.path.join(date_dir, "*.jpg"))
-            if len(latest) == 0:
-                continue
+    ##################################################################
+    #
+    def __contains__(self, fname):
+        return fname in self.frames
 
-            # However if this date dir has at least one data file in
-            # it.. that data file is the latest one that has been
-            # downloaded.
-            #
-            return (os.path.basename(latest[-1]), os.path.basename(date_dir),
-                    os.path.basename(year_dir))
+    ##################################################################
+    #
+    def __len__(self):
+        return len(self.names)
+
+    ##################################################################
+    #
+    def read(self, fname):
+        """
+        Return the contents of the frame `fname`, or None if it is not in
+        this pack.
+        """
+        if fname not in self.frames:
+            return None
+        offset, length = self.frames[fname]
+        return self.mm[offset:offset + length]
+
+    ##################################################################
+    #
+    def frame_at(self, when):
+        """
+        Return the contents of the frame taken at `when` (an arrow timestamp
+        or seconds since the epoch), or None if it is not in this pack.
+        """
+        return self.read(timestamp_fname(epoch(when)))
 
-    # There are no downloaded data files..
+    ##################################################################
     #
-    return None, None, None
+    def close(self):
+        self.mm.close()
 
 
 ####################################################################
 #
-def get_dropbox_dir(client, db_folder):
+def pack_path(data_dirname, day):
     """
-    Get the contents of a dropbox folder and its current hash.
+    Return the pack file the frames from `day` (as 'yyyy-mm-dd') are packed
+    in to.
+    """
+    return os.path.join(data_dirname, day[:4], "%s.pack" % day)
 
-    We only care about the file names in the folder and its current hash so we
-    do not deal with the other metadata.
 
-    XXX Since we are dealing with just images maybe we should restrict the list
-        of files we return to ones that are images?
+####################################################################
+#
+def read_frame(data_dirname, fname):
+    """
+    Return the contents of the downloaded frame `fname`, whether it is still
+    a file of its own or has been packed, or None if we do not have it.
 
     Arguments:
-    - `client`: A dropbox client
-    - `db_folder`: The folder we want the contents of
+    - `data_dirname`: The data directory we download files in to.
+    - `fname`: The file name. It must match DATE_FNAME_re.
     """
-    folder_metadata = client.metadata(db_folder)
-    files = []
-    for f in folder_metadata['contents']:
+    try:
+        with open(download_path(data_dirname, fname), "rb") as f:
+            return f.read()
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    pack_fname = pack_path(data_dirname, fname[:10])
+    if not os.path.exists(pack_fname):
+        return None
+    pack = PackFile(pack_fname)
+    try:
+        return pack.read(fname)
+    finally:
+        pack.close()
 
-        # Skip over directories
-        #
-        if f['is_dir']:
-            continue
 
-        files.append(os.path.basename(f['path']))
+####################################################################
+#
+def local_frame_size(data_dirname, fname, _pack_sizes={}):
+    """
+    Return the size of our copy of the frame `fname`, whether it is still a
+    file of its own or has been packed, or None if we do not have it.
+
+    We remember the sizes of the frames in the last pack we looked in, since
+    we are usually asked about a day's frames one after another.
 
-    return folder_metadata['hash'], files
+    Arguments:
+    - `data_dirname`: The data directory we download files in to.
+    - `fname`: The file name. It must match DATE_FNAME_re.
+    """
+    try:
+        return os.stat(download_path(data_dirname, fname)).st_size
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    pack_fname = pack_path(data_dirname, fname[:10])
+    try:
+        mtime = os.stat(pack_fname).st_mtime
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    if _pack_sizes.get('key') != (pack_fname, mtime):
+        pack = PackFile(pack_fname)
+        _pack_sizes['key'] = (pack_fname, mtime)
+        _pack_sizes['sizes'] = dict((name, length) for name, (offset, length)
+                                    in pack.frames.iteritems())
+        pack.close()
+    return _pack_sizes['sizes'].get(fname)
 
 
 ####################################################################
 #
-def rename_dropbox_files(client, db_folder, files, dry_run):
+def have_frame(data_dirname, files, fname):
     """
-    Go through the files that are in the given dropbox folder, as passed in
-    via the 'files' list. Filter out all the files that do not match our
-    regular expression for the files we are going to rename, and then rename
-    them in to sortable date based file names (the date we derive from their
-    existing file name.)
+    Return True if we already have an identical copy of the frame `fname`
+    (one the same size as the one in the dropbox folder), even though it is
+    not in our index (because the index was reset, or the download directory
+    was restored from a backup.)
 
     Arguments:
-    - `client`: The dropbox client
-    - `db_folder`: The dropbox folder we are operating in
-    - `files`: The list of files from that dropbox folder
+    - `data_dirname`: The data directory we download files in to.
+    - `files`: The Listing the frame is in
+    - `fname`: The file name. It must match DATE_FNAME_re.
     """
-    for fname in files:
-        match = FNAMES_TO_MATCH_re.search(fname)
-
-        # Skip over this loop if this file does not match our pattern.
-        #
-        if match is None:
-            continue
+    size = files.size(fname)
+    return size is not None and local_frame_size(data_dirname, fname) == size
 
-        # The file name actually is alreay date based.. but it is just not
-        # easily sortable so we want to convert it to a yyyy.mm.dd-hh:mm:ss
-        # format for that reason.
-        #
-        d = arrow.get(str(fname[5:-4]), "DD MMM YYYY HH:mm:ss")
-        new_fname = "%s.jpg" % d.format(arrow_timestamp_fmt)
-        print "Renaming '%s' to '%s'" % (fname, new_fname)
 
-        # If we are doing a dry-run skip to the next file here..
-        #
-        if dry_run:
-            continue
+####################################################################
+#
+def write_pack(pack_fname, frames, fsync=False):
+    """
+    Write the pack file `pack_fname` (see PackFile.) It is written to a
+    temporary file and renamed in to place, so if we die part way through
+    any pack that was already there is left as it was.
 
+    Arguments:
+    - `pack_fname`: The pack file to write
+    - `frames`: The name and contents of each frame to put in it, in order
+    - `fsync`: If True, fsync the pack before renaming it in to place.
+    """
+    fd, tmp_fname = tempfile.mkstemp(
+        dir=os.path.dirname(pack_fname),
+        prefix=".%s." % os.path.basename(pack_fname), suffix=".part")
+    try:
+        os.fchmod(fd, 0666 & ~UMASK)
+        out = os.fdopen(fd, 'wb')
         try:
-            client.file_move(os.path.join(db_folder, fname),
-                             os.path.join(db_folder, new_fname))
-        except dropbox.rest.ErrorResponse, e:
-            # It is okay if this file does not exist (means that it
-            # was deleted before we could get to copying it..)
-            #
-            if e.status != 404:
-                raise e
-            else:
-                print "File '%s' was deleted before we could rename it" % \
-                    fname
-    return
+            index = []
+            offset = 0
+            for fname, data in frames:
+                out.write(data)
+                index.append(PACK_ENTRY.pack(fname, offset, len(data)))
+                offset += len(data)
+            out.write("".join(index))
+            out.write(PACK_TRAILER.pack(PACK_MAGIC, offset, len(index)))
+            out.flush()
+            if fsync:
+                os.fsync(out.fileno())
+        finally:
+            out.close()
+        os.rename(tmp_fname, pack_fname)
+    except:
+        if os.path.exists(tmp_fname):
+            os.unlink(tmp_fname)
+        raise
 
 
 ####################################################################
 #
-def download_new_files(client, db_folder, dest_dir, files, when, dry_run):
+def pack_day(data_dirname, day, fsync=False):
     """
-    Download all of the files in the db_folder that are newer than 'when' that
-    match our download pattern.
+    Pack the frames downloaded on `day` in to its pack file and remove them
+    (and the day's directory.)
+
+    If the day already has a pack file (because some frames showed up after
+    we packed it) we write a new pack with the frames from both. The new pack
+    is written to a temporary file and renamed in to place, and the frames are
+    only removed after that, so if we die part way through nothing is lost.
+
+    Returns the number of frames we packed.
 
     Arguments:
-    - `client`: Dropbox client
-    - `db_folder`: Dropbox folder we are downloading from
-    - `dest_dir`: The root destination directory to copy the files in to. The
-                  sub-directory for the year, month, and day will be created
-                  as necessary.
-    - `files`: Use this list of files to decide what to download
-    - `when`: An arrow timestamp. Download all files that were created after
-              this timestamp.
-    - `dry_run`: a boolean. If true then no actual actions are performed
+    - `data_dirname`: The data directory we download files in to.
+    - `day`: The day as 'yyyy-mm-dd'
+    - `fsync`: If True, fsync the pack before renaming it in to place.
     """
+    day_dirname = os.path.join(data_dirname, day[:4], day)
+    loose = set(fname for fname in os.listdir(day_dirname)
+                if DATE_FNAME_re.match(fname) is not None)
+    if not loose:
+        return 0
+    pack_fname = pack_path(data_dirname, day)
+    old = PackFile(pack_fname) if os.path.exists(pack_fname) else None
 
-    # Going through the list of files only download ones that are after 'when'
-    # and conform to our file name pattern.
-    #
-    for fname in files:
-        # only download files that match our timestamp format. We want to force
-        # the file names to be strings (not unicode) for safety of other
-        # manipulations.
+    try:
+        names = set(loose)
+        if old is not None:
+            names.update(old.names)
+
+        def frames():
+            for fname in sorted(names):
+                if fname in loose:
+                    with open(os.path.join(day_dirname, fname), "rb") as f:
+                        yield fname, f.read()
+                else:
+                    yield fname, old.read(fname)
+        write_pack(pack_fname, frames(), fsync)
+    finally:
+        if old is not None:
+            old.close()
+
+    for fname in loose:
+        os.unlink(os.path.join(day_dirname, fname))
+    try:
+        os.rmdir(day_dirname)
+    except OSError, e:
+        # Something else is in there. Leave it be.
+        #
+        if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+            raise
+    return len(loose)
+
+
+####################################################################
+#
+def compact_days(data_dirname, keep_loose_days=1, fsync=False):
+    """
+    Pack every day directory in the data directory older than the last
+    `keep_loose_days` days (in UTC, like our file names) in to its pack file.
+
+    Returns a tuple of the number of days and the number of frames packed.
+
+    Arguments:
+    - `data_dirname`: The data directory we download files in to.
+    - `keep_loose_days`: How many of the most recent days to leave alone.
+                         1 means just today.
+    - `fsync`: If True, fsync each pack before renaming it in to place.
+    """
+    cutoff = time.strftime("%Y-%m-%d", time.gmtime(
+        time.time() - (keep_loose_days - 1) * 24 * 60 * 60))
+    days = 0
+    frames = 0
+    for day_dirname in sorted(glob.glob(os.path.join(
+            data_dirname, "[0-9][0-9][0-9][0-9]",
+            "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"))):
+        day = os.path.basename(day_dirname)
+        if day >= cutoff or not os.path.isdir(day_dirname):
+            continue
+        packed = pack_day(data_dirname, day, fsync)
+        print "** Packed %d frames from %s in to '%s'" % \
+            (packed, day, pack_path(data_dirname, day))
+        days += 1
+        frames += packed
+    return days, frames
+
+
+##################################################################
+##################################################################
+#
+class RetentionPolicy(object):
+    """
+    How we keep the frames we have downloaded as they get older, so that the
+    download directory does not grow without limit.
+
+    A policy is a comma separated list of tiers. Each is the age in days at
+    which it starts and then, separated by colons, what happens to frames
+    from then on:
+
+    quality=<n>   Recompress them as JPEGs of this quality (1-95)
+    scale=<f>     Scale them down to this fraction of their original size
+    every=<m>     Only keep one frame every this many minutes
+    delete        Delete them
+
+    For example "7:quality=70:scale=0.5,90:every=10,365:delete" keeps frames
+    as they are for a week, then at half size and quality 70, from 90 days
+    on just one every ten minutes, and deletes them after a year. Each tier
+    keeps the settings of the ones before it that it does not change.
+
+    We apply a policy to a day of frames at a time. A day's age is how long
+    ago it ended (in UTC, like our file names.)
+    """
+
+    # The settings of frames we have not touched.
+    #
+    ORIGINAL = {'quality': None, 'scale': 1.0, 'every': 0}
+
+    # The quality we recompress at if a tier scales frames down without
+    # saying what quality to use.
+    #
+    DEFAULT_QUALITY = 85
+
+    ##################################################################
+    #
+    def __init__(self, spec):
+        """
+        Arguments:
+        - `spec`: The policy, as described above. Raises ValueError if it
+                  does not make sense.
+        """
+        self.spec = spec
+        self.tiers = []
+        for part in spec.split(","):
+            fields = part.strip().split(":")
+            try:
+                tier = {'days': int(fields[0])}
+                for setting in fields[1:]:
+                    name, _, value = setting.partition("=")
+                    if name == "quality" and 1 <= int(value) <= 95:
+                        tier['quality'] = int(value)
+                    elif name == "scale" and 0 < float(value) <= 1:
+                        tier['scale'] = float(value)
+                    elif name == "every" and int(value) > 0:
+                        tier['every'] = int(value) * 60
+                    elif name == "delete" and not value:
+                        tier['delete'] = True
+                    else:
+                        raise ValueError(setting)
+            except ValueError:
+                raise ValueError("Bad retention tier '%s' in '%s'" %
+                                 (part, spec))
+            if self.tiers and tier['days'] <= self.tiers[-1]['days']:
+                raise ValueError("Retention tiers must get older: '%s'" %
+                                 spec)
+            self.tiers.append(tier)
+
+    ##################################################################
+    #
+    def recompresses(self):
+        """
+        Return True if this policy ever recompresses frames (which needs
+        PIL.)
+        """
+        return any('quality' in tier or 'scale' in tier
+                   for tier in self.tiers)
+
+    ##################################################################
+    #
+    def settings(self, day, now):
+        """
+        Return how the frames from `day` (as 'yyyy-mm-dd') should be kept at
+        the time `now`: a dict of the 'quality' and 'scale' to keep them at
+        (a quality of None means as they were downloaded), to keep a frame
+        'every' so many seconds (0 means all of them), and whether to
+        'delete' them.
+        """
+        end = calendar.timegm(time.strptime(day, "%Y-%m-%d")) + 24 * 60 * 60
+        age = (now - end) / (24 * 60 * 60.0)
+        settings = dict(self.ORIGINAL, delete=False)
+        for tier in self.tiers:
+            if tier['days'] > age:
+                break
+            for name in ('quality', 'scale', 'every', 'delete'):
+                if name in tier:
+                    settings[name] = tier[name]
+        if settings['scale'] != 1.0 and settings['quality'] is None:
+            settings['quality'] = self.DEFAULT_QUALITY
+        return settings
+
+
+####################################################################
+#
+def recompress_frame(data, factor, quality):
+    """
+    Return the JPEG `data` scaled by `factor` and recompressed at `quality`,
+    or `data` itself if that does not make it any smaller (or we can not
+    decode it.)
+
+    This is run in a Retainer's worker processes.
+    """
+    import_image_modules()
+    try:
+        img = Image.open(StringIO(data))
+        if factor < 1:
+            size = (max(1, int(img.size[0] * factor)),
+                    max(1, int(img.size[1] * factor)))
+            img.draft(img.mode, size)
+            img = img.resize(size, Image.ANTIALIAS)
+        out = StringIO()
+        img.save(out, "JPEG", quality=quality, optimize=True)
+    except (IOError, ValueError):
+        return data
+    result = out.getvalue()
+    return result if len(result) < len(data) else data
+
+
+####################################################################
+#
+def stored_days(data_dirname):
+    """
+    Return the days (as 'yyyy-mm-dd') we have frames from, in a day
+    directory or a pack file, oldest first.
+
+    Arguments:
+    - `data_dirname`: The data directory we download files in to.
+    """
+    days = set()
+    for year_dir in glob.glob(os.path.join(data_dirname,
+                                           "[0-9][0-9][0-9][0-9]")):
+        for entry in os.listdir(year_dir):
+            if entry.endswith(".pack") and DAY_re.match(entry[:-5]):
+                days.add(entry[:-5])
+            elif (DAY_re.match(entry) is not None and
+                  os.path.isdir(os.path.join(year_dir, entry))):
+                days.add(entry)
+    return sorted(days)
+
+
+####################################################################
+#
+def retain_day(data_dirname, day, current, target, pool=None, fsync=False):
+    """
+    Change how the frames from `day` are kept from `current` to `target`
+    (see RetentionPolicy.settings().)
+
+    The frames that are still files of their own (ones we downloaded since
+    the day was last retained, or that were never packed) are as we
+    downloaded them. The ones in the day's pack file are kept as `current`
+    says. We write the frames we keep, recompressed if need be, to a new
+    pack file for the day and then remove the loose ones, so if we die part
+    way through the day is left as it was.
+
+    Returns a tuple of the number of frames we kept, the number we removed,
+    and how many bytes the day took up before and after.
+
+    Arguments:
+    - `data_dirname`: The data directory we download files in to.
+    - `day`: The day as 'yyyy-mm-dd'
+    - `current`: How the frames in the day's pack file are kept
+    - `target`: How the day's frames should be kept
+    - `pool`: A multiprocessing.Pool to recompress frames in. If None we
+              recompress them ourselves.
+    - `fsync`: If True, fsync the new pack before renaming it in to place.
+    """
+    day_dirname = os.path.join(data_dirname, day[:4], day)
+    pack_fname = pack_path(data_dirname, day)
+    loose = set()
+    if os.path.isdir(day_dirname):
+        loose = set(fname for fname in os.listdir(day_dirname)
+                    if DATE_FNAME_re.match(fname) is not None)
+    old = PackFile(pack_fname) if os.path.exists(pack_fname) else None
+
+    try:
+        before = sum(os.path.getsize(os.path.join(day_dirname, fname))
+                     for fname in loose)
+        names = set(loose)
+        if old is not None:
+            before += os.path.getsize(pack_fname)
+            names.update(old.names)
+        names = sorted(names)
+        count = len(names)
+
+        # Keep the first frame in each 'every' seconds (or none at all.)
+        #
+        if target['delete']:
+            names = []
+        elif target['every']:
+            kept = []
+            last = None
+            for fname in names:
+                bucket = fname_timestamp(fname) // target['every']
+                if bucket != last:
+                    kept.append(fname)
+                    last = bucket
+            names = kept
+
+        def frames():
+            for i in range(0, len(names), RETENTION_BATCH):
+                batch = names[i:i + RETENTION_BATCH]
+                datas = []
+                jobs = []
+                for fname in batch:
+                    if fname in loose:
+                        with open(os.path.join(day_dirname, fname), "rb") as f:
+                            data = f.read()
+                        was = RetentionPolicy.ORIGINAL
+                    else:
+                        data = old.read(fname)
+                        was = current
+                    if ((target['quality'], target['scale']) !=
+                            (was['quality'], was['scale'])):
+                        jobs.append((len(datas), (
+                            data, target['scale'] / was['scale'],
+                            target['quality'])))
+                    datas.append(data)
+                if pool is not None:
+                    results = [pool.apply_async(recompress_frame, args)
+                               for n, args in jobs]
+                    results = [result.get() for result in results]
+                else:
+                    results = [recompress_frame(*args) for n, args in jobs]
+                for (n, args), data in zip(jobs, results):
+                    datas[n] = data
+                for fname, data in zip(batch, datas):
+                    yield fname, data
+
+        after = 0
+        if names:
+            write_pack(pack_fname, frames(), fsync)
+            after = os.path.getsize(pack_fname)
+        elif old is not None:
+            os.unlink(pack_fname)
+    finally:
+        if old is not None:
+            old.close()
+
+    for fname in loose:
+        os.unlink(os.path.join(day_dirname, fname))
+    if loose or os.path.isdir(day_dirname):
+        try:
+            os.rmdir(day_dirname)
+        except OSError, e:
+            # Something else is in there. Leave it be.
+            #
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+    return len(names), count - len(names), before, after
+
+
+##################################################################
+##################################################################
+#
+class DayLock(object):
+    """
+    A lock held while a day of images is being rewritten (see
+    compact_days() and retain_day()), so only one thing changes a day at
+    once: not just in this process but also in any other copy of us
+    working on the same download directory (like one run from cron while
+    the last one is still going), by holding an flock() on `lock_fname`.
+
+    Use it as a context manager.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, lock_fname):
+        """
+        Arguments:
+        - `lock_fname`: The file we flock(). It is created if need be.
+        """
+        self.lock_fname = lock_fname
+        self.lock = threading.Lock()
+        self.f = None
+
+    ##################################################################
+    #
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.f = open(self.lock_fname, "ab")
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        except:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+            self.lock.release()
+            raise
+        return self
+
+    ##################################################################
+    #
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+            self.f.close()
+        finally:
+            self.f = None
+            self.lock.release()
+
+
+##################################################################
+##################################################################
+#
+class Retainer(object):
+    """
+    Applies a RetentionPolicy to a download directory, in a background
+    thread, recompressing frames in a pool of low priority processes.
+
+    What we have done to each day is kept in `progress_fname`, so when we
+    are stopped part way through we carry on where we left off, and we
+    never recompress frames that have already been recompressed for the
+    tier they are in. Only days that have changed tiers (or that have new
+    loose frames in them) are looked at again. We read it again each time we
+    take `lock` in case another process did the day while we waited.
+
+    `finished` is True once we have been through every day without being
+    stopped.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, name, data_dirname, policy, progress_fname, workers=1,
+                 lock=None, fsync=False):
+        """
+        Arguments:
+        - `name`: The camera we are doing this for (for our metrics)
+        - `data_dirname`: The data directory we download files in to.
+        - `policy`: The RetentionPolicy
+        - `progress_fname`: Where we keep how each day is kept
+        - `workers`: How many processes recompress frames
+        - `lock`: A lock (like a DayLock) we hold while we change a day, so
+                  nothing else (like compact_days()) changes it at the same
+                  time
+        - `fsync`: If True, fsync each pack before renaming it in to place.
+        """
+        self.name = name
+        self.data_dirname = data_dirname
+        self.policy = policy
+        self.progress_fname = progress_fname
+        self.workers = workers
+        self.lock = lock or threading.Lock()
+        self.fsync = fsync
+        self.thread = None
+        self.stopping = threading.Event()
+        self.finished = False
+
+        # How the frames in each day's pack file are kept (see
+        # RetentionPolicy.settings()), by day.
+        #
+        self.progress = {}
+        self.load()
+
+    ##################################################################
+    #
+    def load(self):
+        if os.path.exists(self.progress_fname):
+            with open(self.progress_fname, "rb") as f:
+                self.progress = json.load(f)
+
+    ##################################################################
+    #
+    def save(self):
+        write_file_atomically(StringIO(json.dumps(self.progress)),
+                              self.progress_fname, self.fsync)
+
+    ##################################################################
+    #
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    ##################################################################
+    #
+    def start(self, stop=None):
+        """
+        Start going through the download directory in a background thread,
+        unless we already are.
+
+        Arguments:
+        - `stop`: A threading.Event that is set when we should stop
+        """
+        if self.running():
+            return
+        self.stopping.clear()
+        self.finished = False
+        self.thread = threading.Thread(target=self.run, args=(stop,),
+                                       name="retention %s" % self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    ##################################################################
+    #
+    def join(self, stop=True):
+        """
+        Wait for the background thread to finish. Unless `stop` is False we
+        first tell it to stop after the day it is working on (it can take
+        hours to get through all of them.)
+
+        Returns False if we were stopped before we got through every day.
+        """
+        if stop:
+            self.stopping.set()
+        if self.thread is None:
+            return True
+        self.thread.join()
+        return self.finished
+
+    ##################################################################
+    #
+    def run(self, stop=None):
+        """
+        Go through each day we have frames from, oldest first, bringing it
+        in to line with our policy.
+
+        Arguments:
+        - `stop`: A threading.Event that is set when we should stop
+        """
+        now = time.time()
+        with self.lock:
+            days = stored_days(self.data_dirname)
+            self.load()
+            gone = set(self.progress) - set(days)
+            for day in gone:
+                del self.progress[day]
+            if gone:
+                self.save()
+
+        pool = None
+        try:
+            for day in days:
+                if self.stopping.is_set() or (stop is not None and
+                                              stop.is_set()):
+                    return
+                target = self.policy.settings(day, now)
+                keep = dict((name, target[name])
+                            for name in RetentionPolicy.ORIGINAL)
+                if keep == RetentionPolicy.ORIGINAL and not target['delete']:
+                    # Newer days will not have reached a tier either.
+                    #
+                    break
+
+                with self.lock:
+                    self.load()
+                    current = self.progress.get(day,
+                                                RetentionPolicy.ORIGINAL)
+
+                    # If the policy has been loosened since we last did this
+                    # day we can not get back what we threw away, so we leave
+                    # it as it is.
+                    #
+                    if current['quality'] is not None:
+                        keep['quality'] = min(keep['quality'] or 100,
+                                              current['quality'])
+                    keep['scale'] = min(keep['scale'], current['scale'])
+                    keep['every'] = max(keep['every'], current['every'])
+                    target.update(keep)
+
+                    loose = os.path.isdir(os.path.join(self.data_dirname,
+                                                       day[:4], day))
+                    if current == keep and not loose and \
+                            not target['delete']:
+                        continue
+
+                    if pool is None and target['quality'] is not None:
+                        pool = multiprocessing.Pool(self.workers, os.nice,
+                                                    (RETENTION_NICENESS,))
+                    kept, removed, before, after = retain_day(
+                        self.data_dirname, day, current, target, pool,
+                        self.fsync)
+                    if target['delete']:
+                        self.progress.pop(day, None)
+                    else:
+                        self.progress[day] = keep
+                    self.save()
+
+                print "** Retention: kept %d and removed %d frames from %s, " \
+                    "%d bytes down to %d" % (kept, removed, day, before,
+                                             after)
+                metrics.inc('webcam_retention_days_total', camera=self.name)
+                metrics.inc('webcam_retention_frames_removed_total', removed,
+                            camera=self.name)
+                metrics.inc('webcam_retention_bytes_freed_total',
+                            before - after, camera=self.name)
+            self.finished = True
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+
+##################################################################
+##################################################################
+#
+class DownloadIndex(object):
+    """
+    A persistent index of the image files we have downloaded. It lives in an
+    sqlite database (by default in the download directory.)
+
+    This lets us answer "what is the latest file we downloaded?" and "have we
+    downloaded this file?" without walking the download directory, which gets
+    slower and slower as it fills up with images.
+
+    We also keep the size and rev dropbox gave for each file, when we know
+    them.
+
+    NOTE: The index is only updated from the main thread. sqlite connections
+          can not be shared between threads, so other threads that want to
+          look things up open their own (with `read_only`.)
+    """
+
+    # How many files we add to the index before committing.
+    #
+    COMMIT_EVERY = 100
+
+    ##################################################################
+    #
+    def __init__(self, index_fname, read_only=False):
+        """
+        Open (creating if necessary) the index.
+
+        Arguments:
+        - `index_fname`: The file the sqlite database is in.
+        - `read_only`: If True we only look things up in an index that
+                       already exists (from a thread other than the one
+                       adding to it, like the frame server's.)
+        """
+        self.index_fname = index_fname
+        self.is_new = not os.path.exists(index_fname)
+        self.db = sqlite3.connect(index_fname)
+        self.uncommitted = 0
+        self.on_commit = []
+        if read_only:
+            return
+        self.db.execute("CREATE TABLE IF NOT EXISTS frames ("
+                        "name TEXT PRIMARY KEY, ts INTEGER NOT NULL, "
+                        "size INTEGER, rev TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS frames_ts ON frames (ts)")
+
+        # Indexes made before we kept sizes and revs need the columns added.
+        #
+        columns = [row[1] for row in
+                   self.db.execute("PRAGMA table_info(frames)")]
+        for column, kind in (("size", "INTEGER"), ("rev", "TEXT")):
+            if column not in columns:
+                self.db.execute("ALTER TABLE frames ADD COLUMN %s %s" %
+                                (column, kind))
+        self.db.commit()
+
+    ##################################################################
+    #
+    def __contains__(self, fname):
+        """
+        Return True if we have downloaded the file `fname`
+        """
+        cur = self.db.execute("SELECT 1 FROM frames WHERE name = ?",
+                              (fname,))
+        return cur.fetchone() is not None
+
+    ##################################################################
+    #
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+
+    ##################################################################
+    #
+    def add(self, fname, size=None, rev=None, committed=None):
+        """
+        Record that we have downloaded `fname`.
+
+        Arguments:
+        - `fname`: The base name of the file. It must match DATE_FNAME_re.
+        - `size`: Its size, if we know it
+        - `rev`: The rev dropbox gave it, if we know it
+        - `committed`: A callable to call once `fname` has been committed to
+                       the index (like telling the journal the download is
+                       done.)
+        """
+        self.db.execute("INSERT OR REPLACE INTO frames (name, ts, size, rev) "
+                        "VALUES (?, ?, ?, ?)",
+                        (fname, fname_timestamp(fname), size, rev))
+        if committed is not None:
+            self.on_commit.append(committed)
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_EVERY:
+            self.commit()
+
+    ##################################################################
+    #
+    def commit(self):
+        """
+        Make sure everything we have added to the index is on disk.
+        """
+        self.db.commit()
+        self.uncommitted = 0
+        on_commit, self.on_commit = self.on_commit, []
+        for committed in on_commit:
+            committed()
+
+    ##################################################################
+    #
+    def latest(self):
+        """
+        Return the name of the latest file we have downloaded, or None if we
+        have not downloaded any.
+        """
+        row = self.db.execute("SELECT name FROM frames "
+                              "ORDER BY ts DESC LIMIT 1").fetchone()
+        return None if row is None else str(row[0])
+
+    ##################################################################
+    #
+    def names_between(self, start, end):
+        """
+        Return the names of the files we have downloaded that were created
+        from `start` to `end` (inclusive), oldest first.
+
+        Arguments:
+        - `start`: seconds since the epoch (or an arrow timestamp)
+        - `end`: seconds since the epoch (or an arrow timestamp)
+        """
+        cur = self.db.execute("SELECT name FROM frames "
+                              "WHERE ts >= ? AND ts <= ? ORDER BY ts",
+                              (epoch(start), epoch(end)))
+        return [str(row[0]) for row in cur]
+
+    ##################################################################
+    #
+    def rebuild(self, data_dirname, also=()):
+        """
+        Throw away what is in the index and re-populate it by scanning the
+        data directory.
+
+        Arguments:
+        - `data_dirname`: The data directory we download files in to.
+        - `also`: The names of files we downloaded that are not in the data
+                  directory (because we decided not to keep them.)
+        """
+        self.db.execute("DELETE FROM frames")
+        for fnames in (downloaded_files(data_dirname), also):
+            self.db.executemany("INSERT OR REPLACE INTO frames (name, ts) "
+                                "VALUES (?, ?)",
+                                ((f, fname_timestamp(f)) for f in fnames))
+        self.commit()
+
+    ##################################################################
+    #
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+##################################################################
+##################################################################
+#
+class Journal(object):
+    """
+    A write-ahead journal of the renames, downloads, and deletes we are
+    about to do, so that if we are killed part way through a run we can
+    finish what we were doing when we start up again instead of starting over
+    (and instead of losing files that the high-water mark in our index has
+    already passed.)
+
+    Before we do something we write a 'plan' line for it, and once it is
+    done (or we find out the file is gone) we write a 'done' line:
+
+        plan<TAB>rename<TAB><name><TAB><new name>
+        plan<TAB>download<TAB><name>
+        done<TAB>download<TAB><name>
+
+    Anything planned but not done when we start up is in `pending()`.
+
+    It is safe to use from several threads at once.
+    """
+
+    OPS = ("rename", "download", "delete")
+
+    ##################################################################
+    #
+    def __init__(self, journal_fname, fsync=False):
+        """
+        Open the journal, reading in whatever was left pending in it.
+
+        Arguments:
+        - `journal_fname`: The file the journal is kept in
+        - `fsync`: If True, fsync the journal after every write
+        """
+        self.journal_fname = journal_fname
+        self.fsync = fsync
+        self.lock = threading.Lock()
+
+        # The operations planned but not done, indexed by (op, name). The
+        # value is the rest of the plan (the new name for a rename.)
+        #
+        self._pending = {}
+        if os.path.exists(journal_fname):
+            with open(journal_fname, "rb") as f:
+                for line in f:
+                    # A line without its newline was cut short when we died.
+                    #
+                    if not line.endswith("\n"):
+                        break
+                    fields = line[:-1].split("\t")
+                    if len(fields) < 3 or fields[1] not in self.OPS:
+                        continue
+                    key = (fields[1], fields[2])
+                    if fields[0] == "plan":
+                        self._pending[key] = fields[3:]
+                    elif fields[0] == "done":
+                        self._pending.pop(key, None)
+
+        # Start the journal off with just what is still pending.
+        #
+        self._rewrite()
+
+    ##################################################################
+    #
+    def _rewrite(self):
+        lines = ["plan\t%s\n" % "\t".join((op, name) + tuple(rest))
+                 for (op, name), rest in sorted(self._pending.iteritems())]
+        write_file_atomically(StringIO("".join(lines)), self.journal_fname,
+                              self.fsync)
+        self.out = open(self.journal_fname, "ab")
+
+    ##################################################################
+    #
+    def _write(self, lines):
+        self.out.write("".join(lines))
+        self.out.flush()
+        if self.fsync:
+            os.fsync(self.out.fileno())
+
+    ##################################################################
+    #
+    def plan(self, op, names):
+        """
+        Record that we are about to do `op` to each of `names`. For a rename
+        each name is a tuple of the current name and the new name.
+        """
+        lines = []
+        with self.lock:
+            for name in names:
+                rest = ()
+                if isinstance(name, tuple):
+                    name, rest = name[0], name[1:]
+                self._pending[(op, name)] = list(rest)
+                lines.append("plan\t%s\n" % "\t".join((op, name) + rest))
+            if lines:
+                self._write(lines)
+
+    ##################################################################
+    #
+    def done(self, op, name):
+        """
+        Record that we have done `op` to `name`.
+        """
+        with self.lock:
+            if self._pending.pop((op, name), None) is not None:
+                self._write(["done\t%s\t%s\n" % (op, name)])
+
+    ##################################################################
+    #
+    def pending(self, op):
+        """
+        Return the names we planned to do `op` to but have not done. For a
+        rename each is a tuple of the current name and the new name.
+        """
+        with self.lock:
+            return sorted(tuple([name] + rest) if rest else name
+                          for (o, name), rest in self._pending.iteritems()
+                          if o == op)
+
+    ##################################################################
+    #
+    def checkpoint(self):
+        """
+        If nothing is pending, empty the journal so it does not grow forever.
+        """
+        with self.lock:
+            if not self._pending:
+                self.out.close()
+                self._rewrite()
+
+    ##################################################################
+    #
+    def close(self):
+        self.out.close()
+
+
+##################################################################
+##################################################################
+#
+class BackendError(Exception):
+    """
+    Raised by a backend when the storage service says a request failed. Like
+    a dropbox.rest.ErrorResponse it has the HTTP `status` (404 if the file
+    does not exist, 5xx if the service is having problems, etc.) and the
+    response's `headers` as a list of (header, value) tuples.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, status, reason=None, headers=None, error_msg=None):
+        Exception.__init__(self, status, reason, error_msg)
+        self.status = status
+        self.reason = reason
+        self.headers = headers or []
+        self.error_msg = error_msg
+
+    ##################################################################
+    #
+    def __str__(self):
+        return "[%d] %s" % (self.status, self.error_msg or self.reason)
+
+
+##################################################################
+##################################################################
+#
+class BackendSocketError(socket.error):
+    """
+    Raised by a backend when it could not talk to the storage service at all
+    (a connection timed out, was refused, etc.)
+    """
+    pass
+
+
+##################################################################
+##################################################################
+#
+class Backend(object):
+    """
+    Everything we ask of the service the webcam images are stored in. The
+    functions in this script take a backend instead of talking to dropbox
+    directly, so that they can be run against something else (see
+    fake_dropbox.FakeBackend.)
+
+    The return values are the same as dropbox's. Errors are raised as
+    BackendError or BackendSocketError.
+    """
+
+    ##################################################################
+    #
+    def list_folder(self, path, hash=None, file_limit=25000):
+        """
+        Return the metadata for the folder `path`, including its 'hash' and
+        its 'contents' (the metadata of each file in it.) If `hash` is given
+        and the folder has not changed raise a BackendError with a status of
+        304. If there are more than `file_limit` files in the folder raise a
+        BackendError with a status of 406.
+        """
+        raise NotImplementedError
+
+    ##################################################################
+    #
+    def delta(self, cursor=None):
+        """
+        Return the changes made since `cursor` (see FolderView.)
+        """
+        raise NotImplementedError
+
+    ##################################################################
+    #
+    def move(self, from_path, to_path):
+        """
+        Rename the file `from_path` to `to_path`.
+        """
+        raise NotImplementedError
+
+    ##################################################################
+    #
+    def download(self, path):
+        """
+        Return a tuple of a file-like object with the contents of the file
+        `path` and the file's metadata.
+        """
+        raise NotImplementedError
+
+    ##################################################################
+    #
+    def download_to(self, path, destination_fname, fsync=False,
+                    expected_size=None):
+        """
+        Download the file `path` and write it to `destination_fname` (see
+        write_file_atomically().) Returns the number of bytes written.
+
+        A connection that is dropped part way through can look just like
+        the end of the file, so getting a different number of bytes than the
+        file's metadata (or `expected_size`) says it has is raised as a
+        BackendError with a status of 502, like any other server error. A
+        connection that fails outright while we read the file is raised as
+        a BackendSocketError.
+        """
+        f, metadata = self.download(path)
+        expected = (metadata or {}).get('bytes', expected_size)
+        try:
+            size = write_file_atomically(f, destination_fname, fsync,
+                                         expected)
+        except (socket.error, httplib.HTTPException), e:
+            if isinstance(e, BackendSocketError):
+                raise
+            raise BackendSocketError(getattr(e, 'errno', None),
+                                     "%s: %s" % (e.__class__.__name__, e))
+        finally:
+            f.close()
+        metrics.inc('webcam_bytes_downloaded_total', size)
+        if expected is not None and size != expected:
+            metrics.inc('webcam_short_downloads_total')
+            raise BackendError(502, "Bad Gateway", error_msg=(
+                "Got %d bytes of '%s', expected %d" % (size, path, expected)))
+        return size
+
+    ##################################################################
+    #
+    def delete(self, path):
+        """
+        Delete the file `path`.
+        """
+        raise NotImplementedError
+
+
+####################################################################
+#
+def import_dropbox():
+    """
+    Import the dropbox module (in to our global `dropbox`) if we have not
+    already. It is slow to import, mostly because it pulls in
+    pkg_resources, so we do not import it until we need it.
+    """
+    global dropbox
+    if dropbox is None:
+        import dropbox
+    return dropbox
+
+
+##################################################################
+##################################################################
+#
+class DropboxBackend(Backend):
+    """
+    A Backend that talks to dropbox through a dropbox.client.DropboxClient.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, client):
+        """
+        Arguments:
+        - `client`: A dropbox.client.DropboxClient
+        """
+        self.client = client
+
+    ##################################################################
+    #
+    def _call(self, method, *args, **kwargs):
+        """
+        Call `method` with the given arguments, turning the exceptions the
+        dropbox client raises in to ours.
+        """
+        try:
+            return method(*args, **kwargs)
+        except dropbox.rest.ErrorResponse, e:
+            raise BackendError(e.status, e.reason, e.headers,
+                               getattr(e, 'error_msg', None))
+        except dropbox.rest.RESTSocketError, e:
+            raise BackendSocketError(e.errno, str(e))
+        except (socket.error, httplib.HTTPException), e:
+            # The dropbox client only turns errors sending the request in to
+            # RESTSocketErrors. Getting the response can fail too (like a
+            # pooled connection the server has closed on us.)
+            #
+            raise BackendSocketError(getattr(e, 'errno', None),
+                                     "%s: %s" % (e.__class__.__name__, e))
+
+    ##################################################################
+    #
+    def list_folder(self, path, hash=None, file_limit=25000):
+        return self._call(self.client.metadata, path, hash=hash,
+                          file_limit=file_limit)
+
+    ##################################################################
+    #
+    def delta(self, cursor=None):
+        return self._call(self.client.delta, cursor)
+
+    ##################################################################
+    #
+    def move(self, from_path, to_path):
+        return self._call(self.client.file_move, from_path, to_path)
+
+    ##################################################################
+    #
+    def download(self, path):
+        return self._call(self.client.get_file_and_metadata, path)
+
+    ##################################################################
+    #
+    def delete(self, path):
+        return self._call(self.client.file_delete, path)
+
+
+##################################################################
+##################################################################
+#
+class BackendWrapper(Backend):
+    """
+    A Backend that passes every call on to another backend through
+    `_call()`, which subclasses override to do something around each call.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, backend):
+        """
+        Arguments:
+        - `backend`: The backend to pass calls on to
+        """
+        self.backend = backend
+
+    ##################################################################
+    #
+    def _call(self, call, *args, **kwargs):
+        return getattr(self.backend, call)(*args, **kwargs)
+
+    ##################################################################
+    #
+    def list_folder(self, path, hash=None, file_limit=25000):
+        return self._call('list_folder', path, hash=hash,
+                          file_limit=file_limit)
+
+    ##################################################################
+    #
+    def delta(self, cursor=None):
+        return self._call('delta', cursor)
+
+    ##################################################################
+    #
+    def move(self, from_path, to_path):
+        return self._call('move', from_path, to_path)
+
+    ##################################################################
+    #
+    def download(self, path):
+        return self._call('download', path)
+
+    ##################################################################
+    #
+    def delete(self, path):
+        return self._call('delete', path)
+
+
+##################################################################
+##################################################################
+#
+class InstrumentedBackend(BackendWrapper):
+    """
+    A Backend that passes every call on to another backend, recording in
+    `metrics` how long each kind of call takes and how often it fails (and
+    any call that is slow enough in the `profiler`'s slow log.)
+    """
+
+    ##################################################################
+    #
+    def _call(self, call, *args, **kwargs):
+        start = time.time()
+        try:
+            return getattr(self.backend, call)(*args, **kwargs)
+        except BackendError, e:
+            metrics.inc('webcam_api_errors_total', call=call, status=e.status)
+            raise
+        except BackendSocketError:
+            metrics.inc('webcam_api_errors_total', call=call, status='socket')
+            raise
+        finally:
+            elapsed = time.time() - start
+            metrics.observe('webcam_api_call_seconds', elapsed, call=call)
+            profiler.slow(call, elapsed,
+                          " ".join(str(arg) for arg in args))
+
+
+##################################################################
+##################################################################
+#
+class LimitedBackend(BackendWrapper):
+    """
+    A Backend that passes every call on to another backend, but never lets
+    more than a fixed number of calls be in progress at once. All the
+    LimitedBackends that share a `semaphore` share the limit, so it is a
+    limit on how hard we hit dropbox however many cameras and workers we
+    have.
+
+    NOTE: A download only holds on to the semaphore until dropbox starts
+          sending us the file, not while we are reading it.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, backend, semaphore):
+        """
+        Arguments:
+        - `backend`: The backend to pass calls on to
+        - `semaphore`: The threading.Semaphore every call has to acquire
+        """
+        super(LimitedBackend, self).__init__(backend)
+        self.semaphore = semaphore
+
+    ##################################################################
+    #
+    def _call(self, call, *args, **kwargs):
+        with self.semaphore:
+            return getattr(self.backend, call)(*args, **kwargs)
+
+
+##################################################################
+##################################################################
+#
+class RetryBudget(object):
+    """
+    How many times, in all, the RetryingBackends sharing this budget may
+    retry a call before the budget is reset (once per run of a camera.) This
+    way retrying each call a few times can not turn an outage in to a run
+    that goes on forever.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, retries):
+        """
+        Arguments:
+        - `retries`: The most retries between resets
+        """
+        self.retries = retries
+        self.used = 0
+        self.lock = threading.Lock()
+
+    ##################################################################
+    #
+    def reset(self):
+        with self.lock:
+            self.used = 0
+
+    ##################################################################
+    #
+    def spend(self):
+        """
+        Use up one retry. Returns False if there are none left.
+        """
+        with self.lock:
+            if self.used >= self.retries:
+                return False
+            self.used += 1
+            return True
+
+
+####################################################################
+#
+def transient_error(e):
+    """
+    Return True if the error `e` (a BackendError or BackendSocketError) is
+    worth retrying: a server error, being told to slow down, or not being
+    able to talk to the server at all.
+    """
+    if isinstance(e, BackendSocketError):
+        return True
+    return e.status == 429 or e.status >= 500
+
+
+##################################################################
+##################################################################
+#
+class RetryingBackend(BackendWrapper):
+    """
+    A Backend that passes every call on to another backend and retries it
+    if it fails with a transient error (see transient_error()), waiting
+    longer after each failure (or as long as dropbox tells us to.)
+
+    This way one failed call is retried on its own instead of abandoning
+    everything else the run was doing. Other errors, and errors we have run
+    out of retries for, are raised as before.
+
+    A move or delete that failed may have been done anyway (we just never
+    got dropbox's answer), so if retrying one finds the file is not there
+    any more we take it that our first try worked.
+    """
+
+    # The calls that can not be repeated once they have worked.
+    #
+    GONE_AFTER_RETRY = ('move', 'delete')
+
+    ##################################################################
+    #
+    def __init__(self, backend, retries=3, budget=None, max_delay=60):
+        """
+        Arguments:
+        - `backend`: The backend to pass calls on to
+        - `retries`: The most times we retry one call
+        - `budget`: A RetryBudget shared with other RetryingBackends. If None
+                    only `retries` limits us.
+        - `max_delay`: The longest, in seconds, we wait before a retry
+        """
+        super(RetryingBackend, self).__init__(backend)
+        self.retries = retries
+        self.budget = budget
+        self.max_delay = max_delay
+
+    ##################################################################
+    #
+    def _call(self, call, *args, **kwargs):
+        return self._retry(call, getattr(self.backend, call), *args, **kwargs)
+
+    ##################################################################
+    #
+    def download_to(self, path, destination_fname, fsync=False,
+                    expected_size=None):
+        """
+        Retry downloading the file and writing it out together, so a
+        download that is cut short part way through is retried too.
+        """
+        return self._retry('download', self.backend.download_to, path,
+                           destination_fname, fsync, expected_size)
+
+    ##################################################################
+    #
+    def _retry(self, call, func, *args, **kwargs):
+        """
+        Call `func` with the given arguments, retrying it on transient
+        errors. `call` is what we call it in our metrics and messages.
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except (BackendError, BackendSocketError), e:
+                if (attempt and call in self.GONE_AFTER_RETRY and
+                        isinstance(e, BackendError) and e.status == 404):
+                    print "** Retried %s of '%s' found it gone, so our " \
+                        "first try worked" % (call, args[0])
+                    metrics.inc('webcam_retries_done_total', call=call)
+                    return None
+                if (not transient_error(e) or attempt >= self.retries or
+                        (self.budget is not None and
+                         not self.budget.spend())):
+                    raise
+                delay = retry_after(e)
+            attempt += 1
+            if not delay:
+                delay = 2 ** (attempt - 1)
+            delay = min(delay, self.max_delay)
+            metrics.inc('webcam_retries_total', call=call)
+            print "** Retrying %s in %d seconds after error: %s (attempt %d "\
+                "of %d)" % (call, delay, e, attempt, self.retries)
+            sleep(delay)
+
+
+##################################################################
+##################################################################
+#
+class PooledConnection(object):
+    """
+    Looks like an httplib.HTTPConnection to dropbox.rest.RESTClientObject,
+    but instead of closing the connection when it is done with it we keep it
+    open for the next request. This saves a TCP connect and TLS handshake on
+    every call to dropbox.
+
+    If the server closed a connection we kept open while it was idle we
+    reconnect and send the request again.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, connection_class, host, port):
+        """
+        Arguments:
+        - `connection_class`: The httplib.HTTPConnection-like class to
+                              connect with
+        - `host`: The host to connect to
+        - `port`: The port to connect to
+        """
+        self.connection_class = connection_class
+        self.host = host
+        self.port = port
+        self.conn = None
+        self.response = None
+        self.reused = False
+        self.last_request = None
+
+    ##################################################################
+    #
+    def _connect(self):
+        self.conn = self.connection_class(self.host, self.port)
+        metrics.inc('webcam_connections_opened_total')
+
+    ##################################################################
+    #
+    def _resend(self):
+        """
+        Send the last request again on a new connection.
+        """
+        self.conn.close()
+        self._connect()
+        self.reused = False
+        self.conn.request(*self.last_request)
+
+    ##################################################################
+    #
+    def request(self, method, url, body=None, headers={}):
+        # We can only send another request on the connection if the last
+        # response was read to the end (which we can only tell if it said how
+        # long it was) and the server did not say it was closing it.
+        #
+        r = self.response
+        if self.conn is not None and r is not None and \
+                not (r.isclosed() and r.length == 0 and not r.will_close):
+            self.conn.close()
+            self.conn = None
+        self.response = None
+        self.reused = self.conn is not None
+        if self.conn is None:
+            self._connect()
+        else:
+            metrics.inc('webcam_connections_reused_total')
+        self.last_request = (method, url, body, headers)
+        try:
+            self.conn.request(method, url, body, headers)
+        except (socket.error, httplib.HTTPException):
+            if not self.reused:
+                raise
+            self._resend()
+
+    ##################################################################
+    #
+    def send(self, data):
+        # Only used when uploading a file, which we can not send again.
+        #
+        self.last_request = None
+        self.conn.send(data)
+
+    ##################################################################
+    #
+    def getresponse(self):
+        try:
+            self.response = self.conn.getresponse()
+        except (socket.error, httplib.BadStatusLine):
+            if not self.reused or self.last_request is None:
+                raise
+            self._resend()
+            self.response = self.conn.getresponse()
+        return self.response
+
+    ##################################################################
+    #
+    def close(self):
+        # Leave it open for the next request.
+        #
+        pass
+
+
+##################################################################
+##################################################################
+#
+class ConnectionPool(object):
+    """
+    An `http_connect` for dropbox.rest.RESTClientObject that gives each
+    worker its own PooledConnection to each host, so every call a worker
+    makes to dropbox goes over the same connection.
+
+    Our worker threads only last as long as one run, so we keep the
+    connections by the name of the thread (its worker slot, like
+    'worker-0' or 'downloader-1', see run_worker_pool() and run_pipeline())
+    instead of by the thread itself. The worker in the same slot next run
+    picks up where this one left off, without a new TLS handshake. A slot is
+    never shared by two threads that are running at the same time.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, connection_class):
+        """
+        Arguments:
+        - `connection_class`: The httplib.HTTPConnection-like class to
+                              connect with
+        """
+        self.connection_class = connection_class
+        self.lock = threading.Lock()
+
+        # The thread using each slot and its connections, by slot name.
+        #
+        self.slots = {}
+
+    ##################################################################
+    #
+    def __call__(self, host, port):
+        current = threading.current_thread()
+        slot = current.name
+        with self.lock:
+            owner, connections = self.slots.get(slot, (None, {}))
+            if owner is not current and owner is not None and \
+                    owner.is_alive():
+                # Two threads with the same name. The second one gets a slot
+                # of its own.
+                #
+                slot = (slot, current.ident)
+                owner, connections = self.slots.get(slot, (None, {}))
+            self.slots[slot] = (current, connections)
+        key = (host, port)
+        if key not in connections:
+            connections[key] = PooledConnection(self.connection_class, host,
+                                                port)
+        return connections[key]
+
+
+####################################################################
+#
+def pooled_rest_client():
+    """
+    Return a dropbox rest client that keeps its connections open (see
+    ConnectionPool), to pass to DropboxClient as its `rest_client`, or None
+    if this version of the dropbox module can not use one.
+    """
+    rest = dropbox.rest
+    if not (hasattr(rest, 'RESTClientObject') and
+            hasattr(rest, 'ProperHTTPSConnection')):
+        return None
+    try:
+        args = inspect.getargspec(dropbox.client.DropboxClient.__init__)[0]
+    except TypeError:
+        return None
+    if 'rest_client' not in args:
+        return None
+    return rest.RESTClientObject(
+        http_connect=ConnectionPool(rest.ProperHTTPSConnection))
+
+
+##################################################################
+##################################################################
+#
+class DirListing(object):
+    """
+    The names of the files in a dropbox folder, read as we iterate over it
+    instead of all at once.
+
+    We ask for the folder's metadata, which lists the whole folder in one
+    response, unless the folder has more than `file_limit` files in it
+    (dropbox will not list more than 25,000 files at once, and a response
+    that big is a lot to hold on to.) Then we walk the folder a page at a
+    time with the delta API instead, so we only ever have one page of
+    dropbox's response in memory. (Whoever iterates over us still ends up
+    holding every name, as Listing does. `max_files` is what bounds that.)
+
+    NOTE: The dropbox client parses each response in one go, so a page is
+          the smallest piece we can get. We can not parse the JSON as it
+          arrives.
+
+    Once we have iterated over all of it, `hash` is the folder's hash (or,
+    if we had to page through it, the delta cursor, which also changes
+    whenever anything changes.) If `max_files` is set we stop after that
+    many files, `truncated` is set to True, and `hash` is None, since we
+    have not seen the whole folder.
+
+    As we go we fill in `meta` with the size and rev of each file, for
+    Listing.
+
+    If we are given the `last_hash` of the folder dropbox only sends us its
+    metadata if the folder has changed. If it has not we list nothing,
+    `unchanged` is set to True, and `hash` is `last_hash`.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, backend, db_folder, file_limit=25000, max_files=0,
+                 last_hash=None):
+        """
+        Arguments:
+        - `backend`: A backend
+        - `db_folder`: The folder we want the contents of
+        - `file_limit`: The most files we ask for the metadata of at once
+        - `max_files`: The most files we list. 0 means no limit.
+        - `last_hash`: The hash the folder had the last time we listed it
+        """
+        self.backend = backend
+        self.db_folder = db_folder
+        self.file_limit = file_limit
+        self.max_files = max_files
+        self.last_hash = last_hash
+        self.hash = None
+        self.truncated = False
+        self.paged = False
+        self.unchanged = False
+        self.meta = {}
+
+    ##################################################################
+    #
+    def __iter__(self):
+        self.hash = None
+        self.truncated = False
+        self.unchanged = False
+        self.meta.clear()
+        count = 0
+        for fname in self._names():
+            if self.max_files and count >= self.max_files:
+                self.truncated = True
+                self.hash = None
+                return
+            count += 1
+            yield fname
+
+    ##################################################################
+    #
+    def _names(self):
+        """
+        Yield the names of the files in the folder, setting `hash` when we
+        get to the end.
+        """
+        try:
+            folder_metadata = self.backend.list_folder(
+                self.db_folder, hash=self.last_hash,
+                file_limit=self.file_limit)
+        except BackendError, e:
+            if e.status == 304:
+                self.unchanged = True
+                self.hash = self.last_hash
+                return
+            if e.status != 406:
+                raise
+            folder_metadata = None
+
+        if folder_metadata is not None:
+            for f in folder_metadata['contents']:
+                # Skip over directories
+                #
+                if not f['is_dir']:
+                    fname = os.path.basename(f['path'])
+                    self.meta[fname] = (f.get('bytes'), f.get('rev'))
+                    yield fname
+            self.hash = folder_metadata['hash']
+            return
+
+        # Too many files to list at once. A delta without a cursor lists
+        # everything in the account, a page at a time.
+        #
+        self.paged = True
+        folder = self.db_folder.rstrip("/").lower()
+        cursor = None
+        while True:
+            delta = self.backend.delta(cursor)
+            for path, metadata in delta['entries']:
+                if os.path.dirname(path) != folder:
+                    continue
+                if metadata is not None and not metadata['is_dir']:
+                    fname = os.path.basename(metadata['path'])
+                    self.meta[fname] = (metadata.get('bytes'),
+                                        metadata.get('rev'))
+                    yield fname
+            cursor = delta['cursor']
+            if not delta['has_more']:
+                break
+        self.hash = cursor
+
+
+####################################################################
+#
+def folder_changed_since(backend, db_folder, cursor):
+    """
+    Ask dropbox (with the delta API) if anything in `db_folder` has changed
+    since `cursor`, the delta cursor a DirListing that paged through the
+    folder ended up with. This only costs as much as the changes made since
+    then, however big the folder is.
+
+    Returns a tuple of True and None if anything in the folder changed,
+    otherwise False and the cursor to ask with next time.
+
+    Arguments:
+    - `backend`: A backend
+    - `db_folder`: The folder we are interested in
+    - `cursor`: The delta cursor we last had
+    """
+    folder = db_folder.rstrip("/").lower()
+    while True:
+        delta = backend.delta(cursor)
+        if delta['reset']:
+            return True, None
+        for path, metadata in delta['entries']:
+            if os.path.dirname(path) == folder:
+                return True, None
+        cursor = delta['cursor']
+        if not delta['has_more']:
+            return False, cursor
+
+
+####################################################################
+#
+def get_dropbox_dir(backend, db_folder, file_limit=25000):
+    """
+    Get the contents of a dropbox folder and its current hash.
+
+    We only care about the file names in the folder and its current hash so we
+    do not deal with the other metadata.
+
+    XXX Since we are dealing with just images maybe we should restrict the list
+        of files we return to ones that are images?
+
+    Arguments:
+    - `backend`: A backend
+    - `db_folder`: The folder we want the contents of
+    - `file_limit`: Folders with more files than this are listed a page at a
+                    time (see DirListing.)
+    """
+    listing = DirListing(backend, db_folder, file_limit)
+    files = list(listing)
+    return listing.hash, files
+
+
+##################################################################
+##################################################################
+#
+class FolderView(object):
+    """
+    Our idea of what is in a dropbox folder, kept up to date by asking
+    dropbox only for what has changed since we last asked (using
+    `backend.delta()` and the cursor it gives back.)
+
+    Getting the metadata for a folder sends us a listing of every file in it,
+    every time. With a week of images in the folder that is a lot of data to
+    move just to find out that a few files were added. With the delta API we
+    only get the entries that were added or removed.
+
+    The cursor and the files we know about are saved to `state_fname` so that
+    we pick up where we left off when we are restarted. Rewriting every file
+    in the folder each time a few change would put the cost of a poll right
+    back to the size of the folder, so after each poll we only append what
+    changed to a log next to it ('<state_fname>.log'), and only write the
+    whole thing out again once the log has grown as big as the folder.
+
+    The changes we have seen are also kept in `changes` until someone takes
+    them (see take_changes()) so that a Listing of the folder can be patched
+    instead of being built again.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, db_folder, state_fname=None):
+        """
+        Arguments:
+        - `db_folder`: The dropbox folder we are keeping track of
+        - `state_fname`: The file we save our cursor and file list to. If
+                         None we do not save our state.
+        """
+        self.db_folder = db_folder.rstrip("/").lower()
+        self.state_fname = state_fname
+        self.log_fname = None
+        if state_fname is not None:
+            self.log_fname = state_fname + ".log"
+        self.cursor = None
+        self.generation = 0
+
+        # The files in the folder, indexed by their lower-cased path (which is
+        # how the delta API identifies them.) Each is a list of the file's
+        # name, size, and rev.
+        #
+        self.files = {}
+
+        # The changes to the folder nobody has taken yet, and whether we had
+        # to start over from nothing since then (see take_changes().)
+        #
+        self.changes = []
+        self.reset = True
+
+        # Each time we write our whole state out we start a new log. The
+        # serial number tells us which log entries go with which state, in
+        # case we were killed between writing one and emptying the other.
+        #
+        self.serial = 0
+        self.logged = 0
+
+        if state_fname is not None and os.path.exists(state_fname):
+            with open(state_fname, "rb") as f:
+                state = json.load(f)
+            if state.get('folder') == self.db_folder:
+                self.cursor = state['cursor']
+                self.files = state['files']
+                self.serial = state.get('serial', 0)
+
+                # We used to only keep the name.
+                #
+                for path, value in self.files.iteritems():
+                    if not isinstance(value, list):
+                        self.files[path] = [value, None, None]
+                self._replay()
+
+    ##################################################################
+    #
+    def _replay(self):
+        """
+        Apply the changes in our log (the ones made since we last wrote out
+        our whole state) to what we loaded from our state file.
+        """
+        if self.log_fname is None or not os.path.exists(self.log_fname):
+            return
+        with open(self.log_fname, "rb") as f:
+            for line in f:
+                # If we were killed while writing the last line, it is not
+                # whole, and the ones before it are all we have.
+                #
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if entry.get('serial') != self.serial:
+                    continue
+                for path, value in entry['files']:
+                    if value is None:
+                        self.files.pop(path, None)
+                    else:
+                        self.files[path] = value
+                self.cursor = entry['cursor']
+                self.logged += max(len(entry['files']), 1)
+
+    ##################################################################
+    #
+    def update(self, backend):
+        """
+        Ask dropbox what has changed since we last asked and apply those
+        changes to our view of the folder.
+
+        Returns True if anything in our folder changed.
+
+        Arguments:
+        - `backend`: The backend
+        """
+        changed = False
+        reset = False
+        start_cursor = self.cursor
+        logged = []
+        while True:
+            delta = backend.delta(self.cursor)
+            if delta['reset']:
+                self.files = {}
+                self.changes = []
+                self.reset = True
+                reset = True
+                changed = True
+
+            for path, metadata in delta['entries']:
+                # We only care about files directly inside our folder.
+                #
+                if os.path.dirname(path) != self.db_folder:
+                    continue
+                if metadata is None or metadata['is_dir']:
+                    value = self.files.pop(path, None)
+
+                    # If we never saw the file (we may have renamed it to
+                    # this name ourselves) all we know is its lower-cased
+                    # name.
+                    #
+                    self.changes.append((value[0] if value is not None else
+                                         os.path.basename(path), None))
+                    logged.append((path, None))
+                    changed = changed or value is not None
+                else:
+                    value = [os.path.basename(metadata['path']),
+                             metadata.get('bytes'), metadata.get('rev')]
+                    self.files[path] = value
+                    self.changes.append((value[0], (value[1], value[2])))
+                    logged.append((path, value))
+                    changed = True
+
+            self.cursor = delta['cursor']
+            if not delta['has_more']:
+                break
+
+        if changed:
+            self.generation += 1
+
+        # Unless we had to start over, or our log has grown as big as the
+        # folder, we only need to add what changed to our log.
+        #
+        if reset or self.logged + len(logged) > max(len(self.files), 1000):
+            self.save()
+        elif logged or self.cursor != start_cursor:
+            self.log(logged)
+        return changed
+
+    ##################################################################
+    #
+    def seed(self, cursor, meta):
+        """
+        Start our view of the folder from a listing of it we already have,
+        instead of asking dropbox for all of it again.
+
+        Arguments:
+        - `cursor`: The delta cursor the listing ended at
+        - `meta`: The (size, rev) of every file in the folder, by name (see
+                  DirListing)
+        """
+        self.cursor = cursor
+        self.files = dict(("%s/%s" % (self.db_folder, fname.lower()),
+                           [fname, size, rev])
+                          for fname, (size, rev) in meta.iteritems())
+        self.changes = []
+        self.reset = True
+        self.generation += 1
+        self.save()
+
+    ##################################################################
+    #
+    def take_changes(self):
+        """
+        Return whether our view had to be started over from nothing, and the
+        list of (file name, (size, rev) or None) changes to the folder (see
+        Listing.apply_changes()), since the last time this was called.
+        """
+        reset, changes = self.reset, self.changes
+        self.reset = False
+        self.changes = []
+        return reset, changes
+
+    ##################################################################
+    #
+    def listing(self):
+        """
+        Return the names of the files in the folder, sorted.
+        """
+        return sorted(fname for fname, size, rev in self.files.itervalues())
+
+    ##################################################################
+    #
+    def meta(self):
+        """
+        Return a dict of the (size, rev) of each file in the folder, by name.
+        """
+        return dict((fname, (size, rev))
+                    for fname, size, rev in self.files.itervalues())
+
+    ##################################################################
+    #
+    def log(self, files):
+        """
+        Append the changes in `files` and our cursor to our log.
+
+        Arguments:
+        - `files`: A list of (lower-cased path, [name, size, rev] or None)
+                   tuples
+        """
+        if self.log_fname is None:
+            return
+        with open(self.log_fname, "ab") as f:
+            f.write(json.dumps({'serial': self.serial,
+                                'cursor': self.cursor,
+                                'files': files}) + "\n")
+        self.logged += max(len(files), 1)
+
+    ##################################################################
+    #
+    def save(self):
+        """
+        Save the cursor and what we know about the folder to our state file,
+        and start a new log.
+        """
+        if self.state_fname is None:
+            return
+        self.serial += 1
+        state = json.dumps({'folder': self.db_folder,
+                            'cursor': self.cursor,
+                            'serial': self.serial,
+                            'files': self.files})
+        write_file_atomically(StringIO(state), self.state_fname)
+        open(self.log_fname, "wb").close()
+        self.logged = 0
+
+
+####################################################################
+#
+def get_incremental_dir(backend, view, last_generation=None):
+    """
+    Like get_dropbox_dir(), but only asks dropbox what has changed since the
+    last time we asked.
+
+    Returns a tuple of something that changes whenever the contents of the
+    folder change (like the hash get_dropbox_dir() returns) and the file names
+    in the folder. If that is still `last_generation` we return it and None
+    instead of the file names, so a poll that finds nothing new costs only
+    the delta, not the size of the folder.
+
+    Arguments:
+    - `backend`: A backend
+    - `view`: The FolderView for the folder we want the contents of
+    - `last_generation`: The generation we got the last time we asked
+    """
+    view.update(backend)
+    view.take_changes()
+    if last_generation is not None and view.generation == last_generation:
+        return view.generation, None
+    return view.generation, view.listing()
+
+
+####################################################################
+#
+def move_file(backend, db_folder, fname, new_fname):
+    """
+    Rename `fname` to `new_fname` in the dropbox folder `db_folder`.
+
+    Returns True if the file was renamed and False if it no longer exists.
+
+    Arguments:
+    - `backend`: The backend
+    - `db_folder`: The dropbox folder we are operating in
+    - `fname`: The file to rename
+    - `new_fname`: What to rename it to
+    """
+    try:
+        backend.move(os.path.join(db_folder, fname),
+                     os.path.join(db_folder, new_fname))
+    except BackendError, e:
+        # It is okay if this file does not exist (means that it
+        # was deleted before we could get to copying it..)
+        #
+        if e.status != 404:
+            raise e
+        return False
+    return True
+
+
+####################################################################
+#
+def rename_dropbox_files(backend, db_folder, files, dry_run, workers=1,
+                         backend_factory=None, journal=None):
+    """
+    Go through the files that are in the given dropbox folder, as passed in
+    via the 'files' list. Filter out all the files that do not match our
+    regular expression for the files we are going to rename, and then rename
+    them in to sortable date based file names (the date we derive from their
+    existing file name.)
+
+    If `workers` is more than 1 then that many files are renamed at the same
+    time, each by a different backend (gotten from `backend_factory`.)
+
+    Returns a RenameResult saying what was renamed, so the caller can update
+    its listing of the folder instead of asking dropbox for it again.
+
+    Arguments:
+    - `backend`: The backend
+    - `db_folder`: The dropbox folder we are operating in
+    - `files`: The list of files from that dropbox folder (or a Listing of
+               them)
+    - `dry_run`: a boolean. If true then no actual actions are performed
+    - `workers`: The number of files to rename at the same time.
+    - `backend_factory`: A callable that returns a new backend. Only
+                         needed if `workers` is more than 1.
+    - `journal`: A Journal to record what we are about to do, and have done,
+                 in.
+    """
+    if not isinstance(files, Listing):
+        files = Listing(files)
+
+    # The file name actually is alreay date based.. but it is just not
+    # easily sortable so we want to convert it to a yyyy.mm.dd-hh:mm:ss
+    # format for that reason. The Listing has already worked out the new name
+    # for every file that matches our pattern.
+    #
+    # If we are doing a dry-run we just say what we would do.
+    #
+    result = RenameResult()
+    if dry_run:
+        for fname, new_fname in files.to_rename:
+            print "Renaming '%s' to '%s'" % (fname, new_fname)
+        return result
+
+    def move(backend, item):
+        return move_file(backend, db_folder, *item)
+
+    if workers <= 1:
+        backend_factory = lambda: backend
+
+    if journal is not None:
+        journal.plan('rename', files.to_rename)
+
+    for (fname, new_fname), found, exc in run_worker_pool(move,
+                                                          files.to_rename,
+                                                          workers,
+                                                          backend_factory):
+        print "Renaming '%s' to '%s'" % (fname, new_fname)
+        if exc is not None:
+            raise exc
+        if journal is not None:
+            journal.done('rename', fname)
+        if found:
+            result.renamed.append((fname, new_fname))
+            metrics.inc('webcam_files_renamed_total')
+        else:
+            result.missing.append(fname)
+            metrics.inc('webcam_not_found_total', phase='rename')
+            print "File '%s' was deleted before we could rename it" % \
+                fname
+    if len(result):
+        print "** Renamed %d files, %d were deleted before we could rename " \
+            "them" % (len(result.renamed), len(result.missing))
+    return result
+
+
+##################################################################
+##################################################################
+#
+class PollScheduler(object):
+    """
+    Decides how long to wait between runs of the main loop. This one always
+    waits the same amount of time. AdaptivePollScheduler waits longer while
+    nothing is happening.
+
+    The main loop tells the scheduler how each run went by calling
+    `changed()`, `unchanged()` or `error()` and then calls `wait()`.
+
+    The clock and sleep functions can be replaced (with a fake clock, for
+    instance) so the scheduler can be tested without actually waiting.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, interval, clock=time.time, sleep=sleep):
+        """
+        Arguments:
+        - `interval`: The time in seconds between runs. For an adaptive
+                      scheduler this is the interval we start with, and it is
+                      what we compare ourselves against.
+        - `clock`: A function returning the current time in seconds
+        - `sleep`: A function that waits the given number of seconds
+        """
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self.started = clock()
+        self.polls = 0
+
+    ##################################################################
+    #
+    def changed(self):
+        """
+        The last run found changes in the dropbox folder.
+        """
+        self.polls += 1
+
+    ##################################################################
+    #
+    def unchanged(self):
+        """
+        The last run found nothing had changed in the dropbox folder.
+        """
+        self.polls += 1
+
+    ##################################################################
+    #
+    def error(self, retry_after=None):
+        """
+        The last run failed with a transient error.
+
+        Arguments:
+        - `retry_after`: If dropbox told us how long to wait before trying
+                         again, the number of seconds it told us.
+        """
+        self.polls += 1
+
+    ##################################################################
+    #
+    def next_interval(self):
+        """
+        Return how many seconds to wait before the next run.
+        """
+        return self.interval
+
+    ##################################################################
+    #
+    def calls_saved(self):
+        """
+        Return how many fewer times we have polled dropbox than we would have
+        if we had polled every `interval` seconds (starting right away.)
+        """
+        elapsed = self.clock() - self.started
+        return int(elapsed / self.interval) + 1 - self.polls
+
+    ##################################################################
+    #
+    def wait(self):
+        """
+        Wait until it is time for the next run. Returns the number of seconds
+        we waited.
+        """
+        delay = self.next_interval()
+        self.sleep(delay)
+        return delay
+
+
+##################################################################
+##################################################################
+#
+class AdaptivePollScheduler(PollScheduler):
+    """
+    A PollScheduler that backs off exponentially (up to `max_interval`) while
+    nothing changes in the dropbox folder and drops to `min_interval` as soon
+    as something does, since the camera tends to upload images in bursts.
+
+    Every interval is randomly varied by up to `jitter` of itself so that
+    several of us do not end up polling in lock step, and if dropbox asks us
+    to back off we wait at least as long as it asks.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, interval, min_interval, max_interval, backoff=2.0,
+                 jitter=0.1, clock=time.time, sleep=sleep,
+                 random=random.random):
+        """
+        Arguments:
+        - `interval`: The interval we start with
+        - `min_interval`: The shortest interval we wait
+        - `max_interval`: The longest interval we wait (unless dropbox tells
+                          us to wait longer)
+        - `backoff`: How much longer we wait every time nothing changes
+        - `jitter`: The fraction of the interval we vary it by
+        - `clock`: A function returning the current time in seconds
+        - `sleep`: A function that waits the given number of seconds
+        - `random`: A function returning a random number in [0, 1)
+        """
+        super(AdaptivePollScheduler, self).__init__(interval, clock, sleep)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.random = random
+        self.current = float(interval)
+        self.retry_after = 0
+
+    ##################################################################
+    #
+    def changed(self):
+        super(AdaptivePollScheduler, self).changed()
+        self.current = float(self.min_interval)
+
+    ##################################################################
+    #
+    def unchanged(self):
+        super(AdaptivePollScheduler, self).unchanged()
+        self.current = min(self.max_interval, self.current * self.backoff)
+
+    ##################################################################
+    #
+    def error(self, retry_after=None):
+        super(AdaptivePollScheduler, self).error(retry_after)
+        self.current = min(self.max_interval, self.current * self.backoff)
+        self.retry_after = retry_after or 0
+
+    ##################################################################
+    #
+    def next_interval(self):
+        delay = self.current * (1 + self.jitter * (2 * self.random() - 1))
+        delay = max(delay, self.retry_after)
+        self.retry_after = 0
+        return delay
+
+
+####################################################################
+#
+def retry_after(e):
+    """
+    Return the number of seconds the BackendError `e` tells us to wait
+    before trying again (from its Retry-After header), or None if it does not
+    say.
+    """
+    for header, value in getattr(e, 'headers', None) or []:
+        if header.lower() == 'retry-after':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+####################################################################
+#
+def run_worker_pool(func, items, workers, backend_factory):
+    """
+    A generator that runs `func(backend, item)` for every item in `items`
+    using a pool of `workers` threads and yields `(item, result, exc)` tuples
+    in the same order as `items`.
+
+    Each worker thread gets its own backend from `backend_factory` so that
+    no two threads ever share a connection to dropbox. The threads are named
+    for their place in the pool ('worker-0', 'worker-1', ...) so the next
+    pool's workers reuse their connections (see ConnectionPool.)
+
+    If `func` raises an exception it is not raised in the worker. Instead it
+    is handed back as `exc` (and `result` is None) so that the caller can
+    decide what to do with it, in order, just like it would have if it had
+    called `func` itself.
+
+    Arguments:
+    - `func`: The function to call. It is called as `func(backend, item)`
+    - `items`: The list of things to call `func` on.
+    - `workers`: The number of threads to run `func` in.
+    - `backend_factory`: A callable that returns a new backend.
+    """
+    # With only one worker there is no point in spinning up a thread. Just
+    # do the work here, one item at a time.
+    #
+    if workers <= 1 or len(items) <= 1:
+        backend = backend_factory()
+        for item in items:
+            try:
+                yield item, func(backend, item), None
+            except Exception, e:
+                yield item, None, e
+        return
+
+    work = Queue.Queue()
+    results = Queue.Queue()
+    for idx, item in enumerate(items):
+        work.put((idx, item))
+
+    def worker():
+        backend = backend_factory()
+        while True:
+            try:
+                idx, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results.put((idx, func(backend, item), None))
+            except Exception, e:
+                results.put((idx, None, e))
+
+    threads = []
+    for i in range(min(workers, len(items))):
+        t = threading.Thread(target=worker, name="worker-%d" % i)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # Results come back in whatever order the workers finish them. Hold on to
+    # the ones that arrive early so we can hand them back in order.
+    #
+    try:
+        pending = {}
+        for idx, item in enumerate(items):
+            while idx not in pending:
+                r_idx, result, exc = results.get()
+                pending[r_idx] = (result, exc)
+            result, exc = pending.pop(idx)
+            yield item, result, exc
+    finally:
+        # If our caller stopped early (usually because it raised one of the
+        # exceptions we handed it) empty the work queue so the workers stop
+        # after what they are doing right now.
+        #
+        while True:
+            try:
+                work.get_nowait()
+            except Queue.Empty:
+                break
+        for t in threads:
+            t.join()
+    return
+
+
+####################################################################
+#
+def makedirs(dirname):
+    """
+    Make the directory `dirname` (and any missing parents) unless it already
+    exists. Unlike os.makedirs() it is fine if someone else (another thread)
+    makes it at the same time.
+    """
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+####################################################################
+#
+def write_file_atomically(src, destination_fname, fsync=False,
+                          expected_size=None):
+    """
+    Copy the contents of the file-like object `src` to `destination_fname`.
+
+    We read `src` a chunk at a time in to a temporary file in the same
+    directory as `destination_fname` and then rename the temporary file in to
+    place. This way we never hold the whole file in memory and if we die
+    part way through we leave behind a dot-file that does not look like one of
+    our images instead of a truncated image.
+
+    Returns the number of bytes written. If that took long enough it goes
+    in the `profiler`'s slow log (for a download the time includes reading
+    the file from dropbox.)
+
+    If we were given an `expected_size` and read a different number of bytes
+    (because the connection was dropped part way through, say) the
+    temporary file is removed instead of being renamed in to place, so
+    there is never a truncated file at `destination_fname`, not even for a
+    moment. We still return how many bytes we read.
+
+    Arguments:
+    - `src`: A file-like object to read from
+    - `destination_fname`: The file to write to
+    - `fsync`: If True, fsync the file before renaming it in to place.
+    - `expected_size`: How many bytes `src` should have, if we know.
+    """
+    start = time.time()
+    fd, tmp_fname = tempfile.mkstemp(
+        dir=os.path.dirname(destination_fname),
+        prefix=".%s." % os.path.basename(destination_fname),
+        suffix=".part")
+    size = 0
+    try:
+        # mkstemp() creates the file readable only by us. Give it the
+        # permissions a plain open() would have.
+        #
+        os.fchmod(fd, 0666 & ~UMASK)
+        out = os.fdopen(fd, 'wb')
+        try:
+            while True:
+                chunk = src.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+                size += len(chunk)
+            out.flush()
+            if fsync:
+                os.fsync(out.fileno())
+        finally:
+            out.close()
+        if expected_size is not None and size != expected_size:
+            os.unlink(tmp_fname)
+        else:
+            os.rename(tmp_fname, destination_fname)
+    except:
+        if os.path.exists(tmp_fname):
+            os.unlink(tmp_fname)
+        raise
+    profiler.slow('write', time.time() - start, destination_fname)
+    return size
+
+
+####################################################################
+#
+def download_file(backend, src, destination_fname, fsync=False,
+                  expected_size=None):
+    """
+    Download a single file from dropbox and write it to `destination_fname`.
+    The file only appears at `destination_fname` once it has been completely
+    written.
+
+    Returns True if the file was downloaded and False if it no longer exists
+    in the dropbox. Any other error is raised. (Transient errors, including
+    getting a different number of bytes than dropbox says the file has, are
+    retried by the RetryingBackend we are given, if we are given one.)
+
+    Arguments:
+    - `backend`: The backend
+    - `src`: The full path of the file in the dropbox
+    - `destination_fname`: The file to write it to.
+    - `fsync`: If True, fsync the file before renaming it in to place.
+    - `expected_size`: The size the listing of the folder said the file is.
+    """
+    try:
+        backend.download_to(src, destination_fname, fsync, expected_size)
+        return True
+    except BackendError, e:
+        # It is okay if this file does not exist (means that it
+        # was deleted before we could get to copying it..)
+        #
+        if e.status == 404:
+            return False
+        raise
+
+
+####################################################################
+#
+def download_path(dest_dir, fname):
+    """
+    Return where we download the file `fname` to:
+
+    <dest_dir>/<yyyy>/<yyyy-mm-dd>/<fname>
+
+    Arguments:
+    - `dest_dir`: The root destination directory
+    - `fname`: The file name. It must match DATE_FNAME_re.
+    """
+    return os.path.join(dest_dir, fname[:4], fname[:10], fname)
+
+
+####################################################################
+#
+def download_new_files(backend, db_folder, dest_dir, files, when, dry_run,
+                       workers=1, backend_factory=None, fsync=False,
+                       index=None, limit=0, journal=None,
+                       downloaded=None):
+    """
+    Download all of the files in the db_folder that are newer than 'when' that
+    match our download pattern.
+
+    If `workers` is more than 1 then that many files are downloaded at the
+    same time, each by a different backend (gotten from `backend_factory`.) We
+    still report on the files in the same order we would have downloaded them
+    in one at a time.
+
+    Arguments:
+    - `backend`: The backend
+    - `db_folder`: Dropbox folder we are downloading from
+    - `dest_dir`: The root destination directory to copy the files in to. The
+                  sub-directory for the year, month, and day will be created
+                  as necessary.
+    - `files`: Use this list of files (or Listing) to decide what to download
+    - `when`: An arrow timestamp (or seconds since the epoch.) Download all
+              files that were created after this timestamp.
+    - `dry_run`: a boolean. If true then no actual actions are performed
+    - `workers`: The number of files to download at the same time.
+    - `backend_factory`: A callable that returns a new backend. Only
+                         needed if `workers` is more than 1.
+    - `fsync`: If True, fsync each file before renaming it in to place.
+    - `index`: A DownloadIndex. Files we have already downloaded are skipped
+               and every file we download is added to it.
+    - `limit`: If not 0, download at most this many files (the oldest ones)
+               and leave the rest for next time.
+    - `journal`: A Journal to record what we are about to do, and have done,
+                 in.
+    - `downloaded`: A callable called with the name of each file we download
+                    and where we put it.
+    """
+
+    # Going through the list of files only download ones that are after 'when'
+    # and conform to our file name pattern.
+    #
+    if not isinstance(files, Listing):
+        files = Listing(files)
+
+    to_download = []
+    for fname in files.newer_than(when):
+        # And skip files we already have.
+        #
+        if index is not None and fname in index:
+            continue
+
+        # If we have a copy that is the same size as the one in dropbox (but
+        # our index did not know about it) we do not need to download it
+        # again.
+        #
+        if have_frame(dest_dir, files, fname):
+            print "Already have %s" % fname
+            metrics.inc('webcam_files_already_had_total')
+            if index is not None and not dry_run:
+                index.add(fname, files.size(fname), files.rev(fname))
+            continue
+
+        destination_fname = download_path(dest_dir, fname)
+        destination_dir = os.path.dirname(destination_fname)
+
+        # Wen doing a dry-run do not actually download the file.
+        #
+        if dry_run:
+            print "Downloading %s to %s" % (fname, destination_fname)
+            continue
+
+        # Make sure the destination directory exists.
+        #
+        makedirs(destination_dir)
+
+        to_download.append((fname, destination_fname))
+        if limit and len(to_download) >= limit:
+            break
+
+    def fetch(backend, item):
+        fname, destination_fname = item
+        return download_file(backend, os.path.join(db_folder, fname),
+                             destination_fname, fsync, files.size(fname))
+
+    if journal is not None:
+        journal.plan('download', [fname for fname, dest in to_download])
+
+    if workers > 1:
+        results = run_worker_pool(fetch, to_download, workers,
+                                  backend_factory)
+    else:
+        results = run_worker_pool(fetch, to_download, 1, lambda: backend)
+
+    for (fname, destination_fname), found, exc in results:
+        print "Downloading %s to %s" % (fname, destination_fname)
+        if exc is not None:
+            raise exc
+        # Make sure the index knows about the file before the journal
+        # forgets about it. The index is committed every so many files, not
+        # after each one, so we tell the journal once it has been.
+        #
+        done = None
+        if journal is not None:
+            done = functools.partial(journal.done, 'download', fname)
+        if found:
+            print "** Done downloading %s" % fname
+            metrics.inc('webcam_files_downloaded_total')
+            if index is not None:
+                index.add(fname, files.size(fname), files.rev(fname), done)
+                done = None
+            if downloaded is not None:
+                downloaded(fname, destination_fname)
+        else:
+            print "** File '%s' was deleted from the dropbox before we " \
+                "could download it" % fname
+            metrics.inc('webcam_not_found_total', phase='download')
+        if done is not None:
+            done()
+    if index is not None:
+        index.commit()
+    return
+
+
+####################################################################
+#
+def missing_files(remote, local):
+    """
+    Return the names in `remote` that are not in `local`, in order.
+
+    Both lists must be sorted oldest first. Since our file names sort the
+    same way as the times in them this is a single pass over both lists
+    instead of a lookup in the index for every file in the dropbox folder.
+
+    Arguments:
+    - `remote`: The sorted names of the files in the dropbox folder
+    - `local`: The sorted names of the files we have downloaded
+    """
+    missing = []
+    i = 0
+    n_local = len(local)
+    for fname in remote:
+        while i < n_local and local[i] < fname:
+            i += 1
+        if i == n_local or local[i] != fname:
+            missing.append(fname)
+    return missing
+
+
+####################################################################
+#
+def backfill_files(backend, db_folder, dest_dir, files, index, start, end,
+                   dry_run, workers=1, backend_factory=None, fsync=False,
+                   journal=None):
+    """
+    Download the files in the dropbox folder created from `start` to `end`
+    that we do not have, no matter how old they are.
+
+    download_new_files() only looks at files newer than the latest one we
+    have, so a file that shows up late (or that we got an error downloading)
+    is otherwise never downloaded.
+
+    Arguments:
+    - `backend`: The backend
+    - `db_folder`: The dropbox folder we are operating in
+    - `dest_dir`: The root destination directory to copy the files in to.
+    - `files`: The list (or Listing) of the files in the dropbox folder
+    - `index`: The DownloadIndex of the files we have downloaded.
+    - `start`: Only look at files created at or after this time (an arrow
+               timestamp or seconds since the epoch)
+    - `end`: Only look at files created at or before this time
+    - `dry_run`: If True print what we would download but do not do it.
+    - `workers`: The number of files to download at the same time.
+    - `backend_factory`: A callable that returns a new backend. Only
+                         needed if `workers` is more than 1.
+    - `fsync`: If True, fsync each file before renaming it in to place.
+    - `journal`: A Journal to record what we are about to do, and have done,
+                 in.
+    """
+    if not isinstance(files, Listing):
+        files = Listing(files)
+    missing = missing_files(files.between(start, end),
+                            index.names_between(start, end))
+    print "** Backfilling %d missing files" % len(missing)
+    metrics.inc('webcam_backfilled_files_total', len(missing))
+    if missing:
+        download_new_files(backend, db_folder, dest_dir,
+                           Listing(missing, files.meta), 0, dry_run,
+                           workers=workers, backend_factory=backend_factory,
+                           fsync=fsync, index=index, journal=journal)
+    return len(missing)
+
+
+####################################################################
+#
+def import_image_modules():
+    """
+    Import PIL and multiprocessing (in to our globals), which only
+    '--dedupe' and recompressing old frames (see RetentionPolicy) need.
+    Returns False if PIL is not installed.
+    """
+    global Image, multiprocessing
+    if Image is None:
+        try:
+            from PIL import Image
+        except ImportError:
+            return False
+        import multiprocessing
+    return True
+
+
+####################################################################
+#
+def import_dedupe_modules():
+    """
+    Import numpy, as well as PIL and multiprocessing (in to our globals),
+    which only '--dedupe' needs. Returns False if numpy or PIL is not
+    installed.
+    """
+    global numpy
+    if not import_image_modules():
+        return False
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+    return True
+
+
+####################################################################
+#
+def frame_thumbnail(fname, size=DEDUPE_THUMBNAIL_SIZE):
+    """
+    Return a `size` by `size` grayscale thumbnail of the image `fname` as a
+    numpy array, or None if we can not decode it.
+
+    This is run in a FrameDeduper's worker processes.
+    """
+    import_dedupe_modules()
+    try:
+        img = Image.open(fname)
+        # Let the JPEG decoder scale the image down while it decodes it,
+        # which is much faster than decoding all of it.
+        #
+        img.draft("L", (size * 4, size * 4))
+        img = img.convert("L").resize((size, size), Image.BILINEAR)
+        return numpy.asarray(img, dtype=numpy.int16)
+    except (IOError, ValueError):
+        return None
+
+
+####################################################################
+#
+def skipped_frames(skipped_fname):
+    """
+    Yield the names of the frames a FrameDeduper decided not to keep, as
+    recorded in `skipped_fname`.
+    """
+    if not os.path.exists(skipped_fname):
+        return
+    with open(skipped_fname, "rb") as f:
+        for line in f:
+            if line.endswith("\n"):
+                yield line.split("\t", 1)[0]
+
+
+##################################################################
+##################################################################
+#
+class FrameDeduper(object):
+    """
+    The camera uploads a frame every time it is triggered and most frames
+    look just like the one before them (nothing is moving, or it is dark.)
+    A FrameDeduper throws away the frames we download that are nearly the
+    same as the last frame we kept.
+
+    Each downloaded frame is handed to `add()`, which starts decoding it in
+    to a small grayscale thumbnail in a pool of worker processes, so decoding
+    does not hold up downloading. `finish()` then goes through the frames in
+    order comparing each thumbnail with the last kept one. If the mean
+    difference between their pixels is less than `threshold` (as a fraction
+    of the full range) the frame is deleted and a line saying which kept frame
+    it duplicates is added to `skipped_fname`.
+
+    The skipped frames stay in our DownloadIndex so we do not download them
+    again.
+
+    NOTE: This needs numpy and PIL (or Pillow.)
+    """
+
+    ##################################################################
+    #
+    def __init__(self, skipped_fname, threshold, workers=2,
+                 last_kept_fname=None):
+        """
+        Arguments:
+        - `skipped_fname`: The file we record the frames we skip in.
+        - `threshold`: Frames whose mean pixel difference from the last kept
+                       frame is less than this fraction are skipped.
+        - `workers`: How many processes decode frames.
+        - `last_kept_fname`: The local file of the last frame we kept, if we
+                             have one, to compare the first new frame with.
+        """
+        self.skipped_fname = skipped_fname
+        self.threshold = threshold
+        self.workers = workers
+        self.pool = None
+        self.pending = []
+        self.last_kept = None
+        self.last_kept_fname = None
+        import_dedupe_modules()
+        if last_kept_fname is not None and os.path.exists(last_kept_fname):
+            self.last_kept = frame_thumbnail(last_kept_fname)
+            self.last_kept_fname = os.path.basename(last_kept_fname)
+
+    ##################################################################
+    #
+    def add(self, fname, local_fname):
+        """
+        Start working out if we should keep the frame `fname` that we just
+        downloaded to `local_fname`.
+        """
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        self.pending.append((fname, local_fname,
+                             self.pool.apply_async(frame_thumbnail,
+                                                   (local_fname,))))
+
+    ##################################################################
+    #
+    def finish(self):
+        """
+        Decide which of the frames given to `add()` to keep, deleting the
+        rest. Returns a tuple of how many frames we kept and how many we
+        skipped.
+        """
+        pending = sorted(self.pending)
+        self.pending = []
+        kept = 0
+        skipped = []
+        for fname, local_fname, result in pending:
+            thumbnail = result.get()
+            if thumbnail is not None and self.last_kept is not None:
+                diff = numpy.abs(thumbnail - self.last_kept).mean() / 255.0
+                if diff < self.threshold:
+                    os.unlink(local_fname)
+                    skipped.append("%s\t%s\t%.4f\n" %
+                                   (fname, self.last_kept_fname, diff))
+                    continue
+            kept += 1
+            if thumbnail is not None:
+                self.last_kept = thumbnail
+                self.last_kept_fname = fname
+
+        if skipped:
+            with open(self.skipped_fname, "ab") as f:
+                f.write("".join(skipped))
+        metrics.inc('webcam_frames_kept_total', kept)
+        metrics.inc('webcam_frames_skipped_total', len(skipped))
+        print "** Kept %d new frames, skipped %d that had not changed" % \
+            (kept, len(skipped))
+        return kept, len(skipped)
+
+    ##################################################################
+    #
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+####################################################################
+#
+def delete_file(backend, db_folder, fname):
+    """
+    Delete `fname` from the dropbox folder `db_folder`.
+
+    Returns True if the file was deleted and False if it was already gone.
+
+    Arguments:
+    - `backend`: The backend
+    - `db_folder`: The dropbox folder we are deleting the file from
+    - `fname`: The file to delete
+    """
+    try:
+        backend.delete(os.path.join(db_folder, fname))
+    except BackendError, e:
+        # It is okay if this file does not exist..
+        #
+        if e.status != 404:
+            raise e
+        return False
+    return True
+
+
+####################################################################
+#
+def delete_old_files(backend, db_folder, files, expiry, dry_run, workers=1,
+                     backend_factory=None, journal=None):
+    """
+    In the given dropbox folder delete all files that match our download file
+    pattern whose creation time is older than 'now-expiry'
+
+    NOTE: We only consider files that are in our 'files' array. We expect the
+    calls to be close enough together that there is no real reason to make an
+    additional call to Dropbox to get the list of files.
+
+    And if we do not delete some files this run that we delete on the next run
+    that is fine anyways.
+
+    We are going to use the file's name as the determination of its creation
+    time. We can do this because we have renamed all the files we care about to
+    have this name format.
+
+    This also makes sure that we are only deleting files that we actually want
+    to delete.
+
+    If `workers` is more than 1 then that many files are deleted at the same
+    time, each by a different backend (gotten from `backend_factory`.)
+
+    Arguments:
+    - `backend`: The backend
+    - `db_folder`: The dropbox folder we are deleting files from
+    - `files`: The list (or Listing) of all the files we are going to consider
+    - `expiry`: An arrow timestamp (or seconds since the epoch) that the files
+                must be older than in order to be considered for deletion.
+    - `dry_run`: a boolean. If true then no actual actions are performed
+    - `workers`: The number of files to delete at the same time.
+    - `backend_factory`: A callable that returns a new backend. Only
+                         needed if `workers` is more than 1.
+    - `journal`: A Journal to record what we are about to do, and have done,
+                 in.
+    """
+    # Going through the list of files only delete ones that are before 'expiry'
+    # and conform to our file name pattern.
+    #
+    if not isinstance(files, Listing):
+        files = Listing(files)
+    to_delete = files.not_newer_than(expiry)
+
+    if dry_run:
+        for fname in to_delete:
+            print "** Deleting file '%s'" % fname
+        return
+
+    def delete(backend, fname):
+        return delete_file(backend, db_folder, fname)
+
+    if workers <= 1:
+        backend_factory = lambda: backend
+
+    if journal is not None:
+        journal.plan('delete', to_delete)
+
+    deleted = 0
+    missing = 0
+    for fname, found, exc in run_worker_pool(delete, to_delete, workers,
+                                             backend_factory):
+        print "** Deleting file '%s'" % fname
+        if exc is not None:
+            raise exc
+        if journal is not None:
+            journal.done('delete', fname)
+        if found:
+            deleted += 1
+            metrics.inc('webcam_files_deleted_total')
+        else:
+            missing += 1
+            metrics.inc('webcam_not_found_total', phase='delete')
+    if deleted or missing:
+        print "** Deleted %d files, %d were already gone" % (deleted, missing)
+    return
+
+
+# The counter run_pipeline() bumps for each kind of thing it does.
+#
+PIPELINE_COUNTERS = {'rename': 'webcam_files_renamed_total',
+                     'download': 'webcam_files_downloaded_total',
+                     'delete': 'webcam_files_deleted_total'}
+
+
+####################################################################
+#
+def run_pipeline(backend, db_folder, dest_dir, files, when, expiry, delete,
+                 download_workers=1, mutation_workers=1,
+                 backend_factory=None, fsync=False, index=None,
+                 stop=None, queue_size=100, journal=None, downloaded=None,
+                 limit=0):
+    """
+    Rename, download, and delete files all at the same time, instead of
+    running rename_dropbox_files(), download_new_files(), and
+    delete_old_files() one after the other.
+
+    The renaming stage hands each file it renames straight to the download
+    stage (through a bounded queue, so it can not get too far ahead) and the
+    delete stage starts deleting old files right away. Files that were
+    already date named are fed to the download stage by their own thread, so
+    after an outage a big backlog of them does not hold up renaming (and
+    downloading) the files that have just been uploaded. Files that need to be
+    downloaded before they are deleted are handed to the delete stage once
+    they have been downloaded.
+
+    All the reporting (and updating the index) is done in this thread. If any
+    stage gets an error we stop all of them and raise it here (without
+    setting `stop`.) If `stop` is set (because we got a SIGTERM, say) every
+    stage stops after what it is doing right now.
+
+    Returns True if `limit` kept us from downloading all the new files.
+
+    Arguments:
+    - `backend`: The backend
+    - `db_folder`: The dropbox folder we are operating in
+    - `dest_dir`: The root destination directory to copy the files in to.
+    - `files`: The list (or Listing) of the files in the dropbox folder
+    - `when`: Download all files created after this time (an arrow timestamp
+              or seconds since the epoch)
+    - `expiry`: Delete all files created before this time (an arrow timestamp
+                or seconds since the epoch)
+    - `delete`: If False we do not delete any files.
+    - `download_workers`: The number of files to download at the same time.
+    - `mutation_workers`: The number of files to rename (or delete) at the
+                          same time.
+    - `backend_factory`: A callable that returns a new backend. Every
+                         worker gets its own backend.
+    - `fsync`: If True, fsync each file before renaming it in to place.
+    - `index`: A DownloadIndex. Files we have already downloaded are skipped
+               and every file we download is added to it.
+    - `stop`: A threading.Event. When it is set we stop.
+    - `queue_size`: How many files can be waiting to be downloaded (or
+                    deleted.)
+    - `journal`: A Journal to record what we are about to do, and have done,
+                 in.
+    - `downloaded`: A callable called with the name of each file we download
+                    and where we put it.
+    - `limit`: If not 0, download at most this many files (the oldest ones,
+               whether they are being renamed or not) and leave the rest for
+               next time.
+    """
+    if not isinstance(files, Listing):
+        files = Listing(files)
+    if backend_factory is None:
+        backend_factory = lambda: backend
+    if stop is None:
+        stop = threading.Event()
+    when = epoch(when)
+    expiry = epoch(expiry)
+
+    download_q = Queue.Queue(queue_size)
+    delete_q = Queue.Queue(queue_size)
+    results = Queue.Queue()
+    errors = []
+
+    # An error in one stage stops all of them, but `stop` belongs to our
+    # caller (and in the main loop, to every camera) so we have our own.
+    #
+    failed = threading.Event()
+
+    def stopping():
+        return failed.is_set() or stop.is_set()
+
+    # The index can only be used from this thread so work out which of the
+    # already date named files we need to download before we start.
+    #
+    to_download = []
+    for fname in files.newer_than(when):
+        if index is not None and fname in index:
+            continue
+        if have_frame(dest_dir, files, fname):
+            print "Already have %s" % fname
+            metrics.inc('webcam_files_already_had_total')
+            if index is not None:
+                index.add(fname, files.size(fname), files.rev(fname))
+            continue
+        to_download.append(fname)
+
+    # If we can only download some of the new files this run they have to be
+    # the oldest ones, counting the ones we are about to rename, or the ones
+    # we leave behind would be older than the latest file we have and never
+    # get downloaded. None means every renamed file that is new enough.
+    #
+    limited = False
+    to_download_renamed = None
+    renamed = [new_fname for fname, new_fname in files.to_rename
+               if fname_timestamp(new_fname) > when]
+    if limit and len(to_download) + len(renamed) > limit:
+        limited = True
+        allowed = set(sorted(to_download + renamed)[:limit])
+        to_download = [fname for fname in to_download if fname in allowed]
+        to_download_renamed = allowed
+
+    # The old files we can delete right away are the ones that we had
+    # already downloaded before we started. The rest have to wait until we
+    # have downloaded them.
+    #
+    to_delete = files.not_newer_than(min(when, expiry)) if delete else []
+
+    if journal is not None:
+        journal.plan('rename', files.to_rename)
+        journal.plan('download', to_download)
+        journal.plan('delete', to_delete)
+
+    def put(q, item):
+        """
+        Put `item` on the queue `q`, waiting while it is full, unless we are
+        told to stop. Returns False if we stopped.
+        """
+        while not stopping():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(q):
+        """
+        Get the next item from the queue `q`. Returns None if we stopped.
+        """
+        while not stopping():
+            try:
+                return q.get(timeout=0.5)
+            except Queue.Empty:
+                pass
+        return None
+
+    def fail(e):
+        errors.append(e)
+        failed.set()
+
+    def download_feeder():
+        for fname in to_download:
+            if not put(download_q, fname):
+                return
+
+    def renamer():
+        try:
+            for (fname, new_fname), found, exc in run_worker_pool(
+                    lambda b, item: move_file(b, db_folder, *item),
+                    files.to_rename, mutation_workers, backend_factory):
+                if exc is not None:
+                    raise exc
+                results.put(('rename', fname, new_fname, found))
+                if (found and fname_timestamp(new_fname) > when and
+                        (to_download_renamed is None or
+                         new_fname in to_download_renamed)):
+                    if journal is not None:
+                        journal.plan('download', [new_fname])
+                    if not put(download_q, new_fname):
+                        return
+                if stopping():
+                    return
+        except Exception, e:
+            fail(e)
+        finally:
+            # The downloaders stop when both we and the download feeder are
+            # done.
+            #
+            download_feeder_thread.join()
+            for i in range(download_workers):
+                put(download_q, None)
+
+    def downloader():
+        try:
+            b = backend_factory()
+            while True:
+                fname = get(download_q)
+                if fname is None:
+                    return
+                destination_fname = download_path(dest_dir, fname)
+                makedirs(os.path.dirname(destination_fname))
+                found = download_file(b, os.path.join(db_folder, fname),
+                                      destination_fname, fsync,
+                                      files.size(fname))
+                results.put(('download', fname, destination_fname, found))
+        except Exception, e:
+            fail(e)
+        finally:
+            results.put(('done',))
+
+    def delete_feeder():
+        for fname in to_delete:
+            if not put(delete_q, fname):
+                return
+
+    def deleter():
+        try:
+            b = backend_factory()
+            while True:
+                fname = get(delete_q)
+                if fname is None:
+                    return
+                results.put(('delete', fname, delete_file(b, db_folder,
+                                                          fname)))
+        except Exception, e:
+            fail(e)
+
+    def start(target, name):
+        t = threading.Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+        return t
+
+    download_feeder_thread = start(download_feeder, "download-feeder")
+    renamer_thread = start(renamer, "renamer")
+    downloaders = [start(downloader, "downloader-%d" % i)
+                   for i in range(download_workers)]
+    feeder_thread = None
+    deleters = []
+    if delete:
+        feeder_thread = start(delete_feeder, "delete-feeder")
+        deleters = [start(deleter, "deleter-%d" % i)
+                    for i in range(mutation_workers)]
+
+    counts = {'rename': 0, 'download': 0, 'delete': 0}
+
+    def report(result):
+        kind = result[0]
+        done = None
+        if journal is not None and kind in Journal.OPS:
+            done = functools.partial(journal.done, kind, result[1])
+        if kind == 'rename':
+            fname, new_fname, found = result[1:]
+            print "Renaming '%s' to '%s'" % (fname, new_fname)
+            if not found:
+                print "File '%s' was deleted before we could rename it" % \
+                    fname
+        elif kind == 'download':
+            fname, destination_fname, found = result[1:]
+            print "Downloading %s to %s" % (fname, destination_fname)
+            if found:
+                print "** Done downloading %s" % fname
+                # The journal is told the download is done once the index
+                # has been committed with it in it (see download_new_files.)
+                #
+                if index is not None:
+                    index.add(fname, files.size(fname), files.rev(fname),
+                              done)
+                    done = None
+                if downloaded is not None:
+                    downloaded(fname, destination_fname)
+            else:
+                print "** File '%s' was deleted from the dropbox before we " \
+                    "could download it" % fname
+            if delete and fname_timestamp(fname) <= expiry:
+                if journal is not None:
+                    journal.plan('delete', [fname])
+                put(delete_q, fname)
+        elif kind == 'delete':
+            fname, found = result[1:]
+            print "** Deleting file '%s'" % fname
+        else:
+            return
+        if done is not None:
+            done()
+        if found:
+            counts[kind] += 1
+            metrics.inc(PIPELINE_COUNTERS[kind])
+        else:
+            metrics.inc('webcam_not_found_total', phase=kind)
+
+    # Report on what the stages are doing until all the downloaders are
+    # done. The deleters may still be working on files after that.
+    #
+    done = 0
+    while done < len(downloaders):
+        try:
+            result = results.get(timeout=0.5)
+        except Queue.Empty:
+            continue
+        if result[0] == 'done':
+            done += 1
+        else:
+            report(result)
+
+    renamer_thread.join()
+    if feeder_thread is not None:
+        feeder_thread.join()
+    for t in deleters:
+        put(delete_q, None)
+    for t in deleters:
+        t.join()
+    while not results.empty():
+        report(results.get())
+    if index is not None:
+        index.commit()
+
+    print "** Renamed %d, downloaded %d, and deleted %d files" % \
+        (counts['rename'], counts['download'], counts['delete'])
+    if errors:
+        raise errors[0]
+    return limited
+
+
+##################################################################
+##################################################################
+#
+class FrameCache(object):
+    """
+    The last few frames we downloaded for a camera, kept in memory so that
+    the frame server can hand out the latest frame (which is what nearly
+    everything asks for) without touching the disk.
+
+    It holds the `size` newest frames, by name. It is safe to use from
+    several threads at once.
+
+    NOTE: A frame '--dedupe' decides not to keep stays in the cache until
+          newer frames push it out.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, size=16):
+        """
+        Arguments:
+        - `size`: The most frames we keep
+        """
+        self.size = size
+        self.lock = threading.Lock()
+        self.names = []
+        self.frames = {}
+
+    ##################################################################
+    #
+    def add(self, fname, data):
+        """
+        Remember the frame `fname`, whose contents are `data`.
+        """
+        with self.lock:
+            if fname not in self.frames:
+                bisect.insort(self.names, fname)
+            self.frames[fname] = data
+            while len(self.names) > self.size:
+                del self.frames[self.names.pop(0)]
+
+    ##################################################################
+    #
+    def get(self, fname):
+        """
+        Return the contents of the frame `fname`, or None if we do not have
+        it.
+        """
+        with self.lock:
+            return self.frames.get(fname)
+
+    ##################################################################
+    #
+    def latest(self):
+        """
+        Return a tuple of the name and contents of the newest frame we have,
+        or None if we have none.
+        """
+        with self.lock:
+            if not self.names:
+                return None
+            return self.names[-1], self.frames[self.names[-1]]
+
+    ##################################################################
+    #
+    def names_between(self, start, end):
+        """
+        Return the names of the frames we have that were created from
+        `start` to `end` (inclusive, in seconds since the epoch.)
+        """
+        with self.lock:
+            return [fname for fname in self.names
+                    if start <= fname_timestamp(fname) <= end]
+
+
+####################################################################
+#
+def find_sendfile():
+    """
+    Return a function like os.sendfile() (python 3.3 and later have it, and
+    the pysendfile module gives python 2 one) that copies from a file to a
+    socket without the data passing through us, or None if we do not have
+    one.
+    """
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is None:
+        try:
+            from sendfile import sendfile
+        except ImportError:
+            pass
+    return sendfile
+
+
+####################################################################
+#
+def open_frame(data_dirname, fname):
+    """
+    Open our copy of the frame `fname`, whether it is still a file of its
+    own or has been packed. Returns a tuple of the open file, where in it
+    the frame starts, and how long it is, or None if we do not have it.
+
+    Arguments:
+    - `data_dirname`: The data directory we download files in to.
+    - `fname`: The file name. It must match DATE_FNAME_re.
+    """
+    try:
+        f = open(download_path(data_dirname, fname), "rb")
+        return f, 0, os.fstat(f.fileno()).st_size
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    pack_fname = pack_path(data_dirname, fname[:10])
+    if not os.path.exists(pack_fname):
+        return None
+    pack = PackFile(pack_fname)
+    try:
+        if fname not in pack:
+            return None
+        offset, length = pack.frames[fname]
+    finally:
+        pack.close()
+    return open(pack_fname, "rb"), offset, length
+
+
+##################################################################
+##################################################################
+#
+class FrameHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves each camera's frames, and lists of them, to dashboards:
+
+    /                          The names of our cameras (JSON)
+    /<camera>/latest           The newest frame
+    /<camera>/<yyyy-mm-dd>/    The names of the frames from that day (JSON)
+    /<camera>/<yyyy-mm-dd>/<frame name>
+                               That frame
+    /<camera>/frames?start=<s>&end=<s>
+                               The names of the frames from `start` to `end`
+                               (in seconds since the epoch, JSON)
+
+    The latest frame comes from the camera's FrameCache. Other frames are
+    sent from the disk (or their pack file), with sendfile if we have it.
+    Lists come from the camera's index, plus whatever is in its FrameCache
+    that the index has not been committed with yet. None of these scan the
+    download directory or talk to dropbox.
+
+    Every response has an ETag (and frames a Last-Modified) and we answer
+    conditional GETs with a 304 when nothing has changed.
+    """
+
+    ##################################################################
+    #
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        parts = [urllib.unquote(p) for p in path.split("/")[1:]]
+        if parts == [""]:
+            self.send_json(sorted(self.server.cameras))
+            return
+        camera = self.server.cameras.get(parts[0])
+        if camera is None:
+            self.send_error(404)
+            return
+
+        if parts[1:] == ["latest"]:
+            self.send_latest(camera)
+        elif parts[1:] == ["frames"]:
+            args = urlparse.parse_qs(query)
+            try:
+                start = int(args.get('start', ["0"])[0])
+                end = int(args.get('end', [str(sys.maxint)])[0])
+            except ValueError:
+                self.send_error(400)
+                return
+            self.send_json(self.frame_names(camera, start, end))
+        elif (len(parts) == 3 and DAY_re.match(parts[1]) is not None and
+              parts[2] == ""):
+            try:
+                start = calendar.timegm(time.strptime(parts[1], "%Y-%m-%d"))
+            except ValueError:
+                # Looks like a day, but is not one (2013-13-45, say.)
+                #
+                self.send_error(404)
+                return
+            self.send_json(self.frame_names(camera, start,
+                                            start + 24 * 60 * 60 - 1))
+        elif (len(parts) == 3 and DATE_FNAME_re.match(parts[2]) is not None
+              and parts[2][:10] == parts[1]):
+            self.send_frame(camera, parts[2])
+        else:
+            self.send_error(404)
+
+    ##################################################################
+    #
+    def frame_names(self, camera, start, end):
+        """
+        Return the names of the frames `camera` has from `start` to `end`.
+        """
+        names = set(camera.frame_cache.names_between(start, end))
+        if os.path.exists(camera.index_fname):
+            index = DownloadIndex(camera.index_fname, read_only=True)
+            try:
+                names.update(index.names_between(start, end))
+            finally:
+                index.close()
+        return sorted(names)
+
+    ##################################################################
+    #
+    def not_modified(self, etag, last_modified=None):
+        """
+        If the client already has the version of what it asked for that has
+        `etag` (or that was last modified at `last_modified`) send a 304 and
+        return True.
+        """
+        if_none_match = self.headers.getheader("If-None-Match")
+        if if_none_match is not None:
+            match = (if_none_match.strip() == "*" or
+                     etag in [t.strip() for t in if_none_match.split(",")])
+        else:
+            since = self.headers.getheader("If-Modified-Since")
+            since = since and email.utils.parsedate_tz(since)
+            match = (since is not None and last_modified is not None and
+                     last_modified <= email.utils.mktime_tz(since))
+        if not match:
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return True
+
+    ##################################################################
+    #
+    def send_json(self, value):
+        body = json.dumps(value)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.not_modified(etag):
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    ##################################################################
+    #
+    def send_frame_headers(self, fname, length, cache_control):
+        """
+        Send the headers for the frame `fname`, which is `length` bytes
+        long, unless the client already has it. Return True if we did (and
+        the frame itself should follow.)
+        """
+        etag = '"%s-%d"' % (fname[:-4], length)
+        last_modified = fname_timestamp(fname)
+        if self.not_modified(etag, last_modified):
+            return False
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(last_modified))
+        self.send_header("Cache-Control", cache_control)
+        self.send_header("X-Frame-Name", fname)
+        self.end_headers()
+        return True
+
+    ##################################################################
+    #
+    def send_latest(self, camera):
+        latest = camera.frame_cache.latest()
+        if latest is None:
+            # We have not downloaded anything since we started. Get the
+            # newest frame we have from the disk, once.
+            #
+            fname = None
+            if os.path.exists(camera.index_fname):
+                index = DownloadIndex(camera.index_fname, read_only=True)
+                try:
+                    fname = index.latest()
+                finally:
+                    index.close()
+            data = fname and read_frame(camera.dest_dir, fname)
+            if data is None:
+                self.send_error(404)
+                return
+            camera.frame_cache.add(fname, data)
+            latest = fname, data
+        fname, data = latest
+        if self.send_frame_headers(fname, len(data), "no-cache"):
+            self.wfile.write(data)
+
+    ##################################################################
+    #
+    def send_frame(self, camera, fname):
+        data = camera.frame_cache.get(fname)
+        if data is not None:
+            if self.send_frame_headers(fname, len(data), "max-age=86400"):
+                self.wfile.write(data)
+            return
+
+        frame = open_frame(camera.dest_dir, fname)
+        if frame is None:
+            self.send_error(404)
+            return
+        f, offset, length = frame
+        try:
+            if not self.send_frame_headers(fname, length, "max-age=86400"):
+                return
+            self.wfile.flush()
+            sendfile = self.server.sendfile
+            if sendfile is not None:
+                out = self.connection.fileno()
+                while length > 0:
+                    sent = sendfile(out, f.fileno(), offset, length)
+                    if sent == 0:
+                        break
+                    offset += sent
+                    length -= sent
+            else:
+                f.seek(offset)
+                while length > 0:
+                    chunk = f.read(min(length, DOWNLOAD_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    length -= len(chunk)
+        finally:
+            f.close()
+
+    ##################################################################
+    #
+    def log_message(self, format, *args):
+        # Dashboards poll a lot. Do not log every request.
         #
-        fname = str(fname)
-        if DATE_FNAME_re.search(fname) is None:
-            continue
+        pass
+
+
+##################################################################
+##################################################################
+#
+class FrameServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server that answers each request in its own thread, so a slow
+    client does not hold up the others, and knows about our cameras.
+    """
+    daemon_threads = True
+
+    ##################################################################
+    #
+    def __init__(self, address, cameras):
+        """
+        Arguments:
+        - `address`: The (host, port) to listen on
+        - `cameras`: The Cameras whose frames we serve
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, FrameHandler)
+        self.cameras = dict((camera.name, camera) for camera in cameras)
+        self.sendfile = find_sendfile()
+
+
+####################################################################
+#
+def start_frame_server(host, port, cameras):
+    """
+    Serve the frames of `cameras` on http://<host>:<port>/ (see
+    FrameHandler) from a background thread. Returns the server.
+
+    Arguments:
+    - `host`: The address to listen on
+    - `port`: The port to listen on
+    - `cameras`: The Cameras whose frames we serve
+    """
+    server = FrameServer((host, port), cameras)
+    t = threading.Thread(target=server.serve_forever, name="frames")
+    t.daemon = True
+    t.start()
+    return server
+
+
+##################################################################
+##################################################################
+#
+class Camera(object):
+    """
+    A dropbox folder we are watching, the directory we download its images
+    to, and everything we remember about it from one run to the next.
 
-        # Only download files that were created after 'when'
+    `run_once()` does one run of the three tasks (rename, download, delete)
+    for this camera.
+
+    What we need to decide a run can be skipped (the folder's hash and when
+    our latest image was taken) is kept in a small state file, so when we
+    are run from cron with '--one_run' and nothing has changed we can tell
+    with one cheap call to dropbox, without even opening our index (see
+    `quick_check()`.) Everything else is only opened, by `open()`, once we
+    know there is work to do.
+    """
+
+    ##################################################################
+    #
+    def __init__(self, name, dropbox_folder, dest_dir, expiry, scheduler,
+                 options, index_fname=None, delta_state=None,
+                 journal_fname=None, state_fname=None, retention=None):
+        """
+        Arguments:
+        - `name`: What we call this camera
+        - `dropbox_folder`: The dropbox folder the camera uploads images to
+        - `dest_dir`: The directory we download its images to
+        - `expiry`: How many days we leave images in the dropbox folder
+        - `scheduler`: The PollScheduler that decides when we run next
+        - `options`: The rest of our command line options (as parsed by
+                     docopt)
+        - `index_fname`: The index of files we have downloaded. Defaults
+                         to '.webcam_index.sqlite' in `dest_dir`.
+        - `delta_state`: Where we keep what we know about the dropbox folder
+                         in '--incremental' mode. Defaults to
+                         '.webcam_delta.json' in `dest_dir`.
+        - `journal_fname`: The journal of what we are about to do. Defaults
+                           to '.webcam_journal' in `dest_dir`.
+        - `state_fname`: Where we keep the folder's hash and the time of our
+                         latest image between runs. Defaults to
+                         '.webcam_state.json' in `dest_dir`.
+        - `retention`: How we keep the images we have downloaded as they
+                       get older (see RetentionPolicy), or None to keep
+                       them as they are forever.
+        """
+        self.name = name
+        self.dropbox_folder = dropbox_folder
+        self.dest_dir = dest_dir
+        self.expiry = expiry
+        self.scheduler = scheduler
+        self.options = options
+        self.download_workers = int(options['--download_workers'])
+        self.mutation_workers = int(options['--mutation_workers'])
+        self.verify_every = int(options['--verify_every'])
+        self.max_files = int(options['--max_files_per_run'])
+        self.pipeline = options['--pipeline'] and not options['--dry_run']
+        self.queue_size = int(options['--queue_size'])
+        self.backfill_interval = int(options['--backfill_interval'])
+        self.listing_limit = int(options['--listing_limit'])
+        self.compact = options['--compact'] and not options['--dry_run']
+        self.keep_loose_days = int(options['--keep_loose_days'])
+        self.max_listing = int(options['--max_listing'])
+
+        makedirs(dest_dir)
+        if index_fname is None:
+            index_fname = os.path.join(dest_dir, ".webcam_index.sqlite")
+        if delta_state is None:
+            delta_state = os.path.join(dest_dir, ".webcam_delta.json")
+        if journal_fname is None:
+            journal_fname = os.path.join(dest_dir, ".webcam_journal")
+        if state_fname is None:
+            state_fname = os.path.join(dest_dir, ".webcam_state.json")
+        self.index_fname = index_fname
+        self.delta_state = delta_state
+        self.journal_fname = journal_fname
+        self.skipped_fname = os.path.join(dest_dir, ".webcam_skipped")
+
+        # A dry run does not do anything so it does not need a journal, and
+        # it must not remember the folder's hash either or the next real run
+        # would think it had already seen everything.
         #
-        f_time = arrow.get(fname, arrow_timestamp_fmt)
-        if f_time <= when:
-            continue
+        self.state_fname = None
+        if not options['--dry_run']:
+            self.state_fname = state_fname
 
-        destination_dir = os.path.join(dest_dir, "%d" % f_time.year,
-                                       f_time.format('YYYY-MM-DD'))
-        destination_fname = os.path.join(destination_dir, fname)
-        print "Downloading %s to %s" % (fname, destination_fname)
+        # Our index, our view of the folder (in '--incremental' mode) and
+        # the Listing we keep patching from it (see list_folder()), our
+        # deduper, and our journal. See open().
+        #
+        self.index = None
+        self.view = None
+        self.listing = None
+        self.deduper = None
+        self.journal = None
 
-        # Wen doing a dry-run do not actually download the file.
+        # If we are serving frames (see FrameHandler) we keep the last few
+        # we downloaded in memory.
         #
-        if dry_run:
-            continue
+        self.frame_cache = None
+        if options['--http_port']:
+            self.frame_cache = FrameCache(int(options['--frame_cache']))
+
+        # Packing days (with '--compact') and applying our retention policy
+        # (in the background) both rewrite days of images. Only one of them
+        # may work on a day at once, even if they are in different processes
+        # (see DayLock.)
+        #
+        self.day_lock = DayLock(os.path.join(dest_dir, ".webcam_days.lock"))
+        self.retainer = None
+        if retention:
+            self.retainer = Retainer(
+                name, dest_dir, RetentionPolicy(retention),
+                os.path.join(dest_dir, ".webcam_retention.json"),
+                int(options['--retention_workers']), self.day_lock,
+                options['--fsync'])
+        self.next_retention = 0
+
+        # Dropbox returns a hash when we get the metadata for a directory that
+        # tells us if anything in the directory has changed. This lets us
+        # quickly know nothing has changed and skip the rest of the steps in
+        # one loop. It starts out as what it was at the end of our last run
+        # (or 'None' if we do not know, and then the first time through will
+        # do all the steps.)
+        #
+        # If the folder had to be listed a page at a time (see DirListing)
+        # the "hash" is really a delta cursor.
+        #
+        self.last_dir_hash = None
+        self.paged = False
+        self.truncated = False
+        self.latest = 0
+        self.loops = 0
+        self.load_state()
+
+        # When we next look for files we never downloaded (see backfill()).
+        # None means never.
+        #
+        self.next_backfill = None
+        if options['--backfill'] or self.backfill_interval:
+            self.next_backfill = 0
+
+    ##################################################################
+    #
+    def open(self):
+        """
+        Open our index, our view of the folder, our deduper and our journal,
+        if we have not already.
+        """
+        if self.index is not None:
+            return
+        options = self.options
+
+        # The index of files we have downloaded. If it is brand new (or we
+        # were asked to) build it from what is already in the download
+        # directory (and the frames '--dedupe' decided not to keep.)
+        #
+        self.index = DownloadIndex(self.index_fname)
+        if self.index.is_new or options['--rebuild_index']:
+            print "** Rebuilding index of downloaded files in '%s'" % \
+                self.dest_dir
+            self.index.rebuild(self.dest_dir,
+                               skipped_frames(self.skipped_fname))
+            print "** Index has %d files" % len(self.index)
+
+        # In '--incremental' mode, and for folders too big to list in one go,
+        # we keep our own view of what is in the dropbox folder and only ask
+        # dropbox what has changed.
+        #
+        if options['--incremental'] or self.paged:
+            self.view = FolderView(self.dropbox_folder, self.delta_state)
+
+        # With '--dedupe' we throw away new frames that look just like the
+        # last one we kept.
+        #
+        if options['--dedupe'] and not options['--dry_run']:
+            latest = self.index.latest()
+            self.deduper = FrameDeduper(
+                self.skipped_fname, float(options['--dedupe_threshold']),
+                int(options['--dedupe_workers']),
+                latest and download_path(self.dest_dir, latest))
 
-        # Make sure the destination directory exists and write out the file.
+        # The journal of what we are about to do. If we were killed part way
+        # through our last run it tells us what we still have to finish.
         #
-        if not os.path.exists(destination_dir):
-            os.makedirs(destination_dir)
+        if not options['--dry_run']:
+            self.journal = Journal(self.journal_fname, options['--fsync'])
 
+    ##################################################################
+    #
+    def load_state(self):
+        """
+        Read the folder's hash and the time of our latest image from our
+        state file, if we have one (and it is for the folder we watch.)
+        """
+        if self.state_fname is None or not os.path.exists(self.state_fname):
+            return
         try:
-            f, metadata = client.get_file_and_metadata(os.path.join(db_folder,
-                                                                    fname))
-            out = open(destination_fname, 'wb')
-            out.write(f.read())
-            out.close()
-        except dropbox.rest.ErrorResponse, e:
-            # It is okay if this file does not exist (means that it
-            # was deleted before we could get to copying it..)
-            #
-            if e.status != 404:
-                raise e
+            with open(self.state_fname, "rb") as f:
+                state = json.load(f)
+        except ValueError:
+            return
+        if state.get('folder') != self.dropbox_folder:
+            return
+        self.last_dir_hash = state.get('hash')
+        self.paged = state.get('paged', False)
+        self.latest = state.get('latest', 0)
+        self.next_retention = state.get('next_retention', 0)
+
+    ##################################################################
+    #
+    def save_state(self):
+        """
+        Write the folder's hash and the time of our latest image to our
+        state file.
+
+        In '--incremental' mode our "hash" is just a count of the changes
+        our FolderView has seen since we started, which means nothing to
+        the next run, so we do not save it.
+        """
+        if self.state_fname is None:
+            return
+        state = json.dumps({'folder': self.dropbox_folder,
+                            'hash': (None if self.options['--incremental']
+                                     else self.last_dir_hash),
+                            'paged': self.paged,
+                            'latest': self.latest,
+                            'next_retention': self.next_retention})
+        write_file_atomically(StringIO(state), self.state_fname)
+
+    ##################################################################
+    #
+    def quick_check(self, backfill_due):
+        """
+        Return True if we can find out if anything has changed in the
+        dropbox folder just by asking dropbox if its hash is still the one
+        we last saw, before opening anything.
+
+        If the folder is so big it was listed a page at a time its "hash" is
+        a delta cursor and we ask for the changes since then instead (see
+        folder_changed_since().)
+
+        We can not if we do not know its hash, if we are looking at it
+        '--incremental'ly (the delta is already as cheap as it gets), if it
+        is time to backfill, if we were asked to rebuild our index (or do
+        not have one yet), or if our journal says our last run did not
+        finish.
+
+        Arguments:
+        - `backfill_due`: True if we have to backfill this run
+        """
+        if (self.last_dir_hash is None or backfill_due or
+                self.options['--incremental']):
+            return False
+        if self.index is None:
+            if (self.options['--rebuild_index'] or
+                    not os.path.exists(self.index_fname)):
+                return False
+        if self.journal is not None:
+            return not any(self.journal.pending(op) for op in Journal.OPS)
+        return (self.options['--dry_run'] or
+                not os.path.exists(self.journal_fname) or
+                os.path.getsize(self.journal_fname) == 0)
+
+    ##################################################################
+    #
+    @contextmanager
+    def phase(self, name):
+        """
+        A context manager around the phase `name` of a run that records how
+        long it took in our metrics and, if this run is being profiled (see
+        Profiler), profiles it.
+        """
+        with metrics.timer('webcam_phase_seconds', phase=name,
+                           camera=self.name):
+            with profiler.phase(name):
+                yield
+
+    ##################################################################
+    #
+    def list_folder(self, backend, last_hash=None):
+        """
+        Return the hash (or something like it) and the Listing of the files
+        in our dropbox folder.
+
+        If there were more than '--max_listing' files we only list that many,
+        the hash is None, so the run is never skipped, and `truncated` is
+        set, so the run does nothing with the listing.
+
+        If we are given the folder's `last_hash` and it has not changed we
+        get back that hash and None instead of a Listing.
+
+        Once the folder has had to be listed a page at a time we keep a
+        FolderView of it, started from that listing, and from then on only
+        ask dropbox what has changed, like '--incremental' does. The "hash"
+        is then the view's delta cursor.
+
+        With a FolderView we hand back the same Listing each time, patched
+        with what has changed, so a poll costs what changed rather than the
+        size of the folder. (The renames we do are applied to it by run_once()
+        and we get told about them again by the next delta, which does no
+        harm.)
+        """
+        self.truncated = False
+        with self.phase('list'):
+            if self.view is not None:
+                changed = self.view.update(backend)
+                if self.options['--incremental']:
+                    cur_hash = self.view.generation
+                    unchanged = cur_hash == last_hash
+                else:
+                    cur_hash = self.view.cursor
+                    unchanged = not changed and last_hash is not None
+                if unchanged:
+                    return cur_hash, None
+
+                # Rather than parse and sort the whole folder again we patch
+                # the Listing we made last time with what has changed.
+                #
+                reset, changes = self.view.take_changes()
+                if self.listing is None or reset:
+                    self.listing = Listing(self.view.listing(),
+                                           self.view.meta())
+                else:
+                    self.listing.apply_changes(changes)
+                return cur_hash, self.listing
+            listing = DirListing(backend, self.dropbox_folder,
+                                 self.listing_limit, self.max_listing,
+                                 last_hash)
+            files = Listing(listing, listing.meta)
+        if listing.unchanged:
+            return listing.hash, None
+        self.paged = listing.paged
+        if listing.truncated:
+            print "** Only listed the first %d files in '%s'" % \
+                (self.max_listing, self.dropbox_folder)
+            metrics.inc('webcam_truncated_listings_total', camera=self.name)
+            self.truncated = True
+        elif listing.paged:
+            metrics.inc('webcam_paged_listings_total', camera=self.name)
+            self.view = FolderView(self.dropbox_folder, self.delta_state)
+            self.view.seed(listing.hash, listing.meta)
+            self.view.take_changes()
+            self.listing = files
+        return listing.hash, files
+
+    ##################################################################
+    #
+    def run_once(self, backend, backend_factory, stop):
+        """
+        Do one run of the three tasks for this camera. Errors from dropbox
+        are raised.
+
+        Arguments:
+        - `backend`: The backend to use
+        - `backend_factory`: A callable that returns a new backend for each
+                             worker
+        - `stop`: A threading.Event that is set when we should stop
+        """
+        options = self.options
+        dry_run = options['--dry_run']
+
+        # Get the horizon in the past beyond which in the past we delete old
+        # files
+        #
+        then = time.time() - self.expiry * 24 * 60 * 60
+
+        # Every now and then go through the images we have downloaded
+        # getting rid of the ones we do not need to keep as they are.
+        #
+        self.retain(stop)
+
+        # If it is time to look for files we never downloaded we do not skip
+        # this run even if nothing has changed.
+        #
+        backfill_due = (self.next_backfill is not None and
+                        time.time() >= self.next_backfill)
+
+        # If we can, first just ask dropbox if the folder has changed since
+        # we last looked. If it has not we are done (and when we are run from
+        # cron, that is most of the time), without opening our index or our
+        # journal or anything else. If it has we get the folder's listing
+        # back and carry on with it.
+        #
+        # If the folder is so big we have to page through it we ask dropbox
+        # for what has changed since our last listing instead.
+        #
+        files = None
+        checked = self.quick_check(backfill_due)
+        if checked:
+            metrics.inc('webcam_loops_total', camera=self.name)
+            if self.paged:
+                changed, cursor = folder_changed_since(
+                    backend, self.dropbox_folder, self.last_dir_hash)
+                if not changed:
+                    self.last_dir_hash = cursor
+                    self.save_state()
             else:
-                print "** File '%s' was deleted from the dropbox before we " \
-                    "could download it" % fname
+                cur_dir_hash, files = self.list_folder(backend,
+                                                       self.last_dir_hash)
+                changed = files is not None
+            if not changed:
+                print "** Skipping loop. No changes in folder '%s'" % \
+                    self.dropbox_folder
+                metrics.inc('webcam_skipped_loops_total', camera=self.name)
+                self.scheduler.unchanged()
+                return
+
+        self.open()
+
+        # Finish whatever we were in the middle of when we last stopped.
+        # (If we took the quick check there is nothing to finish, so the
+        # listing we got is still good.)
+        #
+        self.recover(backend, backend_factory)
+
+        # Find the latest image file that we have already downloaded
+        #
+        with self.phase('find_latest'):
+            img_file = self.index.latest()
+
+        # Convert the image file name in to a timestamp. I am going to be lazy
+        # and just assume that the file name is in the proper format.
+        #
+        if img_file is not None:
+            latest = fname_timestamp(img_file)
         else:
-            print "** Done downloading %s" % fname
-    return
+            # Guess we better not have images older than the unix epoch..
+            #
+            latest = 0
+        self.latest = latest
+
+        # Get the list of files and the hash directory we are watching. We can
+        # skip the rest of this run if the current directory hash is the same
+        # as the last directory hash meaning nothing in this directory has
+        # changed since the last time we asked. (Unless the quick check above
+        # already got us the list.)
+        #
+        if files is None:
+            cur_dir_hash, files = self.list_folder(
+                backend, None if backfill_due else self.last_dir_hash)
+            if not checked:
+                metrics.inc('webcam_loops_total', camera=self.name)
+            if files is None or (cur_dir_hash is not None and
+                                 cur_dir_hash == self.last_dir_hash and
+                                 not backfill_due):
+                print "** Skipping loop. No changes in folder '%s'" % \
+                    self.dropbox_folder
+                metrics.inc('webcam_skipped_loops_total', camera=self.name)
+                self.scheduler.unchanged()
+                return
+
+        # A listing that was cut short (see '--max_listing') does not tell us
+        # which files we are missing. If we downloaded the new files in it
+        # the ones it left out that are older than those would never be
+        # downloaded, and we must not delete files we have not downloaded.
+        #
+        if self.truncated:
+            print "** Not renaming, downloading, or deleting anything in " \
+                "'%s' until it can be listed in full" % self.dropbox_folder
+            self.scheduler.error()
+            return
+        self.scheduler.changed()
+
+        # In '--pipeline' mode all three steps happen at the same time.
+        #
+        if self.pipeline:
+            if backfill_due:
+                self.backfill(backend, backend_factory, files, then, latest)
+            print "** Renaming, downloading, and deleting files"
+            with self.phase('pipeline'):
+                limited = run_pipeline(
+                    backend, self.dropbox_folder, self.dest_dir, files,
+                    latest, then, options['--delete'],
+                    download_workers=self.download_workers,
+                    mutation_workers=self.mutation_workers,
+                    backend_factory=backend_factory,
+                    fsync=options['--fsync'],
+                    index=self.index, stop=stop, queue_size=self.queue_size,
+                    journal=self.journal, downloaded=self.downloaded,
+                    limit=self.max_files)
+            self.dedupe()
+            self.pack()
+
+            # If we did not get to all the new files, make sure the next run
+            # is not skipped so we get to the rest.
+            #
+            self.last_dir_hash = None if limited else cur_dir_hash
+            self.loops += 1
+            self.checkpoint()
+            return
+
+        # First step rename all the files that have the old file pattern.
+        #
+        print "** Renaming existing files"
+        with self.phase('rename'):
+            renames = rename_dropbox_files(
+                backend, self.dropbox_folder, files, dry_run,
+                workers=self.mutation_workers,
+                backend_factory=backend_factory, journal=self.journal)
+
+        # Second step, download all files that have appeared since the last
+        # time we ran. We just changed the contents of the directory by
+        # renaming files but we know what we renamed, so we can update our
+        # listing ourselves. Every '--verify_every' runs we ask dropbox for
+        # the listing again instead.
+        #
+        # NOTE: Our renames change the folder's hash so the next run will not
+        #       be skipped. It will not find anything to rename or download
+        #       though (unless something new has shown up.)
+        #
+        print "** Downloading new files"
+        self.last_dir_hash = cur_dir_hash
+        self.loops += 1
+        if self.verify_every > 0 and self.loops % self.verify_every == 0:
+            self.last_dir_hash, files = self.list_folder(backend)
+        else:
+            files.apply_renames(renames)
+
+        # If we are only downloading some of the new files this run, make
+        # sure the next run is not skipped so we get to the rest.
+        #
+        limited = (self.max_files and
+                   len(files.newer_than(latest)) > self.max_files)
+        if limited:
+            self.last_dir_hash = None
+        with self.phase('download'):
+            download_new_files(backend, self.dropbox_folder, self.dest_dir,
+                               files, latest, dry_run,
+                               workers=self.download_workers,
+                               backend_factory=backend_factory,
+                               fsync=options['--fsync'], index=self.index,
+                               limit=self.max_files, journal=self.journal,
+                               downloaded=self.downloaded)
+        self.dedupe()
+
+        # Every now and then (if '--backfill' or '--backfill_interval' is
+        # set) also download files older than the latest one we had that we
+        # do not have.
+        #
+        if backfill_due:
+            self.backfill(backend, backend_factory, files, then, latest)
+
+        # Finally (if '--delete' is set), delete files that are older a set
+        # time (by default 7 days.) If we did not get to download all the new
+        # files, do not delete any that we have not downloaded yet.
+        #
+        if options['--delete']:
+            if limited:
+                newest = self.index.latest()
+                then = min(epoch(then),
+                           fname_timestamp(newest) if newest else 0)
+            print "** Deleteing old files"
+            with self.phase('delete'):
+                delete_old_files(backend, self.dropbox_folder, files, then,
+                                 dry_run, workers=self.mutation_workers,
+                                 backend_factory=backend_factory,
+                                 journal=self.journal)
+
+        # And with '--compact', pack up the days that are over.
+        #
+        self.pack()
+        self.checkpoint()
+        return
+
+    ##################################################################
+    #
+    def retain(self, stop):
+        """
+        Every RETENTION_INTERVAL seconds start applying our retention policy
+        to the images we have downloaded, in the background.
+
+        Arguments:
+        - `stop`: A threading.Event that is set when we should stop
+        """
+        if self.retainer is None or self.options['--dry_run']:
+            return
+        if self.retainer.running() or time.time() < self.next_retention:
+            return
+        self.next_retention = time.time() + RETENTION_INTERVAL
+        self.save_state()
+        self.retainer.start(stop)
+
+    ##################################################################
+    #
+    def downloaded(self, fname, local_fname):
+        """
+        Called with the name of each frame we download and where we put it.
+        """
+        if self.frame_cache is not None:
+            with open(local_fname, "rb") as f:
+                self.frame_cache.add(fname, f.read())
+        if self.deduper is not None:
+            self.deduper.add(fname, local_fname)
+
+    ##################################################################
+    #
+    def dedupe(self):
+        """
+        If we are throwing away frames that have not changed, go through the
+        frames we just downloaded.
+        """
+        if self.deduper is None:
+            return
+        with self.phase('dedupe'):
+            self.deduper.finish()
+
+    ##################################################################
+    #
+    def pack(self):
+        """
+        If we were asked to, pack each day that is over in to its own pack
+        file.
+        """
+        if not self.compact:
+            return
+        with self.phase('compact'):
+            with self.day_lock:
+                days, frames = compact_days(self.dest_dir,
+                                            self.keep_loose_days,
+                                            self.options['--fsync'])
+        metrics.inc('webcam_frames_packed_total', frames, camera=self.name)
+
+    ##################################################################
+    #
+    def backfill(self, backend, backend_factory, files, start, end):
+        """
+        Download the files in `files` created from `start` to `end` that are
+        not in our index, and work out when we should do this next.
+
+        Arguments:
+        - `backend`: The backend to use
+        - `backend_factory`: A callable that returns a new backend for each
+                             worker
+        - `files`: The Listing of our dropbox folder
+        - `start`: The oldest files to look at (normally our expiry horizon)
+        - `end`: The newest files to look at (normally the latest file we had
+                 downloaded when this run started. Newer files are left to
+                 download_new_files())
+        """
+        with self.phase('backfill'):
+            backfill_files(backend, self.dropbox_folder, self.dest_dir, files,
+                           self.index, start, end, self.options['--dry_run'],
+                           workers=self.download_workers,
+                           backend_factory=backend_factory,
+                           fsync=self.options['--fsync'],
+                           journal=self.journal)
+        self.next_backfill = None
+        if self.backfill_interval:
+            self.next_backfill = time.time() + self.backfill_interval
+
+    ##################################################################
+    #
+    def recover(self, backend, backend_factory):
+        """
+        Finish the renames, downloads, and deletes that our journal says we
+        started but did not get to finish (because we were killed, or got an
+        error part way through a run.)
+
+        Renames that already happened just come back as not found. Downloads
+        ignore how far along our index says we are, since the file we did not
+        finish downloading is likely older than ones we did.
+
+        Arguments:
+        - `backend`: The backend to use
+        - `backend_factory`: A callable that returns a new backend for each
+                             worker
+        """
+        if self.journal is None:
+            return
+        renames = self.journal.pending('rename')
+        downloads = self.journal.pending('download')
+        deletes = self.journal.pending('delete')
+        if not (renames or downloads or deletes):
+            return
+
+        print "** Finishing %d renames, %d downloads, and %d deletes from " \
+            "our last run" % (len(renames), len(downloads), len(deletes))
+        for fname, new_fname in renames:
+            print "Renaming '%s' to '%s'" % (fname, new_fname)
+            move_file(backend, self.dropbox_folder, fname, new_fname)
+            self.journal.done('rename', fname)
+            downloads.append(new_fname)
+
+        # We may have died after adding a file to the index but before
+        # saying so in the journal.
+        #
+        for fname in downloads:
+            if fname in self.index:
+                self.journal.done('download', fname)
+
+        download_new_files(backend, self.dropbox_folder, self.dest_dir,
+                           downloads, 0, False,
+                           workers=self.download_workers,
+                           backend_factory=backend_factory,
+                           fsync=self.options['--fsync'], index=self.index,
+                           journal=self.journal)
+        delete_old_files(backend, self.dropbox_folder, deletes, time.time(),
+                         False, workers=self.mutation_workers,
+                         backend_factory=backend_factory,
+                         journal=self.journal)
+        self.checkpoint()
+
+    ##################################################################
+    #
+    def checkpoint(self):
+        """
+        Empty our journal if everything in it is done, and save the folder's
+        hash and the time of our latest image to our state file.
+        """
+        if self.journal is not None:
+            self.journal.checkpoint()
+        img_file = self.index.latest()
+        if img_file is not None:
+            self.latest = fname_timestamp(img_file)
+        self.save_state()
+
+    ##################################################################
+    #
+    def close(self):
+        # Applying our retention policy can take hours, so we stop after the
+        # day it is working on. If that left days undone (like it will when
+        # we are run from cron with '--one_run') our next run carries on with
+        # them instead of waiting RETENTION_INTERVAL.
+        #
+        if self.retainer is not None and not self.retainer.join():
+            self.next_retention = 0
+            self.save_state()
+        if self.index is not None:
+            self.index.close()
+        if self.deduper is not None:
+            self.deduper.close()
+        if self.journal is not None:
+            self.journal.close()
 
 
 ####################################################################
 #
-def delete_old_files(client, db_folder, files, expiry, dry_run):
+def make_scheduler(interval, options):
     """
-    In the given dropbox folder delete all files that match our download file
-    pattern whose creation time is older than 'now-expiry'
+    Return the PollScheduler to use for a camera we run every `interval`
+    seconds, given our command line options.
+    """
+    if options['--adaptive']:
+        return AdaptivePollScheduler(interval,
+                                     int(options['--min_interval']),
+                                     int(options['--max_interval']),
+                                     jitter=float(options['--jitter']))
+    return PollScheduler(interval)
 
-    NOTE: We only consider files that are in our 'files' array. We expect the
-    calls to be close enough together that there is no real reason to make an
-    additional call to Dropbox to get the list of files.
 
-    And if we do not delete some files this run that we delete on the next run
-    that is fine anyways.
+####################################################################
+#
+def cameras_from_config(config, options):
+    """
+    Return the list of Cameras we are watching.
 
-    We are going to use the file's name as the determination of its creation
-    time. We can do this because we have renamed all the files we care about to
-    have this name format.
+    Each '[camera <name>]' section of the config declares a camera. It must
+    have a 'dropbox_folder' and a 'dir' and may have an 'expiry', an
+    'interval', an 'index', a 'delta_state', a 'journal', a 'state', and a
+    'retention'. Anything it does not have comes from the command line
+    options.
 
-    This also makes sure that we are only deleting files that we actually want
-    to delete.
+    If the config has no camera sections we watch the one camera described
+    by the command line options.
 
     Arguments:
-    - `client`: The dropbox client
-    - `db_folder`: The dropbox folder we are deleting files from
-    - `files`: The list of all the files we are going to consider
-    - `expiry`: An arrow timestamp that the files must be older than in order
-                to be considered for deletion.
-    - `dry_run`: a boolean. If true then no actual actions are performed
+    - `config`: The ConfigParser our config was read in to
+    - `options`: Our command line options (as parsed by docopt)
     """
-    # Going through the list of files only delete ones that are before 'expiry'
-    # and conform to our file name pattern.
-    #
-    for fname in files:
-        # only delete files that match our timestamp format. We want to force
-        # the file names to be strings (not unicode) for safety of other
-        # manipulations.
-        #
-        fname = str(fname)
-        if DATE_FNAME_re.search(fname) is None:
-            continue
+    def get(section, option, default):
+        if config.has_option(section, option):
+            return config.get(section, option)
+        return default
 
-        # Only download files that were created after 'when'
-        #
-        f_time = arrow.get(fname, arrow_timestamp_fmt)
-        if f_time > expiry:
+    cameras = []
+    for section in config.sections():
+        if not section.startswith("camera "):
             continue
-        print "** Deleting file '%s'" % fname
-        if not dry_run:
-            try:
-                client.file_delete(os.path.join(db_folder, fname))
-            except dropbox.rest.ErrorResponse, e:
-                # It is okay if this file does not exist..
-                #
-                if e.status != 404:
-                    raise e
-    return
+        interval = int(get(section, "interval", options['--interval']))
+        cameras.append(Camera(
+            section[len("camera "):].strip(),
+            config.get(section, "dropbox_folder"),
+            config.get(section, "dir"),
+            int(get(section, "expiry", options['--expiry'])),
+            make_scheduler(interval, options), options,
+            index_fname=get(section, "index", None),
+            delta_state=get(section, "delta_state", None),
+            journal_fname=get(section, "journal", None),
+            state_fname=get(section, "state", None),
+            retention=get(section, "retention", options['--retention'])))
+
+    if not cameras:
+        cameras.append(Camera(
+            "default", options['--dropbox_folder'], options['--dir'],
+            int(options['--expiry']),
+            make_scheduler(int(options['--interval']), options), options,
+            index_fname=options['--index'],
+            delta_state=options['--delta_state'],
+            journal_fname=options['--journal'],
+            state_fname=options['--state'],
+            retention=options['--retention']))
+    return cameras
 
 
 #############################################################################
@@ -430,9 +5744,9 @@ def main():
 
     """
     args = docopt(__doc__, version=__version__)
-    dropbox_folder = args['--dropbox_folder']
-    expiry = int(args['--expiry'])
-    interval = int(args['--interval'])
+    if args['--dedupe'] and not import_dedupe_modules():
+        print "** '--dedupe' needs numpy and PIL (or Pillow) installed"
+        return
 
     # Read in the config. We need this no matter what so we can get the
     # app key and app secret key.
@@ -443,6 +5757,7 @@ def main():
     # Setup our dropbox session. We use the app_key and app_secret we got from
     # the config file. This is a 'dropbox' app instead of an 'app folder' app.
     #
+    import_dropbox()
     sess = dropbox.session.DropboxSession(config.get("general", "app_key"),
                                           config.get("general", "app_secret"),
                                           "dropbox")
@@ -475,111 +5790,147 @@ def main():
     #       only delete files that are images that conform to the naming
     #       convention we rename the files to.
     #
-    client = dropbox.client.DropboxClient(sess)
+    # Every call we make to dropbox is timed and counted in our metrics, and
+    # all of our cameras together never have more than '--max_concurrency'
+    # calls to dropbox going at once.
+    #
+    # When downloading (or renaming or deleting) with several workers each one
+    # gets its own client so they are not all fighting over one connection.
+    # Each thread keeps its connections to dropbox open between calls, if our
+    # version of the dropbox module lets us.
+    #
+    # A call that fails with a transient error is retried (up to '--retries'
+    # times, and '--retry_budget' times in all in one run of a camera.)
+    #
+    limit = threading.BoundedSemaphore(int(args['--max_concurrency']))
+    budget = RetryBudget(int(args['--retry_budget']))
+    rest_client = None if args['--no_keep_alive'] else pooled_rest_client()
+    client_args = {} if rest_client is None else {'rest_client': rest_client}
+
+    def backend_factory():
+        return RetryingBackend(
+            LimitedBackend(
+                InstrumentedBackend(
+                    DropboxBackend(
+                        dropbox.client.DropboxClient(sess, **client_args))),
+                limit),
+            int(args['--retries']), budget)
+    backend = backend_factory()
 
-    # Dropbox returns a hash when we get the metadata for a directory that
-    # tells us if anything in the directory has changed. This lets us quickly
-    # know nothing has changed and skip the rest of the steps in one
-    # loop. Since it starts out as 'None' the first time through will always do
-    # all the steps.
+    # The cameras we are watching. They all share the one dropbox session.
     #
-    last_dir_hash = None
+    cameras = cameras_from_config(config, args)
+    for camera in cameras:
+        print "** Watching '%s' (downloading to '%s')" % \
+            (camera.dropbox_folder, camera.dest_dir)
+        if (camera.retainer is not None and
+                camera.retainer.policy.recompresses() and
+                not import_image_modules()):
+            print "** Recompressing old images needs PIL (or Pillow) " \
+                "installed"
+            return
 
-    # And start our main loop that will go through the three tasks:
-    # o rename files to date based names
-    # o download all new files to the download directory
-    # o remove files from dropbox that are older than the time period.
+    # Profile a sample of our runs and log slow operations, if we were asked
+    # to.
     #
-    running = True
+    if args['--profile']:
+        profiler.configure(args['--profile_dir'],
+                           float(args['--profile_sample']),
+                           int(args['--profile_keep']),
+                           float(args['--slow_threshold']))
 
-    while running:
-        # Get the horizon in the past beyond which in the past we delete old
-        # files
-        #
-        then = arrow.utcnow().replace(days=-expiry)
+    # Make our metrics available, if we were asked to.
+    #
+    if args['--metrics_port']:
+        start_metrics_server(int(args['--metrics_port']))
 
-        # Find the latest image file that we have already downloaded
-        #
-        img_file, date_dir, year_dir = find_latest_downloaded_file(
-            args['--dir']
-        )
+    # And serve our frames to dashboards, if we were asked to.
+    #
+    if args['--http_port']:
+        start_frame_server(args['--http_host'], int(args['--http_port']),
+                           cameras)
 
-        # Convert the image file name in to a timestamp. I am going to be lazy
-        # and just assume that the file name is in the proper format.
-        #
-        if img_file is not None:
-            latest = arrow.get(img_file, arrow_timestamp_fmt)
-        else:
-            # Guess we better not have images older than the unix epoch..
-            #
-            latest = arrow.get(0)
+    def publish_metrics():
+        metrics.set('webcam_last_run_timestamp_seconds', time.time())
+        for camera in cameras:
+            if camera.latest:
+                metrics.set('webcam_catchup_lag_seconds',
+                            time.time() - camera.latest, camera=camera.name)
+        if args['--stats_file']:
+            metrics.write(args['--stats_file'])
 
-        # Get the list of files and the hash directory we are watching. We can
-        # skip the rest of this loop if the current directory hash is the same
-        # as the last directory hash meaning nothing in this directory has
-        # changed since the last time we asked.
-        #
-        try:
-            cur_dir_hash, files = get_dropbox_dir(client,
-                                                  dropbox_folder)
-            if cur_dir_hash == last_dir_hash:
-                print "** Skipping loop. No changes in folder '%s'" % \
-                    dropbox_folder
-                sleep(interval)
-                continue
+    # On a SIGTERM we finish what we are doing (in '--pipeline' mode, just the
+    # files we are in the middle of) and exit.
+    #
+    stop = threading.Event()
 
-            # First step rename all the files that have the old file pattern.
-            #
-            print "** Renaming existing files"
-            rename_dropbox_files(client, dropbox_folder, files,
-                                 args['--dry_run'])
-
-            # Second step, download all files that have appeared since the last
-            # time we ran. We need to get the list of files again since we just
-            # changed the contents of the directory by renaming files (and also
-            # changing its hash)
-            #
-            print "** Downloading new files"
-            last_dir_hash, files = get_dropbox_dir(client, dropbox_folder)
-            download_new_files(client, dropbox_folder, args['--dir'], files,
-                               latest, args['--dry_run'])
+    def sigterm_handler(signum, frame):
+        print "** Got SIGTERM. Stopping."
+        stop.set()
+    signal.signal(signal.SIGTERM, sigterm_handler)
 
-            # Finally (if '--delete' is set), delete files that are older a set
-            # time (by default 7 days.)
-            #
-            if args['--delete']:
-                print "** Deleteing old files"
-                delete_old_files(client, dropbox_folder, files, then,
-                                 args['--dry_run'])
-        except dropbox.rest.ErrorResponse, e:
-            # If we got anything but a 200 raise an exception (why did
-            # we get a 200?)
+    # And start our main loop. Each time through we run the camera that is
+    # due to be run soonest, going through the three tasks:
+    #
+    # o rename files to date based names
+    # o download all new files to the download directory
+    # o remove files from dropbox that are older than the time period.
+    #
+    # and then work out when it is due to be run again. Since the camera
+    # that has been waiting the longest always goes next, a busy camera can
+    # not keep the others from being run.
+    #
+    due = [(time.time(), i, camera) for i, camera in enumerate(cameras)]
+    heapq.heapify(due)
+
+    while due and not stop.is_set():
+        when, i, camera = heapq.heappop(due)
+        delay = when - time.time()
+        if delay > 0:
+            camera.scheduler.sleep(delay)
+            if stop.is_set():
+                break
+
+        budget.reset()
+        try:
+            with profiler.run(camera.name):
+                camera.run_once(backend, backend_factory, stop)
+        except BackendError, e:
+            # If we got anything but a 200, a server error, or being told to
+            # slow down raise an exception (why did we get a 200?)
             #
-            if e.status not in (200, 500):
-                print "** Wuh? Got dropbox.rest.ErrorResponse: %s" % str(e)
+            if e.status != 200 and not transient_error(e):
+                print "** Wuh? Got error from dropbox: %s" % str(e)
                 raise e
             else:
-                print "** huh. Got dropbox.rest.ErrorResponse: %s" % str(e)
-        except dropbox.rest.RESTSocketError, e:
-            # If we get a timeout, just continue on..
+                print "** huh. Got error from dropbox: %s" % str(e)
+                camera.scheduler.error(retry_after(e))
+        except BackendSocketError, e:
+            # If we could not talk to dropbox (even after retrying), just
+            # continue on..
             #
             print "** Got errno from dropbox socket: %s" % repr(e)
             if e.errno == 60:
                 print "** Connection to dropbox timed out."
-            else:
-                raise e
+            camera.scheduler.error()
+
+        publish_metrics()
 
-        # If we are doing a 'one run' then we immediate set 'running'
-        # to false once we enter the loop so the loop will only run
-        # once. Otherwise sleep..
+        # If we are doing a 'one run' we run each camera once and then we are
+        # done. Otherwise work out when this camera should run next.
         #
         if args['--one_run']:
-            running = False
-        else:
-            print ("*** %s Done run. Sleeping for %d" %
-                   (arrow.now().format('YYYY-MM-DD HH:mm:ss ZZ'), interval))
-            sleep(interval)
+            continue
+        delay = camera.scheduler.next_interval()
+        print ("*** %s Done run of '%s'. Next run in %d (%d fewer listings "
+               "than polling every %d seconds)" %
+               (time.strftime("%Y-%m-%d %H:%M:%S %z"), camera.name,
+                delay, camera.scheduler.calls_saved(),
+                camera.scheduler.interval))
+        heapq.heappush(due, (time.time() + delay, i, camera))
 
+    for camera in cameras:
+        camera.close()
     print "+*+* Exiting main loop"
     return
 